@@ -20,17 +20,16 @@
 import sys
 
 from platform import python_version
-from pkg_resources import parse_version
 
 
 def verify_interpreter_version():
     """Verify the Pyhton interpreter version."""
-    minversion = '3.5'
-    version = python_version()
-    if parse_version(version) < parse_version(minversion):  # pragma: no cover
+    minversion = (3, 5)
+    if sys.version_info < minversion:  # pragma: no cover
         sys.stdout.write("Incompatible Python version, minimum supported "
                          "version {}, found version {}\n".format(
-                             minversion, version))
+                             '.'.join(str(v) for v in minversion),
+                             python_version()))
         sys.exit(1)
 
 
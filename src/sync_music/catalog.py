@@ -0,0 +1,341 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Metadata catalog of the source files and queries on it.
+
+The catalog stores normalised tags of every audio file in the source, so
+that --select can choose the files to sync without parsing all of them again
+on every run. Only files whose size or modification time changed are parsed.
+
+Queries are Python expressions restricted to comparisons of the catalog
+fields, e.g. ``genre == "jazz" and year >= 1990 or rating >= 4``. Text is
+compared case-insensitively and fields with several values (e.g. genre)
+match if any value matches. ``"beat" in artist`` checks for a substring,
+``genre in ["jazz", "blues"]`` for one of several values.
+"""
+
+import ast
+import bisect
+import logging
+import operator
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from . import util
+
+logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
+    logging.getLogger(__name__))
+
+TEXT_FIELDS = ['artist', 'albumartist', 'album', 'title', 'genre',
+               'composer']
+NUMBER_FIELDS = ['year', 'tracknumber', 'discnumber', 'rating', 'length']
+# Fields that are derived from the path instead of being stored
+PATH_FIELDS = ['path', 'format']
+FIELDS = TEXT_FIELDS + NUMBER_FIELDS + PATH_FIELDS
+
+ID3_FRAMES = {
+    'TPE1': 'artist',
+    'TPE2': 'albumartist',
+    'TALB': 'album',
+    'TIT2': 'title',
+    'TCON': 'genre',
+    'TCOM': 'composer',
+    'TDRC': 'date',
+    'TRCK': 'tracknumber',
+    'TPOS': 'discnumber',
+}
+MP4_ATOMS = {
+    '\xa9ART': 'artist',
+    'aART': 'albumartist',
+    '\xa9alb': 'album',
+    '\xa9nam': 'title',
+    '\xa9gen': 'genre',
+    '\xa9wrt': 'composer',
+    '\xa9day': 'date',
+    'trkn': 'tracknumber',
+    'disk': 'discnumber',
+}
+VORBIS_COMMENTS = {name: name for name in TEXT_FIELDS + [
+    'date', 'tracknumber', 'discnumber', 'rating']}
+VORBIS_COMMENTS['album artist'] = 'albumartist'
+
+# Lower bounds of the POPM ratings (0-255) for 1 to 5 stars
+POPM_STARS = [1, 32, 96, 160, 224]
+
+
+def _get_number(value):
+    """Get the leading number of a tag value (e.g. 3 of '3/12')."""
+    digits = ''
+    for char in str(value).strip():
+        if not char.isdigit():
+            break
+        digits += char
+    return int(digits) if digits else None
+
+
+def _get_raw_tags(audio):
+    """Get the tag values by field name of a file parsed by mutagen.
+
+    :returns: dict of lists of values
+    """
+    import mutagen.id3
+    import mutagen.mp4
+    tags = {}
+    if isinstance(audio.tags, mutagen.id3.ID3):
+        for frame_id, name in ID3_FRAMES.items():
+            frame = audio.tags.get(frame_id)
+            if frame is not None:
+                tags[name] = frame.genres if name == 'genre' else frame.text
+        popm = audio.tags.getall('POPM')
+        if popm:
+            tags['rating'] = [bisect.bisect_right(POPM_STARS, popm[0].rating)]
+    elif isinstance(audio.tags, mutagen.mp4.MP4Tags):
+        for atom, name in MP4_ATOMS.items():
+            if atom in audio.tags:
+                tags[name] = [value[0] if isinstance(value, tuple) else value
+                              for value in audio.tags[atom]]
+    elif audio.tags is not None:
+        for comment, name in VORBIS_COMMENTS.items():
+            if comment in audio.tags:
+                tags.setdefault(name, []).extend(audio.tags[comment])
+    return tags
+
+
+def normalize_tags(audio):
+    """Get the catalog entry of a file parsed by mutagen.
+
+    Text is lower case, numbers are parsed and missing fields are left out.
+    Ratings are given in stars from 0 to 5.
+    """
+    entry = {}
+    tags = _get_raw_tags(audio)
+    for name in TEXT_FIELDS:
+        values = [str(value).strip().lower() for value in tags.get(name, [])]
+        values = [value for value in values if value]
+        if values:
+            entry[name] = values
+    for name, tag in [('year', 'date'), ('tracknumber', 'tracknumber'),
+                      ('discnumber', 'discnumber')]:
+        number = _get_number(tags[tag][0]) if tags.get(tag) else None
+        if number is not None:
+            entry[name] = number
+    try:
+        rating = float(str(tags['rating'][0]))
+        # Ratings are given in percent or stars
+        entry['rating'] = rating / 20 if rating > 5 else rating
+    except (KeyError, IndexError, ValueError):
+        pass
+    if audio.info is not None and getattr(audio.info, 'length', None):
+        entry['length'] = audio.info.length
+    return entry
+
+
+def read_tags(path):
+    """Parse a file and get its catalog entry (None if not supported)."""
+    import mutagen
+    audio = mutagen.File(path)
+    if audio is None:
+        return None
+    return normalize_tags(audio)
+
+
+def get_fields(in_filename, entry):
+    """Get the values of all query fields of a file.
+
+    :returns: dict of lists of values
+    """
+    fields = {name: value if isinstance(value, list) else [value]
+              for name, value in entry.items()}
+    fields['path'] = [in_filename.lower()]
+    fields['format'] = [os.path.splitext(in_filename)[1][1:].lower()]
+    return fields
+
+
+class Query:
+    """Query on the catalog fields (see module documentation)."""
+
+    comparisons = {
+        ast.Eq: operator.eq,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+    }
+
+    def __init__(self, expression):
+        """Compile the query.
+
+        :raises ValueError: if the expression is not a valid query
+        """
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as err:
+            raise ValueError("invalid query: {}".format(err.msg)) from err
+        self._evaluate = self._compile(tree.body)
+
+    def matches(self, fields):
+        """Check whether the fields (see get_fields()) match the query."""
+        return bool(self._evaluate(fields))
+
+    def _compile(self, node):
+        """Compile a condition to a function of the fields."""
+        if isinstance(node, ast.BoolOp):
+            operands = [self._compile(value) for value in node.values]
+            combine = all if isinstance(node.op, ast.And) else any
+            return lambda fields: combine(
+                operand(fields) for operand in operands)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = self._compile(node.operand)
+            return lambda fields: not operand(fields)
+        if isinstance(node, ast.Compare):
+            conditions = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                conditions.append(self._compile_comparison(left, op, right))
+                left = right
+            return lambda fields: all(
+                condition(fields) for condition in conditions)
+        if isinstance(node, ast.Name):
+            # A field on its own checks whether the file has a value
+            values = self._compile_value(node)
+            return lambda fields: bool(values(fields))
+        raise ValueError("invalid query: unsupported expression {}".format(
+            ast.unparse(node)))
+
+    def _compile_comparison(self, left, op, right):
+        """Compile a single comparison to a function of the fields."""
+        left_values = self._compile_value(left)
+        right_values = self._compile_value(right)
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if isinstance(right, ast.Name):
+                # Substring of a field
+                def compare(value, other):
+                    return str(value) in str(other)
+            else:
+                compare = operator.eq
+        elif isinstance(op, (ast.Eq, ast.NotEq)):
+            compare = operator.eq
+        elif type(op) in self.comparisons:
+            compare = self.comparisons[type(op)]
+        else:
+            raise ValueError("invalid query: unsupported operator")
+
+        def match(fields):
+            for value in left_values(fields):
+                for other in right_values(fields):
+                    try:
+                        if compare(value, other):
+                            return True
+                    except TypeError:  # e.g. text compared with a number
+                        pass
+            return False
+
+        if isinstance(op, (ast.NotIn, ast.NotEq)):
+            return lambda fields: not match(fields)
+        return match
+
+    @staticmethod
+    def _compile_value(node):
+        """Compile a field or constant to a function returning the values."""
+        if isinstance(node, ast.Name):
+            if node.id not in FIELDS:
+                raise ValueError(
+                    "invalid query: unknown field {}, expected one of "
+                    "{}".format(node.id, ", ".join(FIELDS)))
+            return lambda fields: fields.get(node.id, [])
+        elements = (node.elts if isinstance(node, (ast.List, ast.Tuple))
+                    else [node])
+        values = []
+        for element in elements:
+            if (not isinstance(element, ast.Constant) or
+                    isinstance(element.value, bool) or
+                    not isinstance(element.value, (str, int, float))):
+                raise ValueError("invalid query: unsupported value {}".format(
+                    ast.unparse(element)))
+            value = element.value
+            values.append(value.lower() if isinstance(value, str) else value)
+        return lambda fields: values
+
+
+class Catalog:
+    """Persistent metadata catalog of the source files.
+
+    The entries are stored in a HashDb as (size, mtime, entry) by input file.
+    """
+
+    def __init__(self, hashdb):
+        self._hashdb = hashdb
+        # Input files with changed entries since the last store()
+        self._modified = set()
+
+    def update(self, audio_src, in_filenames, jobs, removed=None):
+        """Bring the catalog up to date for the given files.
+
+        Files that are new or changed since the last run are parsed in
+        parallel, entries of files that don't exist anymore are removed.
+
+        :param removed: input files known to be removed, None if
+            in_filenames are all files of the loaded part of the catalog
+            (all other entries are removed then)
+        :returns: dict of entries by input file (None if not supported)
+        """
+        database = self._hashdb.database
+        stats = {}
+        changed = []
+        for in_filename in in_filenames:
+            stat = os.stat(os.path.join(audio_src, in_filename))
+            stats[in_filename] = (stat.st_size, stat.st_mtime_ns)
+            entry = database.get(in_filename)
+            if entry is None or entry[:2] != stats[in_filename]:
+                changed.append(in_filename)
+
+        def _read(in_filename):
+            try:
+                return read_tags(os.path.join(audio_src, in_filename))
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning("Failed to read tags of {}: {}",
+                               in_filename, err)
+                return None
+
+        with ThreadPool(processes=jobs) as pool:
+            entries = pool.map(_read, changed)
+        for in_filename, entry in zip(changed, entries):
+            database[in_filename] = stats[in_filename] + (entry,)
+
+        if removed is None:
+            missing = [in_filename for in_filename in database
+                       if in_filename not in stats]
+        else:
+            missing = [in_filename for in_filename in removed
+                       if in_filename in database and in_filename not in stats]
+        for in_filename in missing:
+            del database[in_filename]
+        logger.info("Catalog: {} files, {} parsed, {} removed",
+                    len(in_filenames), len(changed), len(missing))
+        self._modified.update(changed)
+        self._modified.update(missing)
+        return {in_filename: database[in_filename][2]
+                for in_filename in in_filenames}
+
+    def store(self):
+        """Store the chunks of the catalog modified by update()."""
+        if self._modified:
+            self._hashdb.store(keys=self._modified)
+            self._modified = set()
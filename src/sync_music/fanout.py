@@ -0,0 +1,155 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Writing processed files to several destinations.
+
+Files are processed once into a staging directory and then copied to every
+destination that needs them. Each destination is written by its own thread,
+so that slow destinations don't block faster ones. The number of staged
+files that are not yet written to all of their destinations is limited by
+the buffer size: if the buffer is full, no further files are processed
+until the slowest destination caught up.
+"""
+
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from . import util
+from .actions import copy_file
+from .stats import RunStats
+
+logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
+    logging.getLogger(__name__))
+
+
+class FanOut:
+    """Copies staged files to several destinations.
+
+    :param destinations: list of destination directories
+    :param buffer_size: maximum number of staged files
+    :param trace: record trace events of the writers (see RunStats)
+    :param sync: flush every written file to the device
+    :param copy_strategy: how the staged files are copied (see copy_file())
+    """
+
+    def __init__(self,  # pylint: disable=too-many-arguments
+                 destinations, buffer_size, trace=False, sync=False,
+                 copy_strategy='auto'):
+        self.destinations = destinations
+        self.sync = sync
+        self.copy_strategy = copy_strategy
+        self.staging = tempfile.mkdtemp(prefix='sync_music-')
+        # Results of the successfully written files per destination
+        self.written = [[] for _ in destinations]
+        self._slots = threading.BoundedSemaphore(buffer_size)
+        self._aborted = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queues = [queue.Queue() for _ in destinations]
+        self._stats = [RunStats(trace=trace) for _ in destinations]
+        self._threads = [threading.Thread(target=self._write, args=(index,),
+                                          daemon=True)
+                         for index in range(len(destinations))]
+        for thread in self._threads:
+            thread.start()
+
+    def throttle(self, files):
+        """Yield the files as long as there is room in the buffer."""
+        for current_file in files:
+            while not self._slots.acquire(timeout=0.1):
+                if self._aborted.is_set():
+                    return
+            yield current_file
+
+    def put(self, file_hash):
+        """Hand over a processed file to the destinations.
+
+        :param file_hash: tuple (in_filename, out_filename, hash, targets,
+            ...) with the indices of the destinations that need the staged
+            file followed by the size and digest of the output (stored in
+            written without the targets) or None if no file was staged
+        """
+        if file_hash is None or not file_hash[3]:
+            self._slots.release()
+            return
+        with self._lock:
+            self._pending[file_hash[0]] = len(file_hash[3])
+        for index in file_hash[3]:
+            self._queues[index].put(file_hash)
+
+    def _write(self, index):
+        """Write staged files to a destination (writer thread)."""
+        while True:
+            file_hash = self._queues[index].get()
+            if file_hash is None:
+                return
+            out_filename = file_hash[1]
+            staged_filepath = os.path.join(self.staging, out_filename)
+            if not self._aborted.is_set():
+                out_filepath = os.path.join(self.destinations[index],
+                                            out_filename)
+                try:
+                    nbytes = os.path.getsize(staged_filepath)
+                    with self._stats[index].stage('fanout', nbytes):
+                        util.ensure_directory_exists(
+                            os.path.dirname(out_filepath))
+                        method = copy_file(staged_filepath, out_filepath,
+                                           self.copy_strategy)
+                    self._stats[index].count('bytes_' + method, nbytes)
+                    if self.sync:
+                        with self._stats[index].stage('flush'):
+                            util.fsync_file(out_filepath)
+                except OSError as err:
+                    logger.error("Error: Failed to write {}: {}",
+                                 out_filepath, err)
+                    self._stats[index].count('files_failed')
+                else:
+                    self.written[index].append(file_hash[:3] + file_hash[4:])
+            self._done(file_hash[0], staged_filepath)
+
+    def _done(self, in_filename, staged_filepath):
+        """Remove a staged file after it was written to all destinations."""
+        with self._lock:
+            self._pending[in_filename] -= 1
+            if self._pending[in_filename]:
+                return
+            del self._pending[in_filename]
+        os.remove(staged_filepath)
+        self._slots.release()
+
+    def abort(self):
+        """Stop processing further files and writing to the destinations."""
+        self._aborted.set()
+
+    def close(self, run_stats=None):
+        """Wait until all destinations are written and remove the staging.
+
+        :param run_stats: RunStats to merge the statistics of the writers to
+        """
+        for file_queue in self._queues:
+            file_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if run_stats is not None:
+            for writer_stats in self._stats:
+                run_stats.merge(writer_stats)
+        shutil.rmtree(self.staging, ignore_errors=True)
@@ -0,0 +1,240 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Compact mapping of the synced files for large libraries.
+
+The hash database maps every input file to (out_filename, hash) or
+(out_filename, hash, output size, output digest). Stored as a dict of tuples
+of strings that takes several hundred MB for a million files. FileEntries
+provides the same mapping, but stores the entries by directory, so that every
+directory name is stored once:
+
+- file names map to a slot of the directory, the hashes and digests are
+  stored as 16 binary bytes per slot in a bytearray, the sizes in an array
+- the output path is only stored if it differs from the input path by more
+  than the extension (only the interned extension is stored then)
+
+Entries that can't be stored like that (e.g. hashes that aren't MD5 hex
+digests) are kept as they are.
+"""
+
+import array
+import collections.abc
+import os
+import sys
+
+DIGEST_SIZE = 16
+# Size of entries without output size and digest
+NO_SIZE = -1
+
+
+def _pack_digest(value):
+    """Get the binary form of an MD5 hex digest (None if not possible)."""
+    if (not isinstance(value, str) or len(value) != 2 * DIGEST_SIZE or
+            value != value.lower()):
+        return None
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return None
+
+
+def _split(key):
+    """Split a key into directory and file name."""
+    directory, _, name = key.rpartition('/')
+    return directory, name
+
+
+class Directory:
+    """Entries of the files in a directory, stored in slots."""
+
+    __slots__ = ['slots', 'hashes', 'digests', 'sizes', 'outs', 'free',
+                 'extra']
+
+    def __init__(self):
+        # Slot by file name
+        self.slots = {}
+        self.hashes = bytearray()
+        self.digests = bytearray()
+        self.sizes = array.array('q')
+        # None if the output path is the input path, the interned extension
+        # if only the extension differs, otherwise a tuple (out_filename,)
+        self.outs = []
+        # Slots of removed entries for reuse
+        self.free = []
+        # Entries that can't be packed by file name
+        self.extra = {}
+
+    def __len__(self):
+        return len(self.slots) + len(self.extra)
+
+    def names(self):
+        """Iterate over the file names."""
+        yield from self.slots
+        yield from self.extra
+
+    def get(self, key, name):
+        """Get the entry of a file (KeyError if missing)."""
+        slot = self.slots.get(name)
+        if slot is None:
+            return self.extra[name]
+        out = self.outs[slot]
+        if out is None:
+            out_filename = key
+        elif isinstance(out, str):
+            out_filename = os.path.splitext(key)[0] + out
+        else:
+            out_filename = out[0]
+        offset = slot * DIGEST_SIZE
+        file_hash = self.hashes[offset:offset + DIGEST_SIZE].hex()
+        size = self.sizes[slot]
+        if size == NO_SIZE:
+            return (out_filename, file_hash)
+        return (out_filename, file_hash, size,
+                self.digests[offset:offset + DIGEST_SIZE].hex())
+
+    def set(self, key, name, value):
+        """Set the entry of a file."""
+        self.remove(name)
+        packed = self._pack(key, value)
+        if packed is None:
+            self.extra[name] = tuple(value)
+            return
+        out, file_hash, size, digest = packed
+        if self.free:
+            slot = self.free.pop()
+            offset = slot * DIGEST_SIZE
+            self.hashes[offset:offset + DIGEST_SIZE] = file_hash
+            self.digests[offset:offset + DIGEST_SIZE] = digest
+            self.sizes[slot] = size
+            self.outs[slot] = out
+        else:
+            slot = len(self.outs)
+            self.hashes += file_hash
+            self.digests += digest
+            self.sizes.append(size)
+            self.outs.append(out)
+        self.slots[name] = slot
+
+    @staticmethod
+    def _pack(key, value):
+        """Get the packed form (out, hash, size, digest) or None."""
+        if not isinstance(value, tuple) or len(value) not in [2, 4]:
+            return None
+        out_filename = value[0]
+        file_hash = _pack_digest(value[1])
+        if not isinstance(out_filename, str) or file_hash is None:
+            return None
+        if len(value) == 2:
+            size, digest = NO_SIZE, bytes(DIGEST_SIZE)
+        else:
+            size, digest = value[2], _pack_digest(value[3])
+            if not isinstance(size, int) or size < 0 or digest is None:
+                return None
+        root = os.path.splitext(key)[0]
+        extension = os.path.splitext(out_filename)[1]
+        if out_filename == key:
+            out = None
+        elif root + extension == out_filename:
+            out = sys.intern(extension)
+        else:
+            out = (out_filename,)
+        return out, file_hash, size, digest
+
+    def remove(self, name):
+        """Remove the entry of a file.
+
+        :returns: whether the file had an entry
+        """
+        slot = self.slots.pop(name, None)
+        if slot is not None:
+            self.outs[slot] = None
+            self.free.append(slot)
+            return True
+        return self.extra.pop(name, None) is not None
+
+
+class FileEntries(collections.abc.MutableMapping):
+    """Compact dict of input file -> database entry (see module doc)."""
+
+    def __init__(self, entries=None):
+        # Directory by directory name ('' for the root)
+        self.directories = {}
+        self._length = 0
+        if entries is not None:
+            self.update(entries)
+
+    def __getitem__(self, key):
+        directory, name = _split(key)
+        try:
+            return self.directories[directory].get(key, name)
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        directory, name = _split(key)
+        entries = self.directories.get(directory)
+        return entries is not None and (name in entries.slots or
+                                        name in entries.extra)
+
+    def __setitem__(self, key, value):
+        directory, name = _split(key)
+        entries = self.directories.get(directory)
+        if entries is None:
+            entries = self.directories[sys.intern(directory)] = Directory()
+        self._length -= len(entries)
+        entries.set(key, name, value)
+        self._length += len(entries)
+
+    def __delitem__(self, key):
+        directory, name = _split(key)
+        entries = self.directories.get(directory)
+        if entries is None or not entries.remove(name):
+            raise KeyError(key)
+        self._length -= 1
+        if not entries:
+            del self.directories[directory]
+
+    def __iter__(self):
+        for directory, entries in self.directories.items():
+            prefix = directory + '/' if directory else ''
+            for name in entries.names():
+                yield prefix + name
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+    def add_directory(self, directory, entries):
+        """Add all entries of a directory (replacing existing ones)."""
+        previous = self.directories.pop(directory, None)
+        if previous is not None:
+            self._length -= len(previous)
+        if entries:
+            self.directories[sys.intern(directory)] = entries
+            self._length += len(entries)
+
+    def iter_directory(self, directory):
+        """Iterate over (key, entry) of the files in a directory."""
+        entries = self.directories[directory]
+        prefix = directory + '/' if directory else ''
+        for name in list(entries.names()):
+            key = prefix + name
+            yield key, entries.get(key, name)
@@ -15,48 +15,333 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-"""HashDb."""
+"""HashDb.
 
+The database is stored in chunks, one per top level directory of the keys,
+so that a part of it can be loaded and updated without touching the other
+entries (see load()). File format::
+
+    MAGIC, offset of the index (8 bytes), pickled chunks, pickled index
+
+The index maps the chunk keys to (offset, length) of the chunk. Updates of a
+part append the new chunks and a new index and then replace the index
+offset, the superseded chunks are dropped when the whole database is stored
+the next time, or when they make up more than COMPACT_RATIO of the file
+(see _compact_file()). Databases stored as a single pickled dict by older
+versions are still loaded.
+
+Compact databases (see FileEntries) are stored with MAGIC_COMPACT, their
+chunks map the directory names to the Directory entries.
+"""
+
+import itertools
 import logging
 import os
 import pickle
 import hashlib
+import struct
 
 from . import util
+from .fileentries import FileEntries
 
 logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
     logging.getLogger(__name__))
 
+MAGIC = b'sync_music db 2\n'
+MAGIC_COMPACT = b'sync_music db 3\n'
+OFFSET = struct.Struct('<Q')
+# Large sequential reads for get_digest()
+DIGEST_BUFFER_SIZE = 1024 * 1024
+# Superseded chunks and indexes (fraction of the file and bytes) at which an
+# update of a part rewrites the file without them
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 64 * 1024
+
+
+def get_chunk_key(key):
+    """Get the chunk of a key (its top level directory)."""
+    return key.split('/', 1)[0] if '/' in key else ''
+
+
+def get_scope_chunk_keys(scope):
+    """Get the chunks that can contain the keys of the paths in scope.
+
+    A path without a slash is either a top level directory or a file in the
+    root (chunk '').
+    """
+    keys = set()
+    for path in scope:
+        keys.add(path.split('/', 1)[0])
+        if '/' not in path:
+            keys.add('')
+    return keys
+
+
+def in_scope(key, scope):
+    """Check whether a key is one of the paths in scope or below them."""
+    return any(key == path or key.startswith(path + '/') for path in scope)
+
 
 class HashDb:
-    """Lightwight database for file hash values."""
+    """Lightwight database for file hash values.
+
+    :param compact: keep the entries of the synced files in a FileEntries
+        instead of a dict (values (out_filename, hash[, size, digest]))
+    """
 
-    def __init__(self, path):
-        self.database = {}
+    def __init__(self, path, compact=False):
+        self.compact = compact
+        self._database = self._new_database()
         self.path = path
+        # Paths the database was loaded for, None for all entries
+        self.scope = None
+        # Entries of the loaded chunks outside of the scope
+        self._others = self._new_database()
+        self._legacy = False
 
-    def load(self):
-        """Load hash database to disk."""
-        if os.path.exists(self.path):
-            logger.info("Loading hash database from {}", self.path)
-            with open(self.path, 'rb') as hash_file:
-                self.database = pickle.load(hash_file, encoding="utf-8")
-        else:
+    @property
+    def database(self):
+        """Dict of the entries (FileEntries if compact)."""
+        return self._database
+
+    @database.setter
+    def database(self, database):
+        if self.compact and not isinstance(database, FileEntries):
+            database = FileEntries(database)
+        self._database = database
+
+    def _new_database(self):
+        """Create an empty database."""
+        return FileEntries() if self.compact else {}
+
+    def load(self, scope=None):
+        """Load hash database from disk.
+
+        :param scope: list of relative paths, only the entries of these
+            paths and below are loaded (from the chunks containing them)
+        """
+        self.database = self._new_database()
+        self.scope = scope
+        self._others = self._new_database()
+        self._legacy = False
+        if not os.path.exists(self.path):
             logger.info("No hash database file {}", self.path)
+            return
+        logger.info("Loading hash database from {}", self.path)
+        with open(self.path, 'rb') as hash_file:
+            magic = hash_file.read(len(MAGIC))
+            # Databases in the other format are converted by a complete
+            # store, so all chunks are needed
+            compact_chunks = magic == MAGIC_COMPACT
+            self._legacy = compact_chunks != self.compact
+            if magic not in [MAGIC, MAGIC_COMPACT]:
+                hash_file.seek(0)
+                self._legacy = True
+                chunks = [pickle.load(hash_file, encoding="utf-8")]
+            else:
+                index = self._read_index(hash_file)
+                if scope is not None and not self._legacy:
+                    index = {key: index[key] for key
+                             in get_scope_chunk_keys(scope) if key in index}
+                chunks = []
+                for offset, length in index.values():
+                    hash_file.seek(offset)
+                    chunks.append(pickle.loads(hash_file.read(length)))
+        for chunk in chunks:
+            if not compact_chunks:
+                self._add_entries(chunk.items(), scope)
+                continue
+            for directory, entries in chunk.items():
+                self._add_directory(directory, entries, scope)
+
+    def _add_entries(self, items, scope):
+        """Add loaded entries to the database or the others."""
+        if scope is None and not self.compact:
+            self.database.update(items)
+            return
+        for key, value in items:
+            if scope is None or in_scope(key, scope):
+                self.database[key] = value
+            else:
+                self._others[key] = value
+
+    def _add_directory(self, directory, entries, scope):
+        """Add the loaded entries of a directory of a compact chunk."""
+        prefix = directory + '/' if directory else ''
+        if self.compact and (scope is None or in_scope(directory, scope)):
+            self.database.add_directory(directory, entries)
+        elif self.compact and not any(path.startswith(prefix)
+                                      for path in scope):
+            self._others.add_directory(directory, entries)
+        else:
+            # The scope contains a part of the directory
+            loaded = FileEntries()
+            loaded.add_directory(directory, entries)
+            self._add_entries(loaded.iter_directory(directory), scope)
+
+    @staticmethod
+    def _read_index(hash_file):
+        """Read the index of the chunks."""
+        hash_file.seek(len(MAGIC))
+        offset, = OFFSET.unpack(hash_file.read(OFFSET.size))
+        hash_file.seek(offset)
+        return pickle.load(hash_file)
+
+    def _get_chunks(self, keys=None):
+        """Get the entries to store by chunk key.
+
+        :param keys: only get the chunks containing these keys
+        """
+        selected = (None if keys is None
+                    else {get_chunk_key(key) for key in keys})
+        chunks = {}
+        if self.scope is not None or selected is not None:
+            # Chunks of the scope are stored even if all entries are gone
+            for key in (get_scope_chunk_keys(self.scope)
+                        if selected is None else selected):
+                chunks[key] = {}
+        if not self.compact:
+            for key, value in itertools.chain(self._others.items(),
+                                              self.database.items()):
+                chunk_key = get_chunk_key(key)
+                if selected is None or chunk_key in selected:
+                    chunks.setdefault(chunk_key, {})[key] = value
+            return chunks
+        for database in [self._others, self.database]:
+            for directory, entries in database.directories.items():
+                chunk_key = get_chunk_key(directory + '/')
+                if selected is not None and chunk_key not in selected:
+                    continue
+                chunk = chunks.setdefault(chunk_key, {})
+                if directory in chunk:  # Split by the scope
+                    merged = FileEntries(
+                        self._others.iter_directory(directory))
+                    merged.update(self.database.iter_directory(directory))
+                    entries = merged.directories[directory]
+                chunk[directory] = entries
+        return chunks
+
+    def store(self, sync=False, keys=None):
+        """Store hash database to disk.
+
+        If only a part was loaded, only its chunks are written. The database
+        is never left partially written: a whole database is written to a
+        temporary file that replaces the old one, updated chunks become
+        valid when the index offset is replaced.
 
-    def store(self):
-        """Store hash database to disk."""
+        :param sync: flush the database to the device before returning
+        :param keys: keys of the changed entries, only their chunks are
+            written (if the database file exists)
+        """
         logger.info("Storing hash database to {}", self.path)
         try:
-            with open(self.path, 'wb') as hash_file:
-                pickle.dump(self.database, hash_file)
+            if ((self.scope is not None or keys is not None) and
+                    not self._legacy and os.path.exists(self.path)):
+                self._store_chunks(sync, keys)
+            else:
+                self._store_all(sync)
         except IOError:
             logger.error("Error: Failed to write hash database to {}",
                          self.path)
 
+    def _store_all(self, sync):
+        """Write the whole database."""
+        temppath = self.path + '.tmp'
+        with open(temppath, 'wb') as hash_file:
+            hash_file.write((MAGIC_COMPACT if self.compact else MAGIC) +
+                            OFFSET.pack(0))
+            self._write_chunks(hash_file, self._get_chunks(), {}, sync)
+        os.replace(temppath, self.path)
+        if sync:
+            util.fsync_path(os.path.dirname(self.path) or '.')
+
+    def _store_chunks(self, sync, keys=None):
+        """Append the loaded (or the given) chunks and replace the index."""
+        with open(self.path, 'r+b') as hash_file:
+            index = self._read_index(hash_file)
+            hash_file.seek(0, os.SEEK_END)
+            self._write_chunks(hash_file, self._get_chunks(keys), index,
+                               sync)
+            size = hash_file.seek(0, os.SEEK_END)
+            hash_file.seek(len(MAGIC))
+            offset, = OFFSET.unpack(hash_file.read(OFFSET.size))
+        # Everything before the index that isn't a chunk of the index
+        superseded = (offset - len(MAGIC) - OFFSET.size -
+                      sum(length for _, length in index.values()))
+        if (superseded > COMPACT_MIN_BYTES and
+                superseded > COMPACT_RATIO * size):
+            self._compact_file(sync)
+
+    def _compact_file(self, sync):
+        """Rewrite the database file without the superseded chunks.
+
+        The chunks are copied without unpickling them.
+        """
+        logger.info("Compacting hash database {}", self.path)
+        temppath = self.path + '.tmp'
+        with open(self.path, 'rb') as hash_file, \
+                open(temppath, 'wb') as compact_file:
+            compact_file.write(hash_file.read(len(MAGIC)) + OFFSET.pack(0))
+            index = {}
+            for key, (offset, length) in self._read_index(hash_file).items():
+                hash_file.seek(offset)
+                index[key] = (compact_file.tell(), length)
+                compact_file.write(hash_file.read(length))
+            self._write_chunks(compact_file, {}, index, sync)
+        os.replace(temppath, self.path)
+        if sync:
+            util.fsync_path(os.path.dirname(self.path) or '.')
+
+    @staticmethod
+    def _write_chunks(hash_file, chunks, index, sync):
+        """Write chunks at the current position, then the index."""
+        for key, chunk in chunks.items():
+            if not chunk:
+                index.pop(key, None)
+                continue
+            data = pickle.dumps(chunk)
+            index[key] = (hash_file.tell(), len(data))
+            hash_file.write(data)
+        offset = hash_file.tell()
+        pickle.dump(index, hash_file)
+        hash_file.flush()
+        if sync:  # The new index has to be durable before it is referenced
+            os.fsync(hash_file.fileno())
+        hash_file.seek(len(MAGIC))
+        hash_file.write(OFFSET.pack(offset))
+        hash_file.flush()
+        if sync:
+            os.fsync(hash_file.fileno())
+
     @classmethod
     def get_hash(cls, path):
         """Calculate hash value for the given path."""
         with open(path, 'rb') as hash_file:
             hash_buffer = hash_file.read(4096)
         return hashlib.md5(hash_buffer).hexdigest()
+
+    @classmethod
+    def get_digest(cls, path, uncached=False):
+        """Calculate the digest of the whole content of the given path.
+
+        :param uncached: drop the cached pages of the file first, so that
+            the content is read from the device
+        :returns: tuple (size, digest)
+        """
+        digest = hashlib.md5()
+        buffer = bytearray(DIGEST_BUFFER_SIZE)
+        view = memoryview(buffer)
+        size = 0
+        with open(path, 'rb', buffering=0) as digest_file:
+            if hasattr(os, 'posix_fadvise'):
+                fileno = digest_file.fileno()
+                if uncached:
+                    os.posix_fadvise(fileno, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.posix_fadvise(fileno, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                length = digest_file.readinto(buffer)
+                if not length:
+                    break
+                digest.update(view[:length])
+                size += length
+        return size, digest.hexdigest()
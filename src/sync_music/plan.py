@@ -0,0 +1,193 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Dry-run plans.
+
+A plan lists the work a sync would do (see SyncMusic.plan_audio()) together
+with estimates of the output size and the duration. Durations are estimated
+from the throughput of previous runs, which is stored per action in a hidden
+history file in the destination.
+
+Throughput is derived from the run statistics: copies are measured by the
+'write' stage, transcodes by the 'decode' and 'encode' stages (in input bytes
+per second) and tag updates by the 'tags' stage (in files per second). The
+recorded times are summed over all workers, so the estimated duration is
+divided by the number of jobs.
+"""
+
+import json
+import logging
+import os
+
+from . import util
+
+logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
+    logging.getLogger(__name__))
+
+HISTORY_FILENAME = '.sync_music_history.json'
+
+ACTIONS = ['transcode', 'copy', 'tags']
+
+# Stages measuring an action and whether its throughput is counted in bytes
+# of the first stage (or in executions of the first stage)
+THROUGHPUT_STAGES = {
+    'copy': (['write'], True),
+    'transcode': (['decode', 'encode'], True),
+    'tags': (['tags'], False),
+}
+
+# Weight of the previous history when adding the throughput of a new run
+HISTORY_DECAY = 0.5
+
+
+def load_history(path):
+    """Load the throughput history, empty if there is none."""
+    try:
+        with open(path) as history_file:
+            return json.load(history_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_history(path, run_stats):
+    """Add the throughput measured in a run to the history."""
+    history = load_history(path)
+    for action, (stages, in_bytes) in THROUGHPUT_STAGES.items():
+        seconds = sum(sum(run_stats.durations.get(stage, []))
+                      for stage in stages)
+        if in_bytes:
+            units = run_stats.nbytes.get(stages[0], 0)
+        else:
+            units = len(run_stats.durations.get(stages[0], []))
+        if not units or not seconds:
+            continue
+        previous = history.get(action, {'units': 0, 'seconds': 0})
+        history[action] = {
+            'units': previous['units'] * HISTORY_DECAY + units,
+            'seconds': previous['seconds'] * HISTORY_DECAY + seconds}
+    try:
+        util.write_atomic(path, json.dumps(history, indent=2, sort_keys=True))
+    except OSError as err:
+        logger.warning("Failed to write throughput history {}", err)
+
+
+def get_throughput(history, action):
+    """Get the throughput of an action, None if it is unknown."""
+    if action not in history or not history[action]['seconds']:
+        return None
+    return history[action]['units'] / history[action]['seconds']
+
+
+def estimate_seconds(entry, history):
+    """Estimate the processing time of a plan entry.
+
+    :returns: seconds (of a single worker) or None if unknown
+    """
+    seconds = 0.0
+    if entry['action'] in ['copy', 'transcode']:
+        throughput = get_throughput(history, entry['action'])
+        if throughput is None:
+            return None
+        seconds += entry['bytes'] / throughput
+    if entry['tags']:
+        throughput = get_throughput(history, 'tags')
+        if throughput is None:
+            return None
+        seconds += 1 / throughput
+    return seconds
+
+
+def create_plan(settings, entries, deletes, history, jobs):
+    """Create a plan with a summary per action.
+
+    :param settings: dict of the settings the plan is valid for
+    :param entries: list of dicts describing the files to process
+    :param deletes: list of dicts describing the files to remove
+    :param history: throughput history (see load_history())
+    :param jobs: number of parallel jobs
+    """
+    summary = {name: {'files': 0, 'bytes': 0, 'out_bytes': 0, 'seconds': 0.0}
+               for name in ACTIONS}
+    total_seconds = 0.0
+    for entry in entries:
+        seconds = estimate_seconds(entry, history)
+        name = entry['action']
+        summary[name]['files'] += 1
+        summary[name]['bytes'] += entry['bytes']
+        summary[name]['out_bytes'] += entry['out_bytes']
+        if summary[name]['seconds'] is not None:
+            summary[name]['seconds'] = (None if seconds is None else
+                                        summary[name]['seconds'] + seconds)
+        total_seconds = (None if seconds is None or total_seconds is None
+                         else total_seconds + seconds)
+    summary['delete'] = {'files': len(deletes),
+                         'bytes': sum(d['bytes'] for d in deletes)}
+    # Outputs of files written under another name (e.g. after changing the
+    # codec), the files are written anew and the old outputs are removed
+    replaced = [entry['replaces'] for entry in entries
+                if entry['replaces'] is not None]
+    summary['replace'] = {'files': len(replaced),
+                          'bytes': sum(r['bytes'] for r in replaced)}
+    summary['out_bytes'] = sum(entry['out_bytes'] for entry in entries)
+    summary['seconds'] = (None if total_seconds is None
+                          else total_seconds / max(jobs, 1))
+    return {'settings': settings, 'files': entries, 'delete': deletes,
+            'summary': summary}
+
+
+def log_plan(plan):
+    """Log the summary of a plan."""
+    summary = plan['summary']
+    logger.info("Plan:")
+    for name in ACTIONS:
+        logger.info(" - {}: {} files, {:.1f} MB -> {:.1f} MB", name,
+                    summary[name]['files'], summary[name]['bytes'] / 1e6,
+                    summary[name]['out_bytes'] / 1e6)
+    logger.info(" - delete: {} files, {:.1f} MB", summary['delete']['files'],
+                summary['delete']['bytes'] / 1e6)
+    logger.info(" - delete replaced outputs: {} files, {:.1f} MB",
+                summary['replace']['files'], summary['replace']['bytes'] / 1e6)
+    logger.info(" - estimated output size: {:.1f} MB",
+                summary['out_bytes'] / 1e6)
+    if summary['seconds'] is None:
+        logger.info(" - estimated duration: unknown (no previous runs)")
+    else:
+        logger.info(" - estimated duration: {:.0f}s", summary['seconds'])
+
+
+def write_plan(path, plan):
+    """Write a plan as JSON file."""
+    util.write_atomic(path, json.dumps(plan, indent=2) + '\n')
+
+
+def read_plan(path, settings):
+    """Read a plan written by write_plan().
+
+    :raises ValueError: if the plan was created with different settings
+    """
+    with open(path) as plan_file:
+        plan = json.load(plan_file)
+    if plan.get('settings') != settings:
+        raise ValueError("Plan {} was created with different settings"
+                         .format(path))
+    return plan
+
+
+def get_history_path(audio_dest):
+    """Get the path of the throughput history in the destination."""
+    return os.path.join(audio_dest, HISTORY_FILENAME)
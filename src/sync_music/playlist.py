@@ -0,0 +1,130 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Playlist helpers."""
+
+import codecs
+import os
+
+
+def read_playlist(path):
+    """Iterate over the lines of an M3U playlist (without line endings).
+
+    Lines are read one by one, so large playlists don't need to fit into
+    memory.
+    """
+    with codecs.open(path, 'r', encoding='windows-1252') as in_file:
+        for line in in_file:
+            yield line.rstrip('\r\n')
+
+
+class PathSuffixIndex:
+    """Index that resolves paths by their longest suffix that is known.
+
+    The known paths are stored in a trie keyed on their reversed path
+    components, so a path is resolved with a single walk over its components
+    instead of probing every suffix separately.
+    """
+
+    def __init__(self, paths):
+        self._root = {}
+        self._depth = 0
+        for path in paths:
+            node = self._root
+            components = path.split('/')
+            self._depth = max(self._depth, len(components))
+            for component in reversed(components):
+                node = node.setdefault(component, {})
+            # None can't be a path component, it marks a known path
+            node[None] = path
+
+    def resolve(self, path):
+        """Find the known paths that are suffixes of the given path.
+
+        :returns: list of matches, ordered from the longest to the shortest
+        """
+        matches = []
+        node = self._root
+        # Leading components beyond the deepest known path can't match
+        for component in reversed(path.rsplit('/', self._depth)):
+            node = node.get(component)
+            if node is None:
+                break
+            match = node.get(None)
+            if match is not None:
+                matches.append(match)
+        matches.reverse()
+        return matches
+
+
+def resolve_in_directory(path, root, cache=None):
+    """Find the longest suffix of path that is an existing file below root.
+
+    This is the file system equivalent of PathSuffixIndex.resolve() for
+    files that haven't been scanned yet.
+
+    :param cache: dict remembering the suffix that resolved the directory
+        of earlier paths, the other files of a directory then only need a
+        single check
+    :returns: path relative to root or None
+    """
+    components = path.split('/')
+    directory = path.rpartition('/')[0]
+    if cache is not None and cache.get(directory) is not None:
+        relpath = os.path.join(*components[cache[directory]:])
+        if os.path.isfile(os.path.join(root, relpath)):
+            return relpath
+    # Suffixes containing empty, '.' or '..' components would leave root
+    start = 0
+    for position, component in enumerate(components):
+        if component in ('', '.', '..'):
+            start = position + 1
+    for position in range(start, len(components)):
+        relpath = os.path.join(*components[position:])
+        if os.path.isfile(os.path.join(root, relpath)):
+            if cache is not None:
+                cache[directory] = position
+            return relpath
+    return None
+
+
+def select_playlist_files(playlist_src, audio_src):
+    """Select the files in audio_src that are referenced by playlists.
+
+    Besides the referenced audio files, the folder.jpg files in their
+    directories are selected as well.
+
+    :returns: set of paths relative to audio_src
+    """
+    selection = set()
+    directories = {}
+    for dirpath, _, filenames in os.walk(playlist_src):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] != '.m3u':
+                continue
+            for line in read_playlist(os.path.join(dirpath, filename)):
+                if line.startswith('#EXT'):
+                    continue
+                relpath = resolve_in_directory(line, audio_src, directories)
+                if relpath is not None:
+                    selection.add(relpath)
+
+    for directory in {os.path.dirname(f) for f in selection}:
+        image = os.path.join(directory, 'folder.jpg')
+        if os.path.isfile(os.path.join(audio_src, image)):
+            selection.add(image)
+    return selection
@@ -0,0 +1,174 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Profiling of the main and the worker processes.
+
+cProfile and pstats are only imported when profiling is requested, as they
+slow down the startup of every run.
+"""
+
+# pylint: disable=import-outside-toplevel
+
+import contextlib
+import glob
+import multiprocessing.util
+import os
+import threading
+import time
+import tracemalloc
+
+TOP_ALLOCATIONS = 10
+# Seconds between writing the statistics of a process while it is running
+DUMP_INTERVAL = 60
+
+_profilers = {}
+_memory_peaks = {}
+_memory_stacks = threading.local()  # pylint: disable=invalid-name
+
+
+class Profiler:
+    """Accumulates the cProfile statistics of the current process.
+
+    The statistics are written to process-<pid>.prof in the profile
+    directory when the process exits (see dump_profile() for the main
+    process) and at most every DUMP_INTERVAL seconds after a profiled block,
+    so that little is lost when the pool terminates a worker process.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory,
+                                 'process-{}.prof'.format(os.getpid()))
+        import cProfile
+        self._profile = cProfile.Profile()
+        self._dumped = time.monotonic()
+        # Run when a worker process exits after the pool has been closed
+        multiprocessing.util.Finalize(None, self.dump, exitpriority=10)
+
+    @classmethod
+    def get(cls, directory):
+        """Get the profiler of the current process."""
+        pid = os.getpid()
+        if pid not in _profilers:
+            _profilers[pid] = cls(directory)
+        return _profilers[pid]
+
+    @contextlib.contextmanager
+    def profile(self):
+        """Profile the enclosed block."""
+        self._profile.enable()
+        try:
+            yield
+        finally:
+            self._profile.disable()
+            if time.monotonic() - self._dumped >= DUMP_INTERVAL:
+                self.dump()
+
+    def dump(self):
+        """Write the statistics collected so far."""
+        self._profile.dump_stats(self.path)
+        self._dumped = time.monotonic()
+
+
+def dump_profile():
+    """Write the statistics of the current process if it is profiled."""
+    profiler = _profilers.get(os.getpid())
+    if profiler is not None:
+        profiler.dump()
+
+
+def remove_profiles(directory):
+    """Remove the statistics of previous runs."""
+    for path in glob.glob(os.path.join(directory, 'process-*.prof')):
+        os.remove(path)
+
+
+def merge_profiles(directory):
+    """Merge the statistics of all processes into sync_music.pstats.
+
+    :returns: path of the merged statistics or None if there are none
+    """
+    paths = sorted(glob.glob(os.path.join(directory, 'process-*.prof')))
+    if not paths:
+        return None
+    path = os.path.join(directory, 'sync_music.pstats')
+    import pstats
+    pstats.Stats(*paths).dump_stats(path)
+    return path
+
+
+@contextlib.contextmanager
+def memory_stage(name, results):
+    """Trace the memory allocated during a stage with tracemalloc.
+
+    The peak of traced memory during the stage (relative to the start of the
+    stage) is recorded. Whenever a stage reaches a new peak in this process,
+    the top allocations that are still alive at the end of the stage are
+    recorded as well. Nested stages contribute to the peak of their parents.
+    Tracing is only active during (outermost) stages.
+
+    :param results: dict stage name -> {'peak': bytes, 'top': [lines]}
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    stack = _memory_stacks.__dict__.setdefault('stack', [])
+    if stack:
+        stack[-1]['peak'] = max(stack[-1]['peak'],
+                                tracemalloc.get_traced_memory()[1])
+    frame = {'peak': 0, 'start': tracemalloc.get_traced_memory()[0]}
+    stack.append(frame)
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        stack.pop()
+        frame['peak'] = max(frame['peak'],
+                            tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+        tracemalloc.reset_peak()
+
+        peak = frame['peak'] - frame['start']
+        key = (os.getpid(), name)
+        if peak > _memory_peaks.get(key, -1):
+            _memory_peaks[key] = peak
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__),
+                 tracemalloc.Filter(False, __file__)])
+            results[name] = {
+                'peak': peak,
+                'top': [str(stat) for stat in
+                        snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]}
+        if started:
+            tracemalloc.stop()
+
+
+def merge_memory(results, other):
+    """Merge memory stage results, keeping the highest peak per stage."""
+    for name, result in other.items():
+        if name not in results or result['peak'] > results[name]['peak']:
+            results[name] = result
+
+
+def write_memory_report(path, results):
+    """Write the memory peaks and top allocations per stage."""
+    with open(path, 'w') as report_file:
+        for name, result in sorted(results.items()):
+            report_file.write("{}: peak {:.1f} MB\n".format(
+                name, result['peak'] / 1e6))
+            for line in result['top']:
+                report_file.write("    {}\n".format(line))
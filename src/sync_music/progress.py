@@ -0,0 +1,122 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Progress reporting.
+
+The progress of processing files is either shown as a live status line below
+the log messages (see StatusHandler) or logged in intervals.
+"""
+
+import logging
+import time
+
+from . import util
+
+logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
+    logging.getLogger(__name__))
+
+CLEAR_LINE = '\r\x1b[K'
+
+
+class StatusHandler(logging.StreamHandler):
+    """Stream handler that keeps a status line below the log messages."""
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self._status = ''
+
+    def emit(self, record):
+        if self._status:
+            self.stream.write(CLEAR_LINE)
+        super().emit(record)
+        if self._status:
+            self.stream.write(self._status)
+            self.flush()
+
+    def set_status(self, status):
+        """Replace the status line, an empty status removes it."""
+        self.acquire()
+        try:
+            self._status = status
+            self.stream.write(CLEAR_LINE + status)
+            self.flush()
+        finally:
+            self.release()
+
+
+class Progress:
+    """Tracks the throughput of processing files and estimates the ETA.
+
+    :param total: number of files to process
+    :param status_handler: StatusHandler to show a live status line, if None
+        the progress is logged every interval seconds
+    """
+
+    def __init__(self, total, status_handler=None, interval=None):
+        self.total = total
+        self.done = 0
+        self.nbytes = 0
+        self._handler = status_handler
+        if interval is None:
+            interval = 10.0 if status_handler is None else 0.2
+        self._interval = interval
+        self._start = time.monotonic()
+        self._last = self._start
+
+    def update(self, files=1, nbytes=0):
+        """Add processed files and bytes, report if the interval passed."""
+        self.done += files
+        self.nbytes += nbytes
+        now = time.monotonic()
+        if now - self._last >= self._interval:
+            self._last = now
+            self._report()
+
+    def format(self):
+        """Format the progress with throughput and ETA."""
+        elapsed = time.monotonic() - self._start
+        files_per_second = self.done / elapsed if elapsed else 0.0
+        eta = (format_duration((self.total - self.done) / files_per_second)
+               if files_per_second else 'unknown')
+        return "{}/{} files, {:.1f} files/s, {:.1f} MB/s, ETA {}".format(
+            self.done, self.total, files_per_second,
+            self.nbytes / 1e6 / elapsed if elapsed else 0.0, eta)
+
+    def _report(self):
+        """Show or log the progress."""
+        if self._handler is not None:
+            self._handler.set_status(self.format())
+        else:
+            logger.info("Progress: {}", self.format())
+
+    def finish(self):
+        """Remove the status line and log the final progress."""
+        if self._handler is not None:
+            self._handler.set_status('')
+        logger.info("Processed {}", self.format())
+
+
+def format_duration(seconds):
+    """Format a duration as e.g. 1h02m03s, 2m03s or 3s."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02}m{:02}s'.format(hours, minutes, seconds)
+    if minutes:
+        return '{}m{:02}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
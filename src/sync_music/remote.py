@@ -0,0 +1,532 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Distributed transcoding.
+
+Remote workers are started with `sync_music worker --listen HOST:PORT` and
+transcode files for the coordinator (a regular sync_music run with
+--remote-worker HOST:PORT). Tags are still copied by the coordinator, the
+workers only decode and encode.
+
+Workers listen on the loopback interface by default. Listening on other
+interfaces requires a shared secret, which the coordinator sends with every
+request (in plain text, workers are meant for trusted networks). Paths are
+only read below the source root of the worker (--source-root).
+
+Protocol: every message consists of a 4 byte big endian header length, a
+JSON header and a binary payload of header['size'] bytes (at most
+MAX_HEADER_LENGTH and MAX_PAYLOAD_SIZE). The coordinator opens a connection
+per request:
+
+- Every request contains the shared secret as 'secret' (null without).
+  Requests with another secret are answered with {'status': 'error',
+  'message': ...} without reading their payload.
+- {'type': 'hello'} is answered with {'status': 'ok', 'jobs': N}.
+- {'type': 'transcode', 'settings': {...}, 'extension': '.flac',
+  'gain': [gain, peak] or null} with the source file as payload, or with
+  'path' instead of the payload if the worker can read the source at the
+  same path (shared storage), is answered with {'status': 'ok'} and the
+  MP3 file as payload, with {'status': 'missing'} if the path doesn't
+  exist below the source root of the worker or with {'status': 'error',
+  'message': ...} if transcoding failed.
+
+The coordinator treats the local machine as one more worker. Every file is
+transcoded on the fastest worker (in observed input bytes per second) with
+a free slot, unless waiting for a busy worker that is more than twice as
+fast is expected to be quicker. Workers that can't be reached are not used
+for the rest of the run and their files are transcoded locally.
+"""
+
+import argparse
+import hmac
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from . import stats
+from . import util
+
+logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
+    logging.getLogger(__name__))
+
+HEADER_LENGTH = struct.Struct('>I')
+
+# Timeout for connecting, the hello exchange and the request headers in
+# seconds, unreachable workers must not delay the start of a sync
+CONNECT_TIMEOUT = 5
+
+# Timeout for every read of a transcode request or response in seconds
+TIMEOUT = 600
+
+# Limits of the messages, the payload is held in memory
+MAX_HEADER_LENGTH = 64 * 1024
+MAX_PAYLOAD_SIZE = 1 << 30
+
+# Weight of a new throughput sample
+THROUGHPUT_WEIGHT = 0.3
+
+
+class RemoteError(IOError):
+    """A remote worker failed to transcode a file."""
+
+
+def send_message(connection, header, payload=b''):
+    """Send a message (header dict and payload bytes)."""
+    header = dict(header, size=len(payload))
+    data = json.dumps(header).encode()
+    connection.sendall(HEADER_LENGTH.pack(len(data)) + data)
+    if payload:
+        connection.sendall(payload)
+
+
+def _receive_exactly(connection, size):
+    """Receive the given number of bytes."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def receive_header(connection):
+    """Receive the header of a message (see receive_payload()).
+
+    :raises ValueError: if the header is invalid or too long
+    """
+    length, = HEADER_LENGTH.unpack(
+        _receive_exactly(connection, HEADER_LENGTH.size))
+    if length > MAX_HEADER_LENGTH:
+        raise ValueError("Header of {} bytes is too long".format(length))
+    header = json.loads(_receive_exactly(connection, length).decode())
+    if not isinstance(header, dict):
+        raise ValueError("Invalid header")
+    return header
+
+
+def receive_payload(connection, header):
+    """Receive the payload of a message after its header.
+
+    :raises ValueError: if the payload size is invalid or too large
+    """
+    size = header.get('size')
+    if not isinstance(size, int) or not 0 <= size <= MAX_PAYLOAD_SIZE:
+        raise ValueError("Invalid payload size {}".format(size))
+    return _receive_exactly(connection, size)
+
+
+def receive_message(connection):
+    """Receive a message.
+
+    :returns: tuple (header dict, payload bytes)
+    """
+    header = receive_header(connection)
+    return header, receive_payload(connection, header)
+
+
+def parse_address(address):
+    """Parse HOST:PORT."""
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def is_loopback(host):
+    """Check whether a host name or address is on the loopback interface."""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return False
+
+
+def read_secret(path):
+    """Read a shared secret from the first line of a file."""
+    with open(path) as secret_file:
+        secret = secret_file.readline().strip()
+    if not secret:
+        raise ValueError("Empty secret in {}".format(path))
+    return secret
+
+
+def request(address, header, payload=b'', timeout=TIMEOUT):
+    """Send a request to a worker and receive the response.
+
+    :param timeout: timeout of every read after connecting (connecting
+        times out after CONNECT_TIMEOUT)
+    """
+    with socket.create_connection(parse_address(address),
+                                  timeout=CONNECT_TIMEOUT) as connection:
+        connection.settimeout(timeout)
+        send_message(connection, header, payload)
+        return receive_message(connection)
+
+
+# RemoteWorkers instances of this process by key (see __getstate__)
+_instances = {}  # pylint: disable=invalid-name
+
+
+class RemoteWorkers:
+    """Dispatches transcode jobs to the local machine and remote workers.
+
+    The state is shared between the worker processes of the pool, the
+    instance has to be created before the pool is started. It is passed
+    to the workers when they are started, afterwards only its key is sent
+    with the tasks (the synchronization primitives can't be pickled then).
+
+    :param addresses: list of HOST:PORT of the remote workers
+    :param local_jobs: number of local transcodes at the same time
+    :param shared_paths: the workers can read the source files at the same
+        paths, send paths instead of the file contents
+    :param secret: shared secret of the workers or None
+    """
+
+    LOCAL = 0
+
+    def __init__(self, addresses, local_jobs, shared_paths=False,
+                 secret=None):
+        self.addresses = [None]
+        self.slots = [local_jobs]
+        self.secret = secret
+        for address in addresses:
+            try:
+                response, _ = request(address, {'type': 'hello',
+                                                'secret': secret},
+                                      timeout=CONNECT_TIMEOUT)
+                if response['status'] != 'ok':
+                    raise ValueError(response.get('message'))
+            except (OSError, ValueError) as err:
+                logger.warning("Remote worker {} not available: {}",
+                               address, err)
+                continue
+            logger.info(" - remote worker {} with {} jobs",
+                        address, response['jobs'])
+            self.addresses.append(address)
+            self.slots.append(response['jobs'])
+        self.shared_paths = shared_paths
+        count = len(self.addresses)
+        self._condition = multiprocessing.Condition()
+        self._busy = multiprocessing.Array('i', count, lock=False)
+        self._failed = multiprocessing.Array('b', count, lock=False)
+        # Input bytes per second of a single job, 0 if unknown
+        self._throughput = multiprocessing.Array('d', count, lock=False)
+        self._key = (os.getpid(), id(self))
+        _instances[self._key] = self
+
+    def __getstate__(self):
+        if multiprocessing.context.get_spawning_popen() is None:
+            return {'_key': self._key}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if len(state) == 1:
+            state = _instances[state['_key']].__dict__
+        self.__dict__.update(state)
+        _instances[self._key] = self
+
+    @property
+    def remote_slots(self):
+        """Number of transcodes that can run on remote workers."""
+        return sum(self.slots[1:])
+
+    def get_throughput(self):
+        """Get the observed throughput per worker (None if unknown)."""
+        with self._condition:
+            return {address or 'local': throughput or None
+                    for address, throughput
+                    in zip(self.addresses, self._throughput)}
+
+    def _select(self, local_only):
+        """Select a worker with a free slot, None if waiting is better."""
+        workers = ([self.LOCAL] if local_only else
+                   [index for index in range(len(self.addresses))
+                    if not self._failed[index]])
+        free = [index for index in workers
+                if self._busy[index] < self.slots[index]]
+        if not free:
+            return None
+        # Workers without throughput are tried first to measure them
+        best_free = max(free, key=lambda index: (
+            self._throughput[index] == 0, self._throughput[index]))
+        fastest = max(self._throughput[index] for index in workers)
+        if (self._throughput[best_free] == 0 or
+                2 * self._throughput[best_free] >= fastest):
+            return best_free
+        return None
+
+    def _acquire(self, local_only=False):
+        """Wait for a free slot and occupy it."""
+        with self._condition:
+            while True:
+                index = self._select(local_only)
+                if index is not None:
+                    self._busy[index] += 1
+                    return index
+                self._condition.wait()
+
+    def _release(self, index, nbytes=0, duration=0.0, failed=False):
+        """Free a slot and record the throughput or the failure."""
+        with self._condition:
+            self._busy[index] -= 1
+            if failed:
+                self._failed[index] = 1
+            elif nbytes and duration:
+                throughput = nbytes / duration
+                if self._throughput[index]:
+                    throughput = (THROUGHPUT_WEIGHT * throughput +
+                                  (1 - THROUGHPUT_WEIGHT) *
+                                  self._throughput[index])
+                self._throughput[index] = throughput
+            self._condition.notify_all()
+
+    def transcode(self, action, in_filepath, out_filepath, gain=None):
+        """Transcode a file on the local machine or a remote worker.
+
+        :param action: Transcode action
+        :param gain: see Transcode.transcode()
+        """
+        nbytes = os.path.getsize(in_filepath)
+        index = self._acquire()
+        if index != self.LOCAL:
+            start = time.perf_counter()
+            try:
+                with stats.stage('remote', nbytes):
+                    self._transcode_remote(self.addresses[index], action,
+                                           in_filepath, out_filepath, gain)
+            except RemoteError:
+                self._release(index)
+                raise
+            except (OSError, ValueError) as err:
+                logger.warning("Remote worker {} failed, transcoding {} "
+                               "locally: {}", self.addresses[index],
+                               in_filepath, err)
+                self._release(index, failed=True)
+                index = self._acquire(local_only=True)
+            else:
+                self._release(index, nbytes, time.perf_counter() - start)
+                stats.count('files_remote')
+                return
+        start = time.perf_counter()
+        try:
+            action.transcode(in_filepath, out_filepath, gain)
+        finally:
+            self._release(index, nbytes, time.perf_counter() - start)
+
+    def _transcode_remote(self, address, action, in_filepath, out_filepath,
+                          gain):
+        """Transcode a file on a remote worker."""
+        header = {'type': 'transcode', 'secret': self.secret,
+                  'settings': action.get_remote_settings(),
+                  'extension': os.path.splitext(in_filepath)[1],
+                  'gain': gain}
+        response = None
+        if self.shared_paths:
+            response, payload = request(address,
+                                        dict(header, path=in_filepath))
+        if response is None or response['status'] == 'missing':
+            with open(in_filepath, 'rb') as in_file:
+                response, payload = request(address, header, in_file.read())
+        if response['status'] != 'ok':
+            raise RemoteError("Failed to transcode file {} on {}: {}".format(
+                in_filepath, address, response.get('message')))
+        with open(out_filepath, 'wb') as out_file:
+            out_file.write(payload)
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    """Server that transcodes files for coordinators (see module doc).
+
+    :param secret: shared secret the requests have to contain or None
+    :param source_root: directory below which source paths are read, None
+        to only accept the file contents
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, jobs, secret=None, source_root=None):
+        super().__init__(address, _WorkerHandler)
+        self.jobs = jobs
+        self.secret = secret
+        self.source_root = (None if source_root is None
+                            else os.path.realpath(source_root))
+        self._slots = threading.BoundedSemaphore(jobs)
+        self._actions = {}
+        self._lock = threading.Lock()
+
+    def _get_action(self, settings):
+        """Get a Transcode action for the given settings."""
+        # pylint: disable=import-outside-toplevel
+        from .transcode import Transcode
+        key = json.dumps(settings, sort_keys=True)
+        with self._lock:
+            if key not in self._actions:
+                self._actions[key] = Transcode(copy_tags=False, **settings)
+            return self._actions[key]
+
+    def is_authorized(self, header):
+        """Check the shared secret of a request."""
+        if self.secret is None:
+            return True
+        secret = header.get('secret')
+        return isinstance(secret, str) and hmac.compare_digest(
+            secret.encode(), self.secret.encode())
+
+    def get_source_path(self, path):
+        """Get the path of a source file below the source root.
+
+        :returns: resolved path or None if the file doesn't exist or is
+            outside of the source root
+        """
+        if self.source_root is None:
+            return None
+        resolved = os.path.realpath(path)
+        if not resolved.startswith(os.path.join(self.source_root, '')):
+            logger.warning("Rejecting path {} outside of {}",
+                           path, self.source_root)
+            return None
+        return resolved if os.path.isfile(resolved) else None
+
+    def transcode(self, header, payload):
+        """Transcode a file.
+
+        :returns: tuple (response header, payload)
+        """
+        action = self._get_action(header['settings'])
+        path = tempfile.mkdtemp(prefix='sync_music-worker-')
+        try:
+            in_filepath = header.get('path')
+            if in_filepath is None:
+                in_filepath = os.path.join(path, 'in' + header['extension'])
+                with open(in_filepath, 'wb') as in_file:
+                    in_file.write(payload)
+            else:
+                in_filepath = self.get_source_path(in_filepath)
+                if in_filepath is None:
+                    return {'status': 'missing'}, b''
+            out_filepath = action.get_out_filename(os.path.join(path, 'out'))
+            with self._slots:
+                logger.info("Transcoding {}", header.get('path', 'file'))
+                try:
+                    gain = header.get('gain')
+                    action.transcode(in_filepath, out_filepath,
+                                     None if gain is None else tuple(gain))
+                except IOError as err:
+                    logger.error("Error: {}", err)
+                    return {'status': 'error', 'message': str(err)}, b''
+            with open(out_filepath, 'rb') as out_file:
+                return {'status': 'ok'}, out_file.read()
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class _WorkerHandler(socketserver.BaseRequestHandler):
+    """Handles a single request of a coordinator."""
+
+    def handle(self):
+        self.request.settimeout(CONNECT_TIMEOUT)
+        try:
+            # The payload is only read for authorized requests
+            header = receive_header(self.request)
+            if not self.server.is_authorized(header):
+                logger.warning("Rejecting request from {} with a wrong "
+                               "secret", self.client_address)
+                send_message(self.request, {'status': 'error',
+                                            'message': "Wrong secret"})
+                return
+            self.request.settimeout(TIMEOUT)
+            payload = receive_payload(self.request, header)
+            if header['type'] == 'hello':
+                send_message(self.request, {'status': 'ok',
+                                            'jobs': self.server.jobs})
+            elif header['type'] == 'transcode':
+                send_message(self.request,
+                             *self.server.transcode(header, payload))
+            else:
+                send_message(self.request, {
+                    'status': 'error',
+                    'message': "Unknown request {}".format(header['type'])})
+        except (OSError, ValueError, KeyError) as err:
+            logger.error("Error: Invalid request from {}: {}",
+                         self.client_address, err)
+
+
+def load_worker_settings(arguments=None):
+    """Parse the arguments of the worker."""
+    parser = argparse.ArgumentParser(prog='sync_music worker',
+                                     description=main.__doc__)
+    parser.add_argument(
+        '--listen', type=str, default='127.0.0.1:7531', metavar='HOST:PORT',
+        help="address to listen on (default 127.0.0.1:7531), addresses "
+             "other than loopback require --secret-file")
+    parser.add_argument(
+        '--secret-file', type=str, metavar='FILE',
+        help="file containing the shared secret of the coordinators "
+             "(see --remote-secret-file)")
+    parser.add_argument(
+        '--source-root', type=str, metavar='DIR',
+        help="read source files sent as paths (see --remote-shared-paths) "
+             "below this directory")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help="number of parallel transcodes (default: number of CPUs)")
+    args = parser.parse_args(arguments)
+
+    try:
+        host, _ = parse_address(args.listen)
+    except ValueError:
+        parser.error("invalid --listen {}, expected HOST:PORT".format(
+            args.listen))
+    args.secret = None
+    if args.secret_file is not None:
+        try:
+            args.secret = read_secret(args.secret_file)
+        except (OSError, ValueError) as err:
+            parser.error(err)
+    if args.secret is None and not is_loopback(host):
+        parser.error("listening on {} requires --secret-file".format(host))
+    if args.source_root is not None and not os.path.isdir(args.source_root):
+        parser.error("{} is not a directory".format(args.source_root))
+    return args
+
+
+def main(arguments=None):  # pragma: no cover
+    """sync_music worker - Transcode files for other sync_music runs."""
+    args = load_worker_settings(arguments)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format="{asctime} {message}", style='{')
+    with WorkerServer(parse_address(args.listen), args.jobs, args.secret,
+                      args.source_root) as server:
+        logger.info("Listening on {}:{} with {} jobs",
+                    *server.server_address, args.jobs)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,280 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Run statistics.
+
+Stages of the work are timed with RunStats.stage(). Code that runs inside of
+worker processes uses the module level stage(), add() and count() functions
+which record into the RunStats of the current task (see collect()). The
+collected statistics are returned to the main process and merged there.
+
+If tracing is enabled, every stage is also recorded as an event in the Chrome
+Trace Event format. Timestamps are taken from the monotonic clock that is
+shared by all processes of the machine.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import profiling
+from . import util
+
+logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
+    logging.getLogger(__name__))
+
+_local = threading.local()  # pylint: disable=invalid-name
+
+PERCENTILES = [50, 90, 99]
+
+
+class RunStats:
+    """Collects durations and byte counts of stages and plain counters."""
+
+    def __init__(self, trace=False, memory=False):
+        self.durations = {}
+        self.nbytes = {}
+        self.counters = {}
+        self.events = [] if trace else None
+        self.memory = {} if memory else None
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0):
+        """Measure the time spent in the enclosed block."""
+        start = time.perf_counter()
+        try:
+            if self.memory is None:
+                yield
+            else:
+                with profiling.memory_stage(name, self.memory):
+                    yield
+        finally:
+            duration = time.perf_counter() - start
+            self.add(name, duration, nbytes)
+            if self.events is not None:
+                self._add_event(name, 'stage', start, duration,
+                                {'bytes': nbytes} if nbytes else {})
+
+    @contextlib.contextmanager
+    def trace(self, name, category, **args):
+        """Record a trace event for the enclosed block.
+
+        :returns: context manager providing the (modifiable) event arguments
+            or None if tracing is disabled
+        """
+        if self.events is None:
+            yield None
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self._add_event(name, category, start,
+                            time.perf_counter() - start, args)
+
+    def _add_event(self, name, category, start, duration, args):
+        """Add a complete event in the Chrome Trace Event format."""
+        self.events.append({
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': start * 1e6, 'dur': duration * 1e6,
+            'pid': os.getpid(), 'tid': threading.get_ident(),
+            'args': args})
+
+    def add(self, name, duration=None, nbytes=0):
+        """Add a duration sample and / or a number of bytes to a stage."""
+        if duration is not None:
+            self.durations.setdefault(name, []).append(duration)
+        if nbytes:
+            self.nbytes[name] = self.nbytes.get(name, 0) + nbytes
+
+    def count(self, name, value=1):
+        """Increase a counter."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        """Merge the statistics of another RunStats object."""
+        for name, durations in other.durations.items():
+            self.durations.setdefault(name, []).extend(durations)
+        for name, nbytes in other.nbytes.items():
+            self.nbytes[name] = self.nbytes.get(name, 0) + nbytes
+        for name, value in other.counters.items():
+            self.count(name, value)
+        if self.events is not None and other.events is not None:
+            self.events.extend(other.events)
+        if self.memory is not None and other.memory is not None:
+            profiling.merge_memory(self.memory, other.memory)
+
+    def report(self):
+        """Create a report of the collected statistics.
+
+        :returns: dict that can be serialized to JSON
+        """
+        stages = {}
+        for name in sorted(set(self.durations) | set(self.nbytes)):
+            durations = sorted(self.durations.get(name, []))
+            total = sum(durations)
+            nbytes = self.nbytes.get(name, 0)
+            stages[name] = {
+                'count': len(durations),
+                'seconds': total,
+                'bytes': nbytes,
+                'mb_per_second': _rate(nbytes / 1e6, total),
+                'max': durations[-1] if durations else None,
+            }
+            stages[name].update({
+                'p{}'.format(percentile): _percentile(durations, percentile)
+                for percentile in PERCENTILES})
+
+        duration = sum(self.durations.get('process', []))
+        encode = sum(self.durations.get('encode', []))
+        written = (self.nbytes.get('encode', 0) +
+                   self.nbytes.get('write', 0))
+        return {
+            'stages': stages,
+            'counters': dict(self.counters),
+            'files_per_second': _rate(self.counters.get('files', 0),
+                                      duration),
+            'mb_per_second': _rate(written / 1e6, duration),
+            'realtime_factor': _rate(self.counters.get('audio_seconds', 0),
+                                     encode),
+        }
+
+    def log(self):
+        """Log a summary of the collected statistics."""
+        report = self.report()
+        logger.info("Run stats:")
+        for name, stage_stats in report['stages'].items():
+            logger.info(" - {}: {:.3f}s ({} times, {:.1f} MB)", name,
+                        stage_stats['seconds'], stage_stats['count'],
+                        stage_stats['bytes'] / 1e6)
+        for name in ['files_per_second', 'mb_per_second', 'realtime_factor']:
+            if report[name] is not None:
+                logger.info(" - {}: {:.2f}", name.replace('_', ' '),
+                            report[name])
+
+    def write_json(self, path):
+        """Write the report as JSON file."""
+        util.write_atomic(path, json.dumps(self.report(), indent=2,
+                                           sort_keys=True) + '\n')
+
+    def write_prometheus(self, path):
+        """Write the report in the Prometheus text exposition format.
+
+        The file is replaced atomically so that it can be read by the
+        node exporter textfile collector at any time.
+        """
+        report = self.report()
+        lines = []
+
+        def _metric(name, metric_type, help_text, samples):
+            lines.append('# HELP sync_music_{} {}'.format(name, help_text))
+            lines.append('# TYPE sync_music_{} {}'.format(name, metric_type))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_string = ','.join('{}="{}"'.format(key, label)
+                                        for key, label in labels)
+                lines.append('sync_music_{}{} {}'.format(
+                    name, '{' + label_string + '}' if labels else '', value))
+
+        stages = report['stages']
+        _metric('stage_seconds_total', 'counter', "Time spent per stage.",
+                [((('stage', n),), s['seconds']) for n, s in stages.items()])
+        _metric('stage_count_total', 'counter', "Executions per stage.",
+                [((('stage', n),), s['count']) for n, s in stages.items()])
+        _metric('stage_bytes_total', 'counter', "Bytes handled per stage.",
+                [((('stage', n),), s['bytes']) for n, s in stages.items()])
+        _metric('stage_seconds', 'summary', "Duration percentiles per stage.",
+                [((('stage', n), ('quantile', p / 100)),
+                  s['p{}'.format(p)])
+                 for n, s in stages.items() for p in PERCENTILES])
+        _metric('counter_total', 'counter', "Run counters.",
+                [((('name', n),), v)
+                 for n, v in sorted(report['counters'].items())])
+        for name in ['files_per_second', 'mb_per_second', 'realtime_factor']:
+            _metric(name, 'gauge', name.replace('_', ' ').capitalize() + '.',
+                    [((), report[name])])
+        util.write_atomic(path, '\n'.join(lines) + '\n')
+
+    def write_trace(self, path):
+        """Write the trace events as JSON (chrome://tracing, Perfetto)."""
+        main_pid = os.getpid()
+        metadata = [
+            {'name': 'process_name', 'ph': 'M', 'pid': pid,
+             'args': {'name': 'main' if pid == main_pid
+                      else 'worker {}'.format(pid)}}
+            for pid in sorted({event['pid'] for event in self.events})]
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': metadata + self.events,
+                       'displayTimeUnit': 'ms'}, trace_file)
+
+
+def _rate(value, duration):
+    """Calculate a rate, None if the duration is unknown."""
+    return value / duration if duration else None
+
+
+def _percentile(durations, percentile):
+    """Get a percentile (nearest rank) of sorted durations."""
+    if not durations:
+        return None
+    rank = max(0, -(-len(durations) * percentile // 100) - 1)
+    return durations[rank]
+
+
+@contextlib.contextmanager
+def collect(trace=False, memory=False):
+    """Record the module level stage() calls into a new RunStats object."""
+    previous = getattr(_local, 'stats', None)
+    _local.stats = RunStats(trace, memory)
+    try:
+        yield _local.stats
+    finally:
+        _local.stats = previous
+
+
+def stage(name, nbytes=0):
+    """Measure a stage of the current task (no-op outside of collect())."""
+    current = getattr(_local, 'stats', None)
+    if current is None:
+        return contextlib.nullcontext()
+    return current.stage(name, nbytes)
+
+
+def trace(name, category, **args):
+    """Record a trace event of the current task (see RunStats.trace())."""
+    current = getattr(_local, 'stats', None)
+    if current is None:
+        return contextlib.nullcontext()
+    return current.trace(name, category, **args)
+
+
+def add(name, duration=None, nbytes=0):
+    """Add a duration sample and / or bytes to a stage of the current task."""
+    current = getattr(_local, 'stats', None)
+    if current is not None:
+        current.add(name, duration, nbytes)
+
+
+def count(name, value=1):
+    """Increase a counter of the current task."""
+    current = getattr(_local, 'stats', None)
+    if current is not None:
+        current.count(name, value)
@@ -19,26 +19,80 @@
 
 import os
 import codecs
+import contextlib
+import functools
+import hashlib
 import logging
 import argparse
 import configparser
+import copy
+import math
+import random
 import sys
+import time
 
 from multiprocessing import Pool
-
-import pbr.version
+from multiprocessing.pool import ThreadPool
 
 from . import util
+from . import catalog
 from .hashdb import HashDb
+from . import loudness
+from . import plan
+from .fanout import FanOut
+from . import progress
+from .playlist import PathSuffixIndex
+from .playlist import read_playlist
+from .playlist import select_playlist_files
+from . import profiling
+from . import remote
+from . import stats
+from .stats import RunStats
+from . import watch
+from .actions import COPY_STRATEGIES
 from .actions import Copy
 from .actions import Skip
+from .transcode import PROFILES
 from .transcode import Transcode
 
-__version__ = pbr.version.VersionInfo('sync_music').release_string()
-
 logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
     logging.getLogger(__name__))
 
+AUDIO_EXTENSIONS = ['.flac', '.ogg', '.opus', '.mp3', '.m4a']
+
+# Constant bitrates in kbit/s (see --bitrate and --codec)
+BITRATES = ['8', '16', '24', '32', '40', '48', '64', '80', '96', '112', '128',
+            '160', '192', '224', '256', '320']
+
+# Parallel reads per destination when verifying (more only cause seeks)
+VERIFY_READERS = 4
+
+# SyncMusic instance of a worker process (see _init_worker())
+_worker_sync_music = None  # pylint: disable=invalid-name
+
+
+def _init_worker(sync_music, log_args):
+    """Initialize a worker process.
+
+    The SyncMusic instance is passed once per worker instead of with every
+    task and the log records are sent to the main process.
+    """
+    global _worker_sync_music  # pylint: disable=global-statement,invalid-name
+    _worker_sync_music = sync_music
+    util.init_worker_logging(*log_args)
+
+
+def _process_file_in_worker(current_file):
+    """Process a single file in a worker process (see _init_worker())."""
+    # pylint: disable=protected-access
+    return _worker_sync_music._process_file(current_file)
+
+
+def _analyze_file_in_worker(in_filename):
+    """Analyse the loudness of a file in a worker process."""
+    # pylint: disable=protected-access
+    return _worker_sync_music._analyze_file(in_filename)
+
 
 class SyncMusic():
     """sync_music - Sync music library to external device."""
@@ -48,73 +102,241 @@ class SyncMusic():
         logger.info(__doc__)
         logger.info("")
         self._args = args
-        self._hashdb = HashDb(os.path.join(args.audio_dest, 'sync_music.db'))
+        self._hashdb = HashDb(os.path.join(args.audio_dest, 'sync_music.db'),
+                              compact=True)
+        self._playlistdb = HashDb(
+            os.path.join(args.audio_dest, 'sync_music_playlists.db'))
+        self.stats = RunStats(trace=args.trace is not None,
+                              memory=args.profile_memory)
+        self._history_path = plan.get_history_path(args.audio_dest)
+        self._main_pid = os.getpid()
+        if args.profile:
+            profiling.remove_profiles(args.profile)
+        self._touched_directories = set()
+        self._staging = None
+        self._remote = None
+        self._loudnessdb = HashDb(
+            os.path.join(args.audio_dest, 'sync_music_loudness.db'))
+        # Album gain by input file (see _analyze_albums())
+        self._album_gains = {}
+        # Names of the synced source files by directory (see watch())
+        self._index = {}
+        # Catalog kept in memory while watching (see _select_files())
+        self._catalog = None
         logger.info("Settings:")
         logger.info(" - audio-src:  {}".format(args.audio_src))
-        logger.info(" - audio-dest: {}".format(args.audio_dest))
+        for audio_dest in args.audio_dests:
+            logger.info(" - audio-dest: {}".format(audio_dest))
         if args.playlist_src:
             logger.info(" - playlist-src: {}".format(args.playlist_src))
+            if args.playlist_selection:
+                logger.info(" - only syncing files from playlists")
+        if args.select:
+            logger.info(" - select: {}".format(args.select))
         logger.info(" - mode: {}".format(args.mode))
+        logger.info(" - codec: {}".format(args.codec[0]))
+        if args.durability != 'none':
+            logger.info(" - durability: {}".format(args.durability))
         logger.info("")
-        self._action_copy = Copy()
+        self._action_copy = Copy(self._args.copy_strategy)
         self._action_skip = Skip()
+        # A bitrate of the codec overrides --bitrate and --varbitrate
+        codec, _, bitrate = args.codec[0].partition(':')
         self._action_transcode = Transcode(
             mode=self._args.mode,
             replaygain_preamp_gain=self._args.replaygain_preamp_gain,
             transcode=not self._args.disable_file_processing,
             copy_tags=not self._args.disable_tag_processing,
-            bitrate=self._args.bitrate,
-            var_bitrate=self._args.varbitrate,
+            bitrate=bitrate or self._args.bitrate,
+            var_bitrate=None if bitrate else self._args.varbitrate,
             albumartist_artist_hack=self._args.albumartist_artist_hack,
             albumartist_composer_hack=self._args.albumartist_composer_hack,
             artist_albumartist_hack=self._args.artist_albumartist_hack,
             discnumber_hack=self._args.discnumber_hack,
-            tracknumber_hack=self._args.tracknumber_hack)
+            tracknumber_hack=self._args.tracknumber_hack,
+            copy_strategy=self._args.copy_strategy,
+            codec=codec)
+        # Destinations with the same codec share the processed files, the
+        # others are synced by their own instance per codec
+        self._mirrors = [self._create_mirror(audio_dest) for audio_dest, codec
+                         in zip(args.audio_dests[1:], args.codec[1:])
+                         if codec == args.codec[0]]
+        self._codec_syncs = []
+        for codec in sorted(set(args.codec) - {args.codec[0]},
+                            key=args.codec.index):
+            audio_dests = [audio_dest for audio_dest, other
+                           in zip(args.audio_dests, args.codec)
+                           if other == codec]
+            codec_sync = SyncMusic(argparse.Namespace(**dict(
+                vars(args), audio_dest=audio_dests[0],
+                audio_dests=audio_dests, codec=[codec] * len(audio_dests))))
+            codec_sync.stats = self.stats
+            self._codec_syncs.append(codec_sync)
+
+    def _create_mirror(self, audio_dest):
+        """Create the instance for an additional destination.
+
+        Mirrors share the settings and actions, but keep the databases and
+        the cleanup state of their destination. The files are scanned,
+        hashed and processed once by this instance (see FanOut).
+        """
+        mirror = copy.copy(self)
+        mirror._args = argparse.Namespace(**dict(
+            vars(self._args), audio_dest=audio_dest, audio_dests=[audio_dest]))
+        mirror._hashdb = HashDb(os.path.join(audio_dest, 'sync_music.db'),
+                                compact=True)
+        mirror._playlistdb = HashDb(
+            os.path.join(audio_dest, 'sync_music_playlists.db'))
+        mirror._history_path = plan.get_history_path(audio_dest)
+        mirror._touched_directories = set()
+        mirror._mirrors = []
+        mirror._codec_syncs = []
+        return mirror
+
+    def _get_destinations(self):
+        """Get the instances of the destinations of this codec, this first."""
+        return [self] + self._mirrors
+
+    def _get_syncs(self):
+        """Get the instances syncing the destinations of each codec."""
+        return [self] + self._codec_syncs
+
+    def _get_all_destinations(self):
+        """Get the instances of all destinations (of all codecs)."""
+        return [destination for sync in self._get_syncs()
+                for destination in sync._get_destinations()]
 
     def _process_file(self, current_file):
-        """Process single file.
+        """Process single file and collect its statistics.
+
+        :param current_file: tuple (in_filename, action, planned_hash)
+        :returns: tuple (file_hash, file_stats)
+        """
+        in_filename, action, _ = current_file
+        # The main process is profiled as a whole (see _profile())
+        profile = (self._profile() if os.getpid() != self._main_pid
+                   else contextlib.nullcontext())
+        with profile, stats.collect(self._args.trace is not None,
+                                    self._args.profile_memory) as file_stats:
+            stats.count('files')
+            with stats.trace(action.name, 'file',
+                             file=in_filename) as event_args:
+                file_hash = self._sync_file(current_file)
+                if file_hash is not None or event_args is not None:
+                    nbytes = os.path.getsize(
+                        os.path.join(self._args.audio_src, in_filename))
+                if file_hash is not None:
+                    stats.count('bytes_changed', nbytes)
+                if event_args is not None:
+                    event_args['bytes'] = nbytes
+                    event_args['changed'] = file_hash is not None
+        return file_hash, file_stats
 
-        :param current_file: tuple:
-            (file_index, total_files, in_filename, action)
+    def _sync_file(self, current_file):
+        """Sync single file.
+
+        :param current_file: tuple (in_filename, action, planned_hash),
+            files with a planned hash (see plan_audio()) are processed
+            without checking for changes again
+        :returns: tuple (in_filename, out_filename, hash, targets, output
+            size, output digest) or None if nothing was written
         """
-        file_index, total_files, in_filename, action = current_file
+        in_filename, action, planned_hash = current_file
         out_filename = action.get_out_filename(in_filename)
-        if out_filename is not None:
-            out_filename = util.correct_path_fat32(out_filename)
-            logger.info("{:04}/{:04}: {} {} to {}",
-                        file_index, total_files, action.name,
-                        in_filename, out_filename)
-        else:
-            logger.info("{:04}/{:04}: {} {}",
-                        file_index, total_files, action.name, in_filename)
+        if out_filename is None:
+            logger.debug("{} {}", action.name, in_filename)
             return None
+        out_filename = util.correct_path_fat32(out_filename)
 
         in_filepath = os.path.join(self._args.audio_src, in_filename)
-        out_filepath = os.path.join(self._args.audio_dest, out_filename)
-
-        # Calculate hash to see if the input file has changed
-        hash_current = self._hashdb.get_hash(in_filepath)
-        hash_database = None
-        if in_filename in self._hashdb.database:
-            hash_database = self._hashdb.database[in_filename][1]
 
-        if (self._args.force or hash_database is None
-                or hash_database != hash_current
-                or not os.path.exists(out_filepath)):
+        if planned_hash is not None:
+            hash_current, targets = planned_hash, [0]
+        else:
+            # Calculate hash to see if the input file has changed
+            with stats.stage('hash'):
+                hash_current = self._hashdb.get_hash(in_filepath)
+            targets = [index for index, destination
+                       in enumerate(self._get_destinations())
+                       if destination._is_changed(in_filename, out_filename,
+                                                  hash_current)]
+        if targets:
+            logger.info("{} {} to {}", action.name, in_filename, out_filename)
+            # Files for several destinations are processed into the staging
+            # directory and written to the destinations by the FanOut
+            out_filepath = os.path.join(
+                self._staging or self._args.audio_dest, out_filename)
             util.ensure_directory_exists(os.path.dirname(out_filepath))
             try:
-                action.execute(in_filepath, out_filepath)
+                action.execute(in_filepath, out_filepath,
+                               source=(in_filename, hash_current),
+                               gain=self._album_gains.get(in_filename))
             except IOError as err:
                 logger.error("Error: {}", err)
+                stats.count('files_failed')
                 return None
-            return (in_filename, out_filename, hash_current)
-        logger.info("Skipping up to date file")
+            stats.count('files_changed')
+            if self._args.durability == 'per-file' and self._staging is None:
+                with stats.stage('flush'):
+                    util.fsync_file(out_filepath)
+            # Size and digest of the output for --verify
+            with stats.stage('digest'):
+                output = self._hashdb.get_digest(out_filepath)
+            return (in_filename, out_filename, hash_current,
+                    targets) + output
+        logger.debug("Skipping up to date file {}", in_filename)
         return None
 
+    def _is_changed(self, in_filename, out_filename, hash_current):
+        """Check whether the input file has changed since the last sync."""
+        hash_database = None
+        if in_filename in self._hashdb.database:
+            hash_database = self._hashdb.database[in_filename][1]
+
+        return (self._args.force or hash_database is None
+                or hash_database != hash_current
+                or not os.path.exists(os.path.join(self._args.audio_dest,
+                                                   out_filename)))
+
+    def _plan_file(self, current_file):
+        """Determine the work syncing a single file would do.
+
+        :param current_file: tuple (in_filename, action)
+        :returns: plan entry or None if the file is skipped or up to date
+        """
+        in_filename, action = current_file
+        out_filename = action.get_out_filename(in_filename)
+        if out_filename is None:
+            return None
+        out_filename = util.correct_path_fat32(out_filename)
+        in_filepath = os.path.join(self._args.audio_src, in_filename)
+        with stats.stage('hash'):
+            hash_current = self._hashdb.get_hash(in_filepath)
+        if not self._is_changed(in_filename, out_filename, hash_current):
+            return None
+
+        entry = {'file': in_filename, 'out': out_filename,
+                 'hash': hash_current,
+                 'bytes': os.path.getsize(in_filepath),
+                 'replaces': None}
+        entry.update(action.plan(
+            in_filepath, os.path.join(self._args.audio_dest, out_filename)))
+        if (in_filename in self._hashdb.database and
+                self._hashdb.database[in_filename][0] != out_filename):
+            # The output is written anew, the old output is removed after
+            # the database has been stored (see _store_databases())
+            replaced = self._hashdb.database[in_filename][0]
+            replaced_filepath = os.path.join(self._args.audio_dest, replaced)
+            entry['replaces'] = {
+                'out': replaced,
+                'bytes': (os.path.getsize(replaced_filepath)
+                          if os.path.exists(replaced_filepath) else 0)}
+        return entry
+
     def _get_file_action(self, in_filename):
         """Determine the action for the given file."""
         extension = os.path.splitext(in_filename)[1]
-        if extension in ['.flac', '.ogg', '.mp3', '.m4a']:
+        if extension in AUDIO_EXTENSIONS:
             if self._args.mode == 'copy':
                 return self._action_copy
             return self._action_transcode
@@ -122,114 +344,1014 @@ class SyncMusic():
             return self._action_copy
         return self._action_skip
 
-    def _clean_up_missing_files(self):
+    def _clean_up_missing_files(self, in_filenames, missing=None):
         """Remove files in the destination, where the source file doesn't
            exist anymore.
+
+        :param in_filenames: set of relative paths found by the source scan
+        :param missing: relative paths of the removed source files if they
+            are known (watch mode), in_filenames isn't used then
         """
         logger.info("Cleaning up missing files")
-        files = [(k, v[0]) for k, v in self._hashdb.database.items()]
-        for in_filename, out_filename in files:
-            in_filepath = os.path.join(self._args.audio_src, in_filename)
-            out_filepath = os.path.join(self._args.audio_dest, out_filename)
+        if missing is None:
+            missing = self._hashdb.database.keys() - in_filenames
+        missing = sorted(f for f in missing if f in self._hashdb.database)
+        if not missing:
+            return
+        for in_filename in missing:
+            logger.info("File {} does not exist, removing {}",
+                        in_filename, self._hashdb.database[in_filename][0])
+        if not (self._args.batch or util.query_yes_no(
+                "{} source files do not exist anymore, do you want to "
+                "remove them from the destination?".format(len(missing)))):
+            return
+
+        with ThreadPool(processes=self._args.jobs) as pool:
+            removed = pool.map(self._remove_out_file, missing)
+        for in_filename, success in zip(missing, removed):
+            if success:
+                self._touched_directories.add(os.path.dirname(os.path.join(
+                    self._args.audio_dest,
+                    self._hashdb.database[in_filename][0])))
+                del self._hashdb.database[in_filename]
+
+    def _remove_out_file(self, in_filename):
+        """Remove the output file belonging to the given input file.
 
-            if not os.path.exists(in_filepath):
-                if os.path.exists(out_filepath):
-                    if (self._args.batch or util.query_yes_no(
-                            "File {} does not exist, do you want to remove {}"
-                            .format(in_filename, out_filename))):
-                        try:
-                            os.remove(out_filepath)
-                        except OSError as err:
-                            logger.error("Error: Failed to remove file {}",
-                                         err)
-                if not os.path.exists(out_filepath):
-                    del self._hashdb.database[in_filename]
+        :returns: True if the output file doesn't exist anymore
+        """
+        out_filepath = os.path.join(self._args.audio_dest,
+                                    self._hashdb.database[in_filename][0])
+        try:
+            os.remove(out_filepath)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logger.error("Error: Failed to remove file {}", err)
+            return False
+        return True
 
     def _clean_up_empty_directories(self):
-        """Remove empty directories in the destination."""
+        """Remove empty directories in the destination.
+
+        Only the directories of files that have been removed during this run
+        are checked, unless a full sweep of the destination is requested.
+        """
         logger.info("Cleaning up empty directories")
-        util.delete_empty_directories(self._args.audio_dest)
-
-    def sync_audio(self):
-        """Sync audio."""
-        self._hashdb.load()
-
-        # Create a list of all tracks ordered by their last modified time stamp
-        files = [(f, self._get_file_action(f),
-                  os.path.getmtime(os.path.join(self._args.audio_src, f)))
-                 for f in util.list_all_files(self._args.audio_src)]
-        files = [(index, len(files), f[0], f[1])
-                 for index, f in enumerate(files, 1)]
+        if self._args.full_directory_cleanup and self._args.only:
+            for path in self._args.only:
+                path = os.path.join(self._args.audio_dest,
+                                    util.correct_path_fat32(path))
+                util.delete_empty_directories(path)
+                self._touched_directories.add(os.path.dirname(path))
+        if self._args.full_directory_cleanup and not self._args.only:
+            util.delete_empty_directories(self._args.audio_dest)
+        else:
+            util.prune_empty_directories(self._touched_directories,
+                                         self._args.audio_dest)
+        self._touched_directories.clear()
+
+    def rebuild_db(self):
+        """Rebuild the hash databases from the files in the destinations.
+
+        Processed files are identified by the source information that
+        copy_tags() stores in them (only if written with the current
+        settings), copies by their path and size. Sources that changed since
+        then are detected by the next sync as usual. The digests of the
+        outputs (see verify_audio()) are not recorded, the files are not
+        known to be intact.
+        """
+        with self._profile(), self.stats.stage('rebuild'):
+            for destination in self._get_all_destinations():
+                destination._rebuild_db()
+
+    def _rebuild_db(self):
+        """Rebuild the hash database of this destination."""
+        logger.info("Rebuilding hash database {}", self._hashdb.path)
+        copies = {}
+        for in_filename in self._list_input_files():
+            if self._get_file_action(in_filename) is self._action_copy:
+                copies[util.correct_path_fat32(in_filename)] = in_filename
+        out_filenames = util.list_all_files(self._args.audio_dest)
+        with ThreadPool(processes=self._args.jobs) as pool:
+            entries = pool.map(
+                functools.partial(self._rebuild_entry, copies), out_filenames,
+                max(1, len(out_filenames) // (self._args.jobs * 16)))
+        self._hashdb.database = {entry[0]: entry[1:]
+                                 for entry in entries if entry is not None}
+        logger.info("Found the sources of {} of {} files",
+                    len(self._hashdb.database), len(out_filenames))
+        self._hashdb.store()
+
+    def _rebuild_entry(self, copies, out_filename):
+        """Find the source of a file in the destination.
+
+        :param copies: dict mapping the output to the input path of copies
+        :returns: tuple (in_filename, out_filename, hash) or None
+        """
+        out_filepath = os.path.join(self._args.audio_dest, out_filename)
+        if out_filename in copies:
+            in_filename = copies[out_filename]
+            in_filepath = os.path.join(self._args.audio_src, in_filename)
+            if os.path.getsize(in_filepath) != os.path.getsize(out_filepath):
+                return None
+            return in_filename, out_filename, self._hashdb.get_hash(
+                in_filepath)
+        if not out_filename.endswith(
+                '.' + self._action_transcode.profile.extension):
+            return None
+        source = self._action_transcode.read_source(out_filepath)
+        if (source is None or
+                source[2] != self._action_transcode.fingerprint):
+            return None
+        return source[0], out_filename, source[1]
+
+    def verify_audio(self):
+        """Verify the outputs in the destinations against the databases.
+
+        The outputs are read again from the device (bypassing the page
+        cache) with up to VERIFY_READERS parallel sequential reads per
+        destination and compared to the size and digest recorded when they
+        were written. Missing, truncated or corrupted outputs are removed
+        from the database, so that the next sync creates them again.
+        Outputs without a recorded digest (written by an older version or
+        after --rebuild-db) get the size and digest read now, so that later
+        runs verify them.
+        """
+        with self._profile(), self.stats.stage('verify'):
+            for destination in self._get_all_destinations():
+                destination._verify()
+
+    def _verify(self):
+        """Verify the outputs of this destination (see verify_audio())."""
+        self._hashdb.load(self._args.only)
+        entries = sorted(self._hashdb.database.items())
+        if self._args.verify < 1:
+            entries = sorted(random.sample(
+                entries, math.ceil(len(entries) * self._args.verify)))
+        logger.info("Verifying {} files in {}", len(entries),
+                    self._args.audio_dest)
+        start = time.perf_counter()
+        with ThreadPool(processes=min(self._args.jobs,
+                                      VERIFY_READERS)) as pool:
+            results = pool.map(self._verify_entry, entries, 1)
+        seconds = time.perf_counter() - start
+
+        failed, recorded = 0, 0
+        for (in_filename, entry), result in zip(entries, results):
+            problem, digest = result[0], result[2]
+            if problem is None and digest is not None:
+                self._hashdb.database[in_filename] = entry[:2] + digest
+                recorded += 1
+            if problem is None:
+                continue
+            logger.warning("File {} is {}, it will be created again",
+                           entry[0], problem)
+            del self._hashdb.database[in_filename]
+            failed += 1
+        nbytes = sum(result[1] for result in results)
+        self.stats.count('verify_files', len(entries))
+        self.stats.count('verify_bytes', nbytes)
+        self.stats.count('verify_failed', failed)
+        self.stats.count('verify_recorded', recorded)
+        logger.info("Read {:.1f} MB in {:.1f}s ({:.1f} MB/s), {} files "
+                    "failed", nbytes / 1e6, seconds,
+                    nbytes / 1e6 / seconds if seconds else 0, failed)
+        if recorded:
+            logger.info("{} files are unverified (no digest recorded, "
+                        "written by an older version or --rebuild-db), "
+                        "their digests are recorded now", recorded)
+        if failed or recorded:
+            self._hashdb.store()
+
+    def _verify_entry(self, item):
+        """Verify a single output.
+
+        :param item: tuple (in_filename, database entry)
+        :returns: tuple (problem or None, bytes read, (size, digest) if the
+            entry has no digest yet or None)
+        """
+        entry = item[1]
+        out_filepath = os.path.join(self._args.audio_dest, entry[0])
+        try:
+            size, digest = self._hashdb.get_digest(out_filepath,
+                                                   uncached=True)
+        except FileNotFoundError:
+            return 'missing', 0, None
+        except OSError as err:
+            return 'unreadable ({})'.format(err), 0, None
+        if len(entry) < 4:
+            return None, size, (size, digest)
+        if size < entry[2]:
+            return 'truncated', size, None
+        if size != entry[2] or digest != entry[3]:
+            return 'corrupted', size, None
+        return None, size, None
+
+    def _list_input_files(self):
+        """List the files in the source that should be synced."""
+        if self._args.playlist_selection:
+            logger.info("Selecting files referenced by playlists")
+            in_filenames = sorted(select_playlist_files(
+                self._args.playlist_src, self._args.audio_src))
+            logger.info("Selected {} files", len(in_filenames))
+        elif self._args.only:
+            in_filenames = []
+            for path in self._args.only:
+                in_path = os.path.join(self._args.audio_src, path)
+                if os.path.isfile(in_path):
+                    in_filenames.append(path)
+                else:
+                    in_filenames.extend(os.path.join(path, f) for f
+                                        in util.list_all_files(in_path))
+        else:
+            in_filenames = util.list_all_files(self._args.audio_src)
+        if self._args.select:
+            # Playlists don't tell which of the other files were removed
+            in_filenames = self._select_files(
+                in_filenames, () if self._args.playlist_selection else None)
+        return in_filenames
+
+    def _select_files(self, in_filenames, removed=None):
+        """Select the files matching --select by their catalog entries.
+
+        Besides the matching audio files, the folder.jpg files in their
+        directories are selected as well.
+
+        :param removed: source files known to be removed, None if
+            in_filenames are all files of the source (or of --only), see
+            catalog.Catalog.update()
+        """
+        query = catalog.Query(self._args.select)
+        audio_files = [f for f in in_filenames
+                       if os.path.splitext(f)[1] in AUDIO_EXTENSIONS]
+        metadata = self._catalog
+        if metadata is None:
+            hashdb = HashDb(os.path.join(self._args.audio_dest,
+                                         'sync_music_catalog.db'))
+            hashdb.load(self._args.only)
+            metadata = catalog.Catalog(hashdb)
+            if self._args.watch:
+                self._catalog = metadata
+        entries = metadata.update(self._args.audio_src, audio_files,
+                                  self._args.jobs, removed)
+        if self._args.plan is None:  # A dry run doesn't write anything
+            metadata.store()
+        selection = {f for f in audio_files if entries[f] is not None and
+                     query.matches(catalog.get_fields(f, entries[f]))}
+        directories = {os.path.dirname(f) for f in selection}
+        selected = [f for f in in_filenames if f in selection or (
+            f.endswith('folder.jpg') and os.path.dirname(f) in directories)]
+        logger.info("Selected {} of {} audio files", len(selection),
+                    len(audio_files))
+        return selected
+
+    def _profile(self):
+        """Profile the enclosed block if profiling is enabled."""
+        if not self._args.profile:
+            return contextlib.nullcontext()
+        return profiling.Profiler.get(self._args.profile).profile()
+
+    def _get_plan_settings(self):
+        """Get the settings that a plan is only valid for."""
+        names = ['audio_src', 'audio_dest', 'mode', 'bitrate', 'varbitrate',
+                 'replaygain_preamp_gain', 'disable_file_processing',
+                 'disable_tag_processing', 'albumartist_artist_hack',
+                 'albumartist_composer_hack', 'artist_albumartist_hack',
+                 'discnumber_hack', 'tracknumber_hack', 'only', 'select',
+                 'codec']
+        return {name: getattr(self._args, name) for name in names}
+
+    def plan_audio(self):
+        """Scan the source and detect changes without writing anything.
+
+        :returns: plan that can be executed with sync_audio() (see
+            plan.create_plan())
+        """
+        with self._profile():
+            return self._plan_audio()
+
+    def _plan_audio(self):
+        """Plan the audio sync (see plan_audio())."""
+        self._hashdb.load(self._args.only)
+
+        with self.stats.stage('scan'):
+            files = [(f, self._get_file_action(f))
+                     for f in self._list_input_files()]
         if not files:
             raise FileNotFoundError("No input files")
 
+        with self.stats.stage('plan'):
+            with ThreadPool(processes=self._args.jobs) as pool:
+                entries = [entry for entry in
+                           pool.map(self._plan_file, files)
+                           if entry is not None]
+
+        deletes = []
+        for in_filename in sorted(self._hashdb.database.keys() -
+                                  {f[0] for f in files}):
+            out_filepath = os.path.join(
+                self._args.audio_dest, self._hashdb.database[in_filename][0])
+            deletes.append({
+                'file': in_filename,
+                'out': self._hashdb.database[in_filename][0],
+                'bytes': (os.path.getsize(out_filepath)
+                          if os.path.exists(out_filepath) else 0)})
+
+        sync_plan = plan.create_plan(
+            self._get_plan_settings(), entries, deletes,
+            plan.load_history(self._history_path), self._args.jobs)
+        plan.log_plan(sync_plan)
+        return sync_plan
+
+    def read_plan(self, path):
+        """Read a plan and check that it matches the current settings."""
+        return plan.read_plan(path, self._get_plan_settings())
+
+    def sync_audio(self, sync_plan=None):
+        """Sync audio.
+
+        :param sync_plan: plan created by plan_audio(), if given only the
+            files of the plan are processed and removed without scanning
+            the source again
+        """
+        with self._profile():
+            for sync in self._get_syncs():
+                sync._sync_audio(sync_plan)
+
+    def _sync_audio(self, sync_plan, changes=None):
+        """Sync audio (see sync_audio()).
+
+        :param changes: tuple (files, missing) with the source files to sync
+            and the removed source files in watch mode, the databases are
+            still loaded then (see _sync_changes())
+        """
+        destinations = self._get_destinations()
+        if changes is None:
+            for destination in destinations:
+                destination._hashdb.load(self._args.only)
+
+        missing, keys = None, None
+        if changes is not None:
+            files = [(f, self._get_file_action(f), None) for f in changes[0]]
+            in_filenames, missing = None, changes[1]
+            # Only the chunks of the changed entries are written
+            keys = set(changes[0]) | set(missing)
+        elif sync_plan is None:
+            # Create a list of all tracks ordered by their last modified time
+            # stamp
+            with self.stats.stage('scan'):
+                files = [(f, self._get_file_action(f), None, os.path.getmtime(
+                    os.path.join(self._args.audio_src, f)))
+                         for f in self._list_input_files()]
+            if not files and not self._args.only:
+                raise FileNotFoundError("No input files")
+            in_filenames = {f[0] for f in files}
+            if self._args.watch:
+                self._index = {}
+                for in_filename in in_filenames:
+                    directory, name = os.path.split(in_filename)
+                    self._index.setdefault(directory, set()).add(name)
+        else:
+            logger.info("Executing plan")
+            files = [(e['file'], self._get_file_action(e['file']), e['hash'])
+                     for e in sync_plan['files']]
+            in_filenames = (self._hashdb.database.keys() -
+                            {d['file'] for d in sync_plan['delete']})
+        files = [f[:3] for f in files]
+
         # Cleanup files that does not exist any more
-        self._clean_up_missing_files()
-        self._clean_up_empty_directories()
+        with self.stats.stage('cleanup'):
+            for destination in destinations:
+                destination._clean_up_missing_files(in_filenames, missing)
+                destination._clean_up_empty_directories()
+
+        if self._args.remote_worker and self._remote is None:
+            logger.info("Remote workers:")
+            self._remote = remote.RemoteWorkers(
+                self._args.remote_worker, self._args.jobs,
+                self._args.remote_shared_paths, self._args.remote_secret)
+            self._action_transcode.remote = self._remote
+
+        self._album_gains = self._analyze_albums(files)
 
         # Do the work
         logger.info("Starting actions")
+        results = []
+        file_progress = self._create_progress(len(files))
+        fanout = None
+        if self._mirrors:
+            fanout = FanOut([d._args.audio_dest for d in destinations],
+                            self._args.destination_buffer,
+                            trace=self._args.trace is not None,
+                            sync=self._args.durability == 'per-file',
+                            copy_strategy=self._args.copy_strategy)
+            self._staging = fanout.staging
+        checkpoint = time.monotonic()
         try:
-            if self._args.jobs == 1:
-                # pool.map doesn't might not show all exceptions
-                file_hashes = []
-                for current_file in files:
-                    file_hashes.append(self._process_file(current_file))
-            else:
-                with Pool(processes=self._args.jobs) as pool:
-                    file_hashes = pool.map(self._process_file, files)
+            with self.stats.stage('process'):
+                for result in self._process_files(files, fanout):
+                    results.append(result)
+                    if fanout is not None:
+                        fanout.put(result[0])
+                    file_progress.update(
+                        nbytes=result[1].counters.get('bytes_changed', 0))
+                    if (self._args.durability == 'batched' and
+                            time.monotonic() - checkpoint >=
+                            self._args.checkpoint_interval):
+                        with self.stats.stage('checkpoint'):
+                            self._store_databases(results, fanout, keys)
+                        checkpoint = time.monotonic()
+                if fanout is not None:
+                    fanout.close(self.stats)
         except:  # noqa, pylint: disable=bare-except
+            if fanout is not None:
+                fanout.abort()
+                fanout.close(self.stats)
             logger.error(">>> traceback <<<")
             logger.exception("Exception")
             logger.error(">>> end of traceback <<<")
+        self._staging = None
+        file_progress.finish()
+        if self._remote is not None:
+            logger.info("Transcoding throughput per job:")
+            throughputs = self._remote.get_throughput()
+            for address, throughput in throughputs.items():
+                logger.info(" - {}: {}", address,
+                            "unknown" if throughput is None
+                            else "{:.1f} MB/s".format(throughput / 1e6))
 
-        # Store new hashes in the database
-        for file_hash in file_hashes:
-            if file_hash is not None:
-                self._hashdb.database[file_hash[0]] = \
-                    (file_hash[1], file_hash[2])
-        self._hashdb.store()
+        # Store new hashes in the databases
+        for _, file_stats in results:
+            self.stats.merge(file_stats)
+        with self.stats.stage('store'):
+            self._store_databases(results, fanout, keys)
+        plan.update_history(self._history_path, self.stats)
+        self._log_copies()
+        self._log_avoided_encodes()
+        self.stats.log()
+
+    def _store_databases(self, results, fanout, keys=None):
+        """Store the written files in the databases of the destinations.
+
+        With --durability the databases are only written after the outputs
+        they reference are durable: with 'per-file' every output was already
+        flushed when it was written, with 'batched' the file system of the
+        destination is flushed first (syncfs).
+
+        :param results: results of _process_file() so far
+        :param fanout: FanOut that wrote the files or None
+        :param keys: in_filenames of all changed entries if only they have
+            to be stored (watch mode, see HashDb.store())
+        """
+        if fanout is None:
+            written = [[r[0][:3] + r[0][4:] for r in results
+                        if r[0] is not None]]
+        else:
+            # Copy first, the writer threads continue to append
+            written = [list(file_hashes) for file_hashes in fanout.written]
+        for destination, file_hashes in zip(self._get_destinations(),
+                                            written):
+            if self._args.durability == 'batched':
+                with self.stats.stage('flush'):
+                    util.syncfs(destination._args.audio_dest)
+            replaced = []
+            for file_hash in file_hashes:
+                # (out_filename, hash, output size, output digest)
+                previous = destination._hashdb.database.get(file_hash[0])
+                destination._hashdb.database[file_hash[0]] = file_hash[1:]
+                if previous is not None and previous[0] != file_hash[1]:
+                    replaced.append(previous[0])
+            destination._hashdb.store(
+                sync=self._args.durability != 'none', keys=keys)
+            # Outputs that got another name (e.g. after changing the codec)
+            # are removed once the database references the new outputs
+            destination._remove_replaced_files(replaced)
+
+    def _remove_replaced_files(self, out_filenames):
+        """Remove outputs that have been replaced by outputs of another name.
+
+        :param out_filenames: relative paths of the replaced outputs
+        """
+        for out_filename in out_filenames:
+            out_filepath = os.path.join(self._args.audio_dest, out_filename)
+            logger.info("Removing replaced file {}", out_filename)
+            try:
+                os.remove(out_filepath)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                logger.error("Error: Failed to remove file {}", err)
+                continue
+            self._touched_directories.add(os.path.dirname(out_filepath))
+        util.prune_empty_directories(self._touched_directories,
+                                     self._args.audio_dest)
+        self._touched_directories.clear()
+
+    def _log_copies(self):
+        """Log how the copied files were written (see copy_file())."""
+        counters = self.stats.counters
+        if not any(counters.get(name) for name in
+                   ['bytes_copied', 'bytes_cloned', 'bytes_linked']):
+            return
+        logger.info("Copies: {:.1f} MB copied, {:.1f} MB cloned, {:.1f} MB "
+                    "hard linked", counters.get('bytes_copied', 0) / 1e6,
+                    counters.get('bytes_cloned', 0) / 1e6,
+                    counters.get('bytes_linked', 0) / 1e6)
+
+    def _log_avoided_encodes(self):
+        """Log the encodes of MP3s that were copied instead.
+
+        The saved time is estimated from the transcode throughput of this
+        and previous runs.
+        """
+        count = self.stats.counters.get('encodes_avoided')
+        if not count:
+            return
+        nbytes = self.stats.counters['encodes_avoided_bytes']
+        throughput = plan.get_throughput(
+            plan.load_history(self._history_path), 'transcode')
+        saved = "unknown"
+        if throughput is not None:
+            self.stats.count('encodes_avoided_seconds', nbytes / throughput)
+            saved = progress.format_duration(nbytes / throughput)
+        logger.info("Copied {} MP3s at or below the target bitrate instead "
+                    "of encoding them ({:.1f} MB, CPU time saved: {})",
+                    count, nbytes / 1e6, saved)
+
+    def _process_files(self, files, fanout=None):
+        """Process files in parallel.
+
+        :param fanout: FanOut that limits the number of files processed
+            ahead of the slowest destination
+        :returns: iterator over the results of _process_file() in the order
+            of completion
+        """
+        # Small chunks keep the progress up to date, the overhead per chunk
+        # is low as the SyncMusic instance is passed to the workers only once
+        jobs = self._get_jobs()
+        chunksize = max(1, len(files) // (jobs * 64))
+        if fanout is not None:
+            # The chunks are collected before they are processed, larger
+            # chunks than the buffer would never be complete
+            chunksize = min(chunksize, self._args.destination_buffer)
+            files = fanout.throttle(files)
+        if jobs == 1:
+            # pool.map doesn't might not show all exceptions
+            for current_file in files:
+                yield self._process_file(current_file)
+            return
+
+        with util.log_listener() as log_args, \
+                Pool(processes=jobs, initializer=_init_worker,
+                     initargs=(self, log_args)) as pool:
+            yield from pool.imap_unordered(_process_file_in_worker, files,
+                                           chunksize)
+            # Let the workers exit to flush their log records
+            pool.close()
+            pool.join()
+
+    def _analyze_albums(self, files):
+        """Measure the album gain of the albums with changed files.
+
+        The files of a directory form an album. The tracks are analysed in
+        parallel, the results are cached by their hash, size and modification
+        time in sync_music_loudness.db of the (first) destination.
+
+        :param files: list of tuples (in_filename, action, planned_hash)
+        :returns: dict mapping the input files to tuples (gain, peak)
+        """
+        if (self._args.mode != 'replaygain-album' or
+                self._args.disable_file_processing):
+            return {}
+        if not loudness.available():
+            logger.info("NumPy is not installed, using the album gain from "
+                        "the tags")
+            return {}
+        with self.stats.stage('analyze'):
+            return self._analyze_changed_albums(files)
+
+    def _analyze_changed_albums(self, files):
+        """Measure the album gain (see _analyze_albums())."""
+        # Albums with changed files are analysed completely
+        changed = set()
+        for in_filename, action, planned_hash in files:
+            if action is not self._action_transcode:
+                continue
+            album = os.path.dirname(in_filename)
+            if album in changed:
+                continue
+            if planned_hash is not None or any(
+                    destination._is_changed(
+                        in_filename, util.correct_path_fat32(
+                            action.get_out_filename(in_filename)),
+                        self._hashdb.get_hash(os.path.join(
+                            self._args.audio_src, in_filename)))
+                    for destination in self._get_destinations()):
+                changed.add(album)
+        albums = {}
+        hashes = {}
+        for album in changed:
+            path = os.path.join(self._args.audio_src, album)
+            albums[album] = sorted(
+                os.path.join(album, entry.name) for entry in os.scandir(path)
+                if entry.is_file() and self._get_file_action(
+                    os.path.join(album, entry.name)) is self._action_transcode)
+            for in_filename in albums[album]:
+                hashes[in_filename] = self._get_loudness_key(in_filename)
+
+        self._loudnessdb.load()
+        cache = self._loudnessdb.database
+        missing = [in_filename for album in sorted(changed)
+                   for in_filename in albums[album]
+                   if hashes[in_filename] not in cache]
+        if missing:
+            logger.info("Analysing loudness of {} files", len(missing))
+        analysis_stats = RunStats()
+        for in_filename, (result, file_stats) in zip(
+                missing, self._analyze_files(missing)):
+            analysis_stats.merge(file_stats)
+            if result is not None:
+                cache[hashes[in_filename]] = result
+        self.stats.merge(analysis_stats)
+        seconds = sum(analysis_stats.durations.get('loudness', []))
+        if seconds:
+            logger.info("Analysed {:.0f}s of audio at {:.0f}x realtime",
+                        analysis_stats.counters['audio_seconds_analyzed'],
+                        analysis_stats.counters['audio_seconds_analyzed'] /
+                        seconds)
+
+        # Only keep the results of files that are still synced (the database
+        # is complete unless only a part of the library is synced)
+        if not self._args.only:
+            valid = {entry[1] for entry in self._hashdb.database.values()}
+            self._loudnessdb.database = {
+                key: value for key, value in cache.items()
+                if key in hashes.values() or (
+                    ':' in key and key.partition(':')[0] in valid)}
+        if missing or len(cache) != len(self._loudnessdb.database):
+            self._loudnessdb.store()
+
+        album_gains = {}
+        for album in changed:
+            results = [cache.get(hashes[f]) for f in albums[album]]
+            if None in results:
+                continue  # Fall back to the tags
+            gain = loudness.get_gain(loudness.combine(results))
+            if gain is not None:
+                album_gains.update(dict.fromkeys(albums[album], gain))
+        return album_gains
+
+    def _get_loudness_key(self, in_filename):
+        """Get the key of a file in the loudness cache.
+
+        The hash only covers the beginning of the file, the size and the
+        modification time detect changes of the audio after it.
+        """
+        in_filepath = os.path.join(self._args.audio_src, in_filename)
+        stat = os.stat(in_filepath)
+        return '{}:{}:{}'.format(self._hashdb.get_hash(in_filepath),
+                                 stat.st_size, stat.st_mtime_ns)
+
+    def _analyze_files(self, in_filenames):
+        """Analyse the loudness of files in parallel.
+
+        :returns: list of the results of _analyze_file()
+        """
+        if self._args.jobs == 1 or len(in_filenames) < 2:
+            return [self._analyze_file(f) for f in in_filenames]
+        with util.log_listener() as log_args, \
+                Pool(processes=self._args.jobs, initializer=_init_worker,
+                     initargs=(self, log_args)) as pool:
+            results = pool.map(_analyze_file_in_worker, in_filenames)
+            # Let the workers exit to flush their log records
+            pool.close()
+            pool.join()
+        return results
+
+    def _analyze_file(self, in_filename):
+        """Analyse the loudness of a single file.
+
+        :returns: tuple (result, file_stats), the result is None if the file
+            can't be decoded (see loudness.analyze_samples())
+        """
+        from pydub import exceptions  # pylint: disable=import-outside-toplevel
+        with stats.collect() as file_stats:
+            try:
+                result = loudness.analyze_file(
+                    os.path.join(self._args.audio_src, in_filename))
+            except (exceptions.CouldntDecodeError, OSError) as err:
+                logger.error("Error: Failed to analyse {}: {}",
+                             in_filename, err)
+                result = None
+        return result, file_stats
+
+    def _get_jobs(self):
+        """Get the number of worker processes.
+
+        Processes that wait for remote workers are added to the local jobs.
+        """
+        if self._remote is None:
+            return self._args.jobs
+        return self._args.jobs + self._remote.remote_slots
+
+    def _create_progress(self, total):
+        """Create the progress of processing files.
+
+        The live status line is only shown if requested and the console
+        handler writes to a terminal.
+        """
+        status_handler = None
+        if self._args.progress:
+            for handler in logging.getLogger().handlers:
+                if (isinstance(handler, progress.StatusHandler) and
+                        handler.stream.isatty()):
+                    status_handler = handler
+        return progress.Progress(total, status_handler)
+
+    def write_reports(self):
+        """Write the run statistics to the requested report files."""
+        if self._args.report:
+            logger.info("Writing run report to {}", self._args.report)
+            self.stats.write_json(self._args.report)
+        if self._args.prometheus:
+            logger.info("Writing Prometheus metrics to {}",
+                        self._args.prometheus)
+            self.stats.write_prometheus(self._args.prometheus)
+        if self._args.trace:
+            logger.info("Writing trace to {}", self._args.trace)
+            self.stats.write_trace(self._args.trace)
+        if self._args.profile:
+            profiling.dump_profile()
+            path = profiling.merge_profiles(self._args.profile)
+            logger.info("Writing profile to {}", path)
+        if self._args.profile_memory:
+            path = os.path.join(self._args.profile, 'memory.txt')
+            logger.info("Writing memory profile to {}", path)
+            profiling.write_memory_report(path, self.stats.memory)
+
+    def sync_playlists(self, filenames=None):
+        """Sync m3u playlists.
+
+        Playlists are only rewritten if their content or the output paths of
+        the files they reference changed since the last run.
+
+        :param filenames: only sync these playlists (relative to
+            --playlist-src), e.g. the changed ones in watch mode
+        """
+        with self._profile():
+            for destination in self._get_all_destinations():
+                destination._sync_playlists(filenames)
+
+    def _sync_playlists(self, filenames=None):
+        """Sync m3u playlists (see sync_playlists())."""
+        index = PathSuffixIndex(self._hashdb.database)
+        self._playlistdb.load()
+        if filenames is None:
+            playlists = []
+            for dirpath, _, names in os.walk(self._args.playlist_src):
+                relpath = os.path.relpath(dirpath, self._args.playlist_src)
+                for filename in names:
+                    if os.path.splitext(filename)[1] == '.m3u':
+                        playlists.append(
+                            os.path.normpath(os.path.join(relpath, filename)))
+            database = {}
+        else:
+            playlists = sorted(
+                f for f in filenames if os.path.splitext(f)[1] == '.m3u' and
+                os.path.isfile(os.path.join(self._args.playlist_src, f)))
+            database = {filename: fingerprint for filename, fingerprint
+                        in self._playlistdb.database.items()
+                        if filename not in filenames}
+
+        with self.stats.stage('playlists'), \
+                ThreadPool(processes=self._args.jobs) as pool:
+            fingerprints = pool.map(
+                functools.partial(self._sync_playlist, index=index),
+                playlists)
+        database.update(
+            (filename, fingerprint)
+            for filename, fingerprint in zip(playlists, fingerprints)
+            if fingerprint is not None)
+        self._playlistdb.database = database
+        if self._args.durability == 'batched':
+            util.syncfs(self._args.audio_dest)
+        self._playlistdb.store(sync=self._args.durability != 'none')
 
-    def sync_playlists(self):
-        """Sync m3u playlists."""
-        for dirpath, _, filenames in os.walk(self._args.playlist_src):
-            relpath = os.path.relpath(dirpath, self._args.playlist_src)
-            for filename in filenames:
-                if os.path.splitext(filename)[1] == '.m3u':
-                    try:
-                        self._sync_playlist(
-                            os.path.normpath(
-                                os.path.join(relpath, filename)))
-                    except IOError as err:
-                        logger.error("Error: {}", err)
-
-    def _sync_playlist(self, filename):
-        """Sync playlist."""
-        logger.info("Syncing playlist {}", filename)
+    def _sync_playlist(self, filename, index):
+        """Sync playlist.
+
+        :param index: PathSuffixIndex of the files in the hash database
+        :returns: fingerprint of the playlist or None on errors
+        """
         srcpath = os.path.join(self._args.playlist_src, filename)
         destpath = os.path.join(self._args.audio_dest, filename)
+        try:
+            fingerprint = self._get_playlist_fingerprint(srcpath, index)
+            if (not self._args.force and os.path.exists(destpath) and
+                    self._playlistdb.database.get(filename) == fingerprint):
+                logger.info("Skipping up to date playlist {}", filename)
+                return fingerprint
+
+            # Write to a temporary file first to never leave a partially
+            # written playlist behind
+            logger.info("Syncing playlist {}", filename)
+            util.ensure_directory_exists(os.path.dirname(destpath))
+            temppath = os.path.join(os.path.dirname(destpath),
+                                    '.' + os.path.basename(destpath) + '.tmp')
+            lines = self._convert_playlist(srcpath, index, report=True)
+            with codecs.open(temppath, 'w', 'windows-1252') as out_file:
+                for line, out_line in lines:
+                    if out_line is None:
+                        logger.warning("File does not exist: {}", line)
+                        continue
+                    out_file.write(out_line + '\r\n')
+            os.replace(temppath, destpath)
+            if self._args.durability == 'per-file':
+                util.fsync_file(destpath)
+        except IOError as err:
+            logger.error("Error: {}", err)
+            return None
+        return fingerprint
 
-        if os.path.exists(destpath):
-            os.remove(destpath)
-
-        # Copy file
-        with codecs.open(srcpath, 'r', encoding='windows-1252') as in_file:
-            with codecs.open(destpath, 'w', encoding='windows-1252') as out_file:
-                for line in in_file.read().splitlines():
-                    if not line.startswith('#EXT'):
-                        in_filename = line
-                        try:
-                            while True:
-                                if in_filename in self._hashdb.database:
-                                    line = self._hashdb.database[in_filename][0]
-                                    line = line.replace('/', '\\')
-                                    break
-                                in_filename = in_filename.split('/', 1)[1]
-                        except IndexError:
-                            logger.warning("File does not exist: {}", line)
-                            continue
-                    line = line + '\r\n'
-                    out_file.write(line)
+    def _get_playlist_fingerprint(self, srcpath, index):
+        """Hash the playlist content and the resolved output paths."""
+        content_hash = hashlib.md5()
+        output_hash = hashlib.md5()
+        for line, out_line in self._convert_playlist(srcpath, index):
+            content_hash.update(line.encode() + b'\n')
+            output_hash.update(b'\0' if out_line is None
+                               else out_line.encode() + b'\n')
+        return (content_hash.hexdigest(), output_hash.hexdigest())
+
+    def _convert_playlist(self, srcpath, index, report=False):
+        """Iterate over the playlist lines with their output replacements.
+
+        :returns: iterator of tuples (line, out_line), out_line is None if
+            the file referenced by the line isn't in the hash database
+        """
+        for line in read_playlist(srcpath):
+            if line.startswith('#EXT'):
+                yield line, line
+                continue
+            matches = index.resolve(line)
+            if not matches:
+                yield line, None
+                continue
+            if report and len(matches) > 1:
+                logger.warning("Ambiguous file {}, using {} instead of {}",
+                               line, matches[0], ", ".join(matches[1:]))
+            yield line, self._hashdb.database[matches[0]][0].replace('/', '\\')
+
+    def create_watcher(self):
+        """Watch the sources for changes (see watch()).
+
+        The watcher is created before the first sync, so that changes during
+        the sync are synced afterwards.
+        """
+        roots = [self._args.audio_src]
+        if self._args.playlist_src:
+            roots.append(self._args.playlist_src)
+        return watch.Watcher(roots)
+
+    def watch(self, watcher):
+        """Sync the changes reported by the watcher until interrupted.
+
+        The databases and the list of the source files stay in memory. Once
+        nothing changed for --watch-delay seconds, only the directories with
+        changed files and the changed playlists are synced.
+        """
+        logger.info("Watching for changes (stop with Ctrl+C)")
+        try:
+            while True:
+                changes = watcher.wait(self._args.watch_delay)
+                if changes is not None and not changes:
+                    continue
+                # Every sync gets its own statistics and reports
+                self.stats = RunStats(trace=self._args.trace is not None,
+                                      memory=self._args.profile_memory)
+                for destination in self._get_all_destinations():
+                    destination.stats = self.stats
+                with self._profile():
+                    self._sync_changes(changes)
+                self.write_reports()
+                logger.info("Watching for changes (stop with Ctrl+C)")
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        finally:
+            watcher.close()
+
+    def _sync_changes(self, changes):
+        """Sync the changes reported by the watcher (see watch()).
+
+        :param changes: set of changed absolute paths or None if everything
+            has to be synced again
+        """
+        paths, playlists = set(), set()
+        playlist_src = os.path.join(self._args.playlist_src or '', '')
+        for path in changes if changes is not None else []:
+            if (self._args.playlist_src and
+                    os.path.splitext(path)[1] == '.m3u' and
+                    path.startswith(playlist_src)):
+                playlists.add(os.path.relpath(path, self._args.playlist_src))
+            elif path.startswith(os.path.join(self._args.audio_src, '')):
+                path = os.path.relpath(path, self._args.audio_src)
+                # Hidden files are never synced (e.g. temporary files)
+                if not any(part.startswith('.') for part in path.split('/')):
+                    paths.add(path)
+
+        # Events were lost or playlists select the files to sync
+        if changes is None or (self._args.playlist_selection and playlists):
+            logger.info("Syncing everything again")
+            for sync in self._get_syncs():
+                sync._sync_audio(None)
+            if self._args.playlist_src:
+                for destination in self._get_all_destinations():
+                    destination._sync_playlists()
+            return
+
+        if paths:
+            logger.info("Syncing {} changed files", len(paths))
+            changes = self._update_index(paths)
+            for sync in self._get_syncs():
+                sync._sync_audio(None, changes=changes)
+        if self._args.playlist_src and (paths or playlists):
+            # Added or removed files change the playlists that reference
+            # them, unchanged playlists are skipped by their fingerprint
+            for destination in self._get_all_destinations():
+                destination._sync_playlists(None if paths else playlists)
+
+    def _update_index(self, paths):
+        """Update the source files of the directories with changed paths.
+
+        All files in these directories are synced again, unchanged ones are
+        skipped by their hash. This keeps the selection of the folder.jpg
+        files of selected directories correct.
+
+        :param paths: changed paths relative to --audio-src
+        :returns: tuple (in_filenames, missing) with the files to sync in
+            these directories and the files that were removed from them
+        """
+        directories = {os.path.dirname(path) for path in paths}
+        removed = {path for path in paths if not os.path.exists(
+            os.path.join(self._args.audio_src, path))}
+        if removed:
+            # A removed directory removes all directories below it
+            for directory in self._index:
+                parent = directory
+                while parent and parent not in removed:
+                    parent = os.path.dirname(parent)
+                if parent:
+                    directories.add(directory)
+
+        previous = {os.path.join(directory, name)
+                    for directory in directories
+                    for name in self._index.pop(directory, ())}
+        in_filenames = []
+        for directory in sorted(directories):
+            path = os.path.join(self._args.audio_src, directory)
+            if not os.path.isdir(path):
+                continue
+            with os.scandir(path) as entries:
+                in_filenames.extend(sorted(
+                    os.path.join(directory, entry.name) for entry in entries
+                    if entry.is_file() and not entry.name.startswith('.')))
+        # Only the catalog entries of these files have to be checked
+        removed = (previous | removed) - set(in_filenames)
+        if self._args.playlist_selection:
+            selection = select_playlist_files(self._args.playlist_src,
+                                              self._args.audio_src)
+            in_filenames = [f for f in in_filenames if f in selection]
+        if self._args.select:
+            in_filenames = self._select_files(in_filenames, removed)
+
+        for in_filename in in_filenames:
+            directory, name = os.path.split(in_filename)
+            self._index.setdefault(directory, set()).add(name)
+        return in_filenames, previous - set(in_filenames)
+
+
+def __getattr__(name):
+    """Determine the version only when it is requested (it is slow)."""
+    if name == '__version__':
+        return util.get_package_version('sync-music')
+    raise AttributeError(name)
+
+
+class VersionAction(argparse.Action):
+    """Version action that determines the version only when it is shown."""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        # pylint: disable=redefined-builtin
+        super().__init__(option_strings=option_strings, dest=dest,
+                         default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        sys.stdout.write('{} {}\n'.format(
+            parser.prog, util.get_package_version('sync-music')))
+        parser.exit()
 
 
 def load_settings(arguments=None):  # pylint: disable=too-many-locals
@@ -257,24 +1379,82 @@ def load_settings(arguments=None):  # pylint: disable=too-many-locals
     parser = argparse.ArgumentParser(parents=[config_parser])
     parser.set_defaults(**defaults)
     parser.add_argument(
-        '-v', '--version', action='version',
-        version='%(prog)s {}'.format(__version__))
+        '-v', '--version', action=VersionAction)
     parser.add_argument(
         '-b', '--batch', action='store_true', help="batch mode, no user input")
     parser.add_argument(
         '-o', '--logfile', type=str, default='./sync_music.log',
         help="write log output to file")
+    parser.add_argument(
+        '--progress', action='store_true',
+        help="show a live progress line with throughput and ETA instead of "
+             "logging the progress every 10 seconds")
+    parser.add_argument(
+        '--plan', type=str, metavar='FILE',
+        help="dry run: detect the changes without writing anything, show "
+             "the work per action with estimated output size and duration "
+             "and write it as JSON")
+    parser.add_argument(
+        '--execute-plan', type=str, metavar='FILE',
+        help="execute a plan written by --plan without scanning the "
+             "source again")
+    parser.add_argument(
+        '--watch', action='store_true',
+        help="keep running after the sync and sync changed files and "
+             "playlists as soon as they are written (Linux only)")
+    parser.add_argument(
+        '--watch-delay', type=float, default=2, metavar='SECONDS',
+        help="with --watch, sync the changes once nothing changed for this "
+             "long, e.g. while a tagger rewrites an album (default 2)")
+    parser.add_argument(
+        '--report', type=str, metavar='FILE',
+        help="write run statistics (time per stage, throughput) as JSON")
+    parser.add_argument(
+        '--prometheus', type=str, metavar='FILE',
+        help="write run statistics for the Prometheus textfile collector")
+    parser.add_argument(
+        '--trace', type=str, metavar='FILE',
+        help="write a timeline of all file actions and stages in the Chrome "
+             "Trace Event format (for chrome://tracing or Perfetto)")
+    parser.add_argument(
+        '--profile', type=str, metavar='DIR',
+        help="profile the main and all worker processes with cProfile and "
+             "write the merged statistics to DIR/sync_music.pstats")
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help="additionally trace memory allocations per stage with "
+             "tracemalloc and write them to DIR/memory.txt (slow)")
 
     parser_paths = parser.add_argument_group("Paths")
     parser_paths.add_argument(
         '--audio-src', type=str, required='audio_src' not in defaults,
         help="folder containing the audio sources")
     parser_paths.add_argument(
-        '--audio-dest', type=str, required='audio_dest' not in defaults,
-        help="target directory for converted files")
+        '--audio-dest', type=str, nargs='+',
+        required='audio_dest' not in defaults,
+        help="target directory for converted files, files are processed "
+             "once for several target directories")
+    parser_paths.add_argument(
+        '--only', type=str, nargs='+', metavar='PATH',
+        help="only sync these files or directories (relative to "
+             "--audio-src), e.g. a new album; the rest of the destination "
+             "and its database is left untouched and playlists are not "
+             "synced")
     parser_paths.add_argument(
         '--playlist-src', type=str,
         help='folder containing the source playlists')
+    parser_paths.add_argument(
+        '--playlist-selection', action='store_true',
+        help="only sync the files referenced by the playlists in "
+             "--playlist-src (and their folder.jpg), remove all other files "
+             "from the destination")
+    parser_paths.add_argument(
+        '--select', type=str, metavar='QUERY',
+        help="only sync the audio files whose tags match the query (and "
+             "their folder.jpg), remove all other files from the "
+             "destination, e.g. 'genre == \"jazz\" and year >= 1990 or "
+             "rating >= 4'; fields: {} (tags are cached in "
+             "sync_music_catalog.db)".format(", ".join(catalog.FIELDS)))
 
     # Audio sync options
     parser_audio = parser.add_argument_group("Transcoding options")
@@ -283,7 +1463,8 @@ def load_settings(arguments=None):  # pylint: disable=too-many-locals
         choices=['auto', 'transcode', 'replaygain', 'replaygain-album',
                  'copy'],
         default='auto',
-        help="auto: copy MP3s, transcode others and adapt tags (default); "
+        help="auto: copy files in the target codec (e.g. MP3s), transcode "
+             "others and adapt tags (default); "
              "transcode: transcode all files and adapt tags (slow); "
              "replaygain: transcode all files, apply ReplayGain track based "
              "normalization and adapt tags (slow), "
@@ -291,11 +1472,17 @@ def load_settings(arguments=None):  # pylint: disable=too-many-locals
              "based normalization and adapt tags (slow), "
              "copy: copy all files, leave tags untouched (implies "
              "--disable-tag-processing)")
+    parser_audio.add_argument(
+        '--codec', type=str, nargs='+', metavar='CODEC[:BITRATE]',
+        default=['mp3'],
+        help="codec of the transcoded files ({}) with an optional bitrate "
+             "instead of --bitrate, one for all or one per --audio-dest "
+             "(default mp3); opus and aac need about half the bitrate of "
+             "mp3 for the same quality, e.g. opus:96".format(
+                 ", ".join(PROFILES)))
     parser_audio.add_argument(
         '--bitrate',
-        choices=['8', '16', '24', '32', '40', '48', '64',
-                 '80', '96', '112', '128', '160',
-                 '192', '224', '256', '320'],
+        choices=BITRATES,
         default='192',
         help="Desired bitrate for the transcoded files (number in kbit/s); "
              "see https://trac.ffmpeg.org/wiki/Encode/MP3 for further information")
@@ -323,8 +1510,61 @@ def load_settings(arguments=None):  # pylint: disable=too-many-locals
     parser_audio.add_argument(
         '-f', '--force', action='store_true',
         help="rerun action even if the source file has not changed")
+    parser_audio.add_argument(
+        '--rebuild-db', action='store_true',
+        help="rebuild a lost or corrupted hash database from the files in "
+             "the destination before syncing, instead of processing all "
+             "files again")
+    parser_audio.add_argument(
+        '--verify', type=float, nargs='?', const=1.0, metavar='FRACTION',
+        help="read all files in the destination again before syncing and "
+             "create missing, truncated or corrupted files again; check "
+             "only a random FRACTION of the files for a quick check "
+             "(e.g. 0.1)")
+    parser_audio.add_argument(
+        '--full-directory-cleanup', action='store_true',
+        help="check the whole destination for empty directories instead of "
+             "only the directories of removed files (slow on large devices)")
+    parser_audio.add_argument(
+        '--copy-strategy', choices=COPY_STRATEGIES, default='auto',
+        help="auto: clone copied files if the file systems support it "
+             "(copy-on-write, e.g. btrfs, XFS), otherwise copy them "
+             "(default); hardlink: create hard links for files that are "
+             "copied unmodified if source and destination are on the same "
+             "file system, otherwise like auto; copy: always copy all "
+             "bytes")
+    parser_audio.add_argument(
+        '--durability', choices=['none', 'batched', 'per-file'],
+        default='none',
+        help="none: leave flushing the written files to the operating "
+             "system (default, fast, files may be lost if the device is "
+             "removed without unmounting it); batched: flush the file "
+             "system of the destination every --checkpoint-interval seconds "
+             "and at the end, the database only references flushed files; "
+             "per-file: flush every file after writing it (slow on FAT32)")
+    parser_audio.add_argument(
+        '--checkpoint-interval', type=float, default=30, metavar='SECONDS',
+        help="interval of the flushes with --durability batched (default "
+             "30)")
     parser_audio.add_argument(
         '-j', '--jobs', type=int, default=4, help="number of parallel jobs")
+    parser_audio.add_argument(
+        '--destination-buffer', type=int, default=16, metavar='FILES',
+        help="number of processed files that may wait for slower target "
+             "directories when syncing to several (default 16)")
+    parser_audio.add_argument(
+        '--remote-worker', type=str, nargs='+', metavar='HOST:PORT',
+        help="additionally transcode on remote workers started with "
+             "'sync_music worker --listen HOST:PORT', files are distributed "
+             "by the observed throughput")
+    parser_audio.add_argument(
+        '--remote-shared-paths', action='store_true',
+        help="the remote workers can read the source files at the same "
+             "paths (e.g. network share), send paths instead of the files")
+    parser_audio.add_argument(
+        '--remote-secret-file', type=str, metavar='FILE',
+        help="file containing the shared secret of the remote workers "
+             "(see 'sync_music worker --secret-file')")
 
     # Optons for action transcode
     parser_hacks = parser.add_argument_group(
@@ -357,12 +1597,106 @@ def load_settings(arguments=None):  # pylint: disable=too-many-locals
                                         settings.discnumber_hack or
                                         settings.tracknumber_hack):
             parser.error("hacks cannot be used in copy mode")
-        paths = ['audio_src', 'audio_dest']
+        if settings.playlist_selection and settings.playlist_src is None:
+            parser.error("--playlist-selection requires --playlist-src")
+        if settings.profile_memory and settings.profile is None:
+            parser.error("--profile-memory requires --profile")
+        if settings.plan is not None and settings.execute_plan is not None:
+            parser.error("--plan cannot be used with --execute-plan")
+        if settings.plan is not None and settings.rebuild_db:
+            parser.error("--plan cannot be used with --rebuild-db")
+        if settings.verify is not None:
+            if settings.plan is not None or settings.execute_plan is not None:
+                parser.error("--verify cannot be used with --plan or "
+                             "--execute-plan")
+            if not 0 < settings.verify <= 1:
+                parser.error("--verify requires a fraction between 0 and 1")
+        if settings.watch and (settings.plan is not None or
+                               settings.execute_plan is not None or
+                               settings.only is not None):
+            parser.error("--watch cannot be used with --plan, --execute-plan "
+                         "or --only")
+        if settings.watch_delay < 0:
+            parser.error("--watch-delay must not be negative")
+        if settings.select is not None:
+            try:
+                catalog.Query(settings.select)
+            except ValueError as err:
+                parser.error("--select: {}".format(err))
+        if settings.only is not None:
+            if settings.playlist_selection or settings.rebuild_db:
+                parser.error("--only cannot be used with "
+                             "--playlist-selection or --rebuild-db")
+            settings.only = [os.path.normpath(path).strip('/')
+                             for path in settings.only]
+            for path in settings.only:
+                if path in ['', '.'] or path.split('/')[0] == '..':
+                    parser.error("--only requires paths inside of "
+                                 "--audio-src, got {}".format(path))
+        if settings.profile is not None:
+            settings.profile = util.makepath(settings.profile)
+            util.ensure_directory_exists(settings.profile)
+
+        # Several destinations are given on separate lines in config files
+        if isinstance(settings.audio_dest, str):
+            settings.audio_dest = [line.strip() for line
+                                   in settings.audio_dest.splitlines()
+                                   if line.strip()]
+        settings.audio_dests = [util.makepath(audio_dest)
+                                for audio_dest in settings.audio_dest]
+        settings.audio_dest = settings.audio_dests[0]
+        if len(set(settings.audio_dests)) != len(settings.audio_dests):
+            parser.error("--audio-dest contains a directory twice")
+        if isinstance(settings.codec, str):
+            settings.codec = settings.codec.split()
+        for codec in settings.codec:
+            name, _, bitrate = codec.partition(':')
+            if name not in PROFILES or (bitrate and bitrate not in BITRATES):
+                parser.error("invalid --codec {}, expected one of {} with an "
+                             "optional bitrate, e.g. opus:96".format(
+                                 codec, ", ".join(PROFILES)))
+            if (settings.varbitrate is not None and not bitrate and
+                    PROFILES[name].qualities is None):
+                parser.error("--varbitrate is not supported by --codec {}, "
+                             "give it a bitrate instead".format(name))
+        if len(settings.codec) == 1:
+            settings.codec = settings.codec * len(settings.audio_dests)
+        elif len(settings.codec) != len(settings.audio_dests):
+            parser.error("--codec requires one codec for all or one per "
+                         "--audio-dest")
+        if len(settings.audio_dests) > 1 and (settings.plan or
+                                              settings.execute_plan):
+            parser.error("--plan and --execute-plan only support a single "
+                         "--audio-dest")
+        if settings.destination_buffer < 1:
+            parser.error("--destination-buffer must be at least 1")
+        if settings.checkpoint_interval < 0:
+            parser.error("--checkpoint-interval must not be negative")
+        if isinstance(settings.remote_worker, str):
+            settings.remote_worker = settings.remote_worker.split()
+        for address in settings.remote_worker or []:
+            try:
+                remote.parse_address(address)
+            except ValueError:
+                parser.error("invalid --remote-worker {}, expected "
+                             "HOST:PORT".format(address))
+        settings.remote_secret = None
+        if settings.remote_secret_file is not None:
+            try:
+                settings.remote_secret = remote.read_secret(
+                    settings.remote_secret_file)
+            except (OSError, ValueError) as err:
+                parser.error(err)
+
+        paths = ['audio_src']
         if settings.playlist_src is not None:
             paths.append('playlist_src')
         settings_dict = vars(settings)
-        util.ensure_directory_exists(
-            util.makepath(settings_dict['audio_dest']))
+        if settings.plan is None:  # A dry run doesn't create the destination
+            for audio_dest in settings.audio_dests:
+                util.ensure_directory_exists(audio_dest)
+                if not os.path.isdir(audio_dest):
+                    raise IOError("{} is not a directory".format(audio_dest))
         for path in paths:
             settings_dict[path] = util.makepath(settings_dict[path])
             if not os.path.isdir(settings_dict[path]):
@@ -376,12 +1710,15 @@ def load_settings(arguments=None):  # pylint: disable=too-many-locals
 
 def main():  # pragma: no cover
     """sync_music - Sync music library to external device."""
+    if sys.argv[1:2] == ['worker']:
+        remote.main(sys.argv[2:])
+        return
     args = load_settings()
 
     rootlogger = logging.getLogger()
     rootlogger.setLevel(logging.DEBUG)
 
-    consolelogger = logging.StreamHandler(sys.stdout)
+    consolelogger = progress.StatusHandler(sys.stdout)
     consolelogger.setLevel(logging.INFO)
     consolelogger.setFormatter(logging.Formatter("{message}", style='{'))
     rootlogger.addHandler(consolelogger)
@@ -395,14 +1732,45 @@ def main():  # pragma: no cover
 
     sync_music = SyncMusic(args)
 
+    if args.plan:
+        try:
+            plan.write_plan(args.plan, sync_music.plan_audio())
+        except FileNotFoundError as err:
+            logger.critical("Failed to plan sync {}", err)
+            sys.exit(1)
+        sync_music.write_reports()
+        return
+
     if not args.batch and not util.query_yes_no("Do you want to continue?"):
         sys.exit(1)
 
+    watcher = None
+    if args.watch:
+        try:
+            watcher = sync_music.create_watcher()
+        except OSError as err:
+            logger.critical("Failed to watch the sources {}", err)
+            sys.exit(1)
+
     try:
-        sync_music.sync_audio()
-    except FileNotFoundError as err:
+        if args.rebuild_db:
+            sync_music.rebuild_db()
+        if args.verify is not None:
+            sync_music.verify_audio()
+        sync_plan = None
+        if args.execute_plan:
+            sync_plan = sync_music.read_plan(args.execute_plan)
+        sync_music.sync_audio(sync_plan)
+    except (FileNotFoundError, ValueError) as err:
         logger.critical("Failed to sync music {}", err)
         sys.exit(1)
 
-    if args.playlist_src:
+    if args.playlist_src and args.only:
+        logger.info("Skipping playlists (--only)")
+    elif args.playlist_src:
         sync_music.sync_playlists()
+
+    sync_music.write_reports()
+
+    if watcher is not None:
+        sync_music.watch(watcher)
@@ -15,23 +15,120 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-"""Transcode action."""
+"""Transcode action.
+
+The codec libraries (pydub, mutagen) are only imported when a file is
+actually processed to keep the startup fast, especially for runs without
+changes.
+"""
+
+# pylint: disable=import-outside-toplevel
 
 import base64
 import collections
+import hashlib
+import json
 import logging
+import math
 import os
-import shutil
-import pkg_resources
-
-from pydub import AudioSegment, exceptions
-import mutagen
 
+from . import loudness
+from . import stats
 from . import util
+from .actions import copy_file
 
 logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
     logging.getLogger(__name__))
 
+# Private ID3 frames describing the source of an output file, used to
+# rebuild a lost hash database from the destination (see read_source())
+SOURCE_FRAMES = ('sync_music_source', 'sync_music_hash', 'sync_music_settings')
+
+# Average bitrates and bitrate ranges of the LAME VBR quality levels
+LAME_QUALITIES = {
+    "0": ["245", "220-260"],
+    "1": ["225", "190-250"],
+    "2": ["190", "170-210"],
+    "3": ["175", "150-195"],
+    "4": ["165", "140-185"],
+    "5": ["130", "120-150"],
+    "6": ["115", "100-130"],
+    "7": ["100", "80-120"],
+    "8": ["85", "70-105"],
+    "9": ["65", "45-85"]
+}
+# Opus reaches the quality of the LAME levels at about half the bitrate, its
+# VBR mode varies the bitrate around the given average (no fixed range)
+OPUS_QUALITIES = {
+    "0": ["128", None],
+    "1": ["112", None],
+    "2": ["96", None],
+    "3": ["88", None],
+    "4": ["80", None],
+    "5": ["64", None],
+    "6": ["56", None],
+    "7": ["48", None],
+    "8": ["40", None],
+    "9": ["32", None]
+}
+
+# Encoder profiles by codec: ffmpeg container and encoder with their
+# arguments, extension of the output files, source extensions that are
+# copied instead of encoded again, the tag format of the output files and
+# the VBR quality levels (None if --varbitrate isn't supported)
+Profile = collections.namedtuple('Profile', [
+    'container', 'encoder', 'parameters', 'extension', 'copied', 'tags',
+    'qualities'])
+PROFILES = {
+    'mp3': Profile('mp3', 'libmp3lame', [], 'mp3', ['.mp3'], 'id3',
+                   LAME_QUALITIES),
+    'opus': Profile('opus', 'libopus', ['-vbr', 'on'], 'opus', ['.opus'],
+                    'vorbis', OPUS_QUALITIES),
+    # M4A sources may be lossless (ALAC), they are always encoded. The VBR
+    # mode of the native AAC encoder is experimental.
+    'aac': Profile('ipod', 'aac', [], 'm4a', [], 'mp4', None),
+}
+
+# Tags are converted to ID3 first (hacks and ReplayGain apply to ID3), the
+# tag writers of the other formats use the inverse tables
+VORBIS_TO_ID3 = {
+    'album': 'TALB',
+    'artist': 'TPE1',
+    'albumartist': 'TPE2',
+    'title': 'TIT2',
+    'genre': 'TCON',
+    'date': 'TDRC',
+    'tracknumber': 'TRCK',
+    'discnumber': 'TPOS',
+    'MUSICBRAINZ_TRACKID': 'UFID:http://musicbrainz.org',
+    'MUSICBRAINZ_ARTISTID': 'TXXX:MusicBrainz Artist Id',
+    'MUSICBRAINZ_ALBUMARTISTID': 'TXXX:MusicBrainz Album Artist Id',
+    'MUSICBRAINZ_RELEASEGROUPID': 'TXXX:MusicBrainz Release Group Id',
+    'MUSICBRAINZ_ALBUMID': 'TXXX:MusicBrainz Album Id',
+    'MUSICBRAINZ_RELEASETRACKID': 'TXXX:MusicBrainz Release Track Id',
+    'replaygain_album_gain': 'TXXX:replaygain_album_gain',
+    'replaygain_album_peak': 'TXXX:replaygain_album_peak',
+    'replaygain_track_gain': 'TXXX:replaygain_track_gain',
+    'replaygain_track_peak': 'TXXX:replaygain_track_peak'
+}
+MP4_TO_ID3 = {
+    '\xa9alb': 'TALB',  # album
+    '\xa9ART': 'TPE1',  # artist
+    'aART': 'TPE2',  # albumartist
+    '\xa9nam': 'TIT2',  # title
+    '\xa9gen': 'TCON',  # genre
+    '\xa9day': 'TDRC',  # date
+    'trkn': 'TRCK',  # tracknumber
+    'disk': 'TPOS',  # disknumber
+    '\xa9wrt': 'TCOM',  # composer
+    '\xa9cmt': 'COMM'  # comment
+}
+ID3_TO_VORBIS = dict({key: tag for tag, key in VORBIS_TO_ID3.items()},
+                     TCOM='composer')
+ID3_TO_MP4 = {key: atom for atom, key in MP4_TO_ID3.items()}
+# Other TXXX frames are stored in freeform atoms (like MusicBrainz Picard)
+MP4_FREEFORM = '----:com.apple.iTunes:'
+
 
 class Transcode:  # pylint: disable=too-many-instance-attributes
     """Transcodes audio files."""
@@ -44,9 +141,35 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
                  albumartist_composer_hack=False,
                  artist_albumartist_hack=False,
                  discnumber_hack=False,
-                 tracknumber_hack=False):
+                 tracknumber_hack=False,
+                 copy_strategy='auto',
+                 codec='mp3'):
         self.name = "Processing"
-        self._format = "mp3"
+        self._copy_strategy = copy_strategy
+        # RemoteWorkers that transcode files (see remote module)
+        self.remote = None
+        self._remote_settings = {
+            'mode': mode, 'replaygain_preamp_gain': replaygain_preamp_gain,
+            'bitrate': bitrate, 'var_bitrate': var_bitrate}
+        settings = dict(
+            self._remote_settings, transcode=transcode,
+            albumartist_artist_hack=albumartist_artist_hack,
+            albumartist_composer_hack=albumartist_composer_hack,
+            artist_albumartist_hack=artist_albumartist_hack,
+            discnumber_hack=discnumber_hack,
+            tracknumber_hack=tracknumber_hack)
+        # MP3 outputs keep the fingerprint they had before profiles existed
+        if codec != 'mp3':
+            self._remote_settings['codec'] = codec
+            settings['codec'] = codec
+        # Outputs are only reused for the same settings (see read_source())
+        self.fingerprint = hashlib.md5(json.dumps(
+            settings, sort_keys=True).encode()).hexdigest()
+        self.profile = PROFILES[codec]
+        if var_bitrate is not None and self.profile.qualities is None:
+            raise ValueError("Codec {} doesn't support a variable bitrate"
+                             .format(codec))
+        self._format = self.profile.extension
         self._format_string = self._format
         self._bitrate = bitrate
         self._bitrate_string = self._bitrate
@@ -55,12 +178,9 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
         self.get_transcode_bitrate()
 
         logger.info("Transcoding settings:")
+        logger.info(" - Pydub {}".format(util.get_package_version("pydub")))
         logger.info(
-            " - Pydub {}".format(
-                pkg_resources.require("PyDub")[0].version))
-        logger.info(
-            " - Mutagen {}".format(
-                pkg_resources.require("mutagen")[0].version))
+            " - Mutagen {}".format(util.get_package_version("mutagen")))
         self._mode = mode
         self._transcode = transcode
         if transcode and mode in ['auto', 'transcode', 'replaygain',
@@ -104,55 +224,135 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
     def get_transcode_bitrate(self):
         """Select between CBR and VBR and set the displayed strings accordingly"""
         if self._var_bitrate is not None:
-            var_bitrate_dict = {
-                "0": ["245", "220-260"],
-                "1": ["225", "190-250"],
-                "2": ["190", "170-210"],
-                "3": ["175", "150-195"],
-                "4": ["165", "140-185"],
-                "5": ["130", "120-150"],
-                "6": ["115", "100-130"],
-                "7": ["100", "80-120"],
-                "8": ["85", "70-105"],
-                "9": ["65", "45-85"]
-            }
+            average, bitrate_range = \
+                self.profile.qualities[self._var_bitrate]
 
             self._bitrate = None
+            self._average_bitrate = int(average)
             self._format_string = self._format + " VBR"
 
             self._bitrate_string = \
-                "an average bitrate of {} kbit/s " \
-                "and a bitrate range between {} kbit/s".format(
-                    var_bitrate_dict[self._var_bitrate][0],
-                    var_bitrate_dict[self._var_bitrate][1])
+                "an average bitrate of {} kbit/s".format(average)
+            if bitrate_range is not None:
+                self._bitrate_string += \
+                    " and a bitrate range between {} kbit/s".format(
+                        bitrate_range)
         else:
             self._format_string = self._format + " CBR"
             self._bitrate_string = "a bitrate of of {} kbit/s".format(self._bitrate)
+            self._average_bitrate = int(self._bitrate)
             self._bitrate += 'k'
 
-    def execute(self, in_filepath, out_filepath):
-        """Executes action."""
+    def execute(self, in_filepath, out_filepath, source=None, gain=None):
+        """Executes action.
+
+        :param source: tuple (in_filename, hash) stored in the output file
+        :param gain: tuple (gain, peak) for the ReplayGain modes (see
+            transcode())
+        """
         if self._transcode:
             if self._mode == 'auto':
-                if (os.path.splitext(in_filepath)[1] !=
-                        '.' + self._format):
-                    self.transcode(in_filepath, out_filepath)
+                if (os.path.splitext(in_filepath)[1] not in
+                        self.profile.copied):
+                    self._transcode_file(in_filepath, out_filepath, gain)
                 else:
                     self.copy(in_filepath, out_filepath)
+            elif not self._needs_encode(in_filepath):
+                stats.count('encodes_avoided')
+                stats.count('encodes_avoided_bytes',
+                            os.path.getsize(in_filepath))
+                self.copy(in_filepath, out_filepath)
             elif self._mode in ['transcode', 'replaygain', 'replaygain-album']:
-                self.transcode(in_filepath, out_filepath)
+                self._transcode_file(in_filepath, out_filepath, gain)
 
         if self._copy_tags:
-            self.copy_tags(in_filepath, out_filepath)
+            self.copy_tags(in_filepath, out_filepath, source)
 
-    @classmethod
-    def copy(cls, in_filepath, out_filepath):
-        """Copying audio file."""
+    def _transcode_file(self, in_filepath, out_filepath, gain):
+        """Transcode locally or on a remote worker if configured."""
+        if self.remote is not None:
+            self.remote.transcode(self, in_filepath, out_filepath, gain)
+        else:
+            self.transcode(in_filepath, out_filepath, gain)
+
+    def get_remote_settings(self):
+        """Get the settings a remote worker needs to transcode files."""
+        return dict(self._remote_settings)
+
+    def plan(self, in_filepath, out_filepath):
+        """Describe the work execute() would do (see plan.create_plan()).
+
+        The size of transcoded files is estimated from the duration of the
+        input file and the (average) target bitrate.
+        """
+        import mutagen
+        action = 'tags'
+        if self._transcode:
+            if self._mode == 'auto':
+                if (os.path.splitext(in_filepath)[1] not in
+                        self.profile.copied):
+                    action = 'transcode'
+                else:
+                    action = 'copy'
+            elif not self._needs_encode(in_filepath):
+                action = 'copy'
+            elif self._mode in ['transcode', 'replaygain', 'replaygain-album']:
+                action = 'transcode'
+
+        out_bytes = os.path.getsize(in_filepath)
+        if action == 'transcode':
+            try:
+                in_file = mutagen.File(in_filepath)
+            except mutagen.MutagenError:
+                in_file = None
+            if in_file is not None:
+                out_bytes = int(in_file.info.length *
+                                self._average_bitrate * 1000 / 8)
+        elif action == 'tags' and os.path.exists(out_filepath):
+            out_bytes = os.path.getsize(out_filepath)
+        return {'action': action, 'tags': self._copy_tags,
+                'out_bytes': out_bytes}
+
+    def _needs_encode(self, in_filepath):
+        """Check whether a file has to be encoded in the transcode mode.
+
+        Encoding files in the target format (e.g. MP3s) at or below the
+        target bitrate again would only make them larger and worse, they are
+        copied. In the ReplayGain modes the gain has to be applied to the
+        samples, they are always encoded.
+        """
+        import mutagen
+        if (self._mode != 'transcode' or
+                os.path.splitext(in_filepath)[1] not in self.profile.copied):
+            return True
+        try:
+            info = mutagen.File(in_filepath).info
+        except (mutagen.MutagenError, OSError, AttributeError):
+            return True
+        bitrate = getattr(info, 'bitrate', 0)
+        if not bitrate or bitrate > self._average_bitrate * 1000:
+            return True
+        logger.info("Not encoding {} ({} kbit/s {})", in_filepath,
+                    bitrate // 1000,
+                    str(getattr(info, 'bitrate_mode', '')).rpartition('.')[2])
+        return False
+
+    def copy(self, in_filepath, out_filepath):
+        """Copying audio file.
+
+        The tags of the copy are modified in place, so it is never a hard
+        link to the source in that case.
+        """
         logger.info("Copying from {} to {}", in_filepath, out_filepath)
-        shutil.copy(in_filepath, out_filepath)
+        strategy = self._copy_strategy
+        if self._copy_tags and strategy == 'hardlink':
+            strategy = 'auto'
+        with stats.stage('write', os.path.getsize(in_filepath)):
+            copy_file(in_filepath, out_filepath, strategy)
 
     def get_replaygain(self, in_filepath):
         """Read ReplayGain info from tags."""
+        import mutagen.mp3
         in_file = mutagen.File(in_filepath)
         tag_prefix = 'TXXX:' if isinstance(in_file, mutagen.mp3.MP3) else ''
         rp_info = collections.namedtuple('ReplayGainInfo', ['gain', 'peak'])
@@ -170,61 +370,99 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
         except (TypeError, KeyError):
             return None
 
-    def transcode(self, in_filepath, out_filepath):
-        """Transcode audio file."""
+    def transcode(self, in_filepath, out_filepath, gain=None):
+        """Transcode audio file.
+
+        :param gain: tuple (gain, peak) applied to the samples in the
+            ReplayGain modes, by default the track gain is measured (see
+            loudness) or read from the tags
+        """
+        from pydub import AudioSegment, exceptions
         logger.info("Transcoding from {} to {}", in_filepath, out_filepath)
         try:
-            in_file = AudioSegment.from_file(
-                in_filepath, os.path.splitext(in_filepath)[1][1:])
-            if not self._mode.startswith('replaygain'):
-                self.export_audio_file(
-                    export_file=in_file,
-                    export_filepath=out_filepath,
-                    in_parameters=[])
-            else:
-                rp_info = self.get_replaygain(in_filepath)
-                if rp_info:
-                    self.export_audio_file(
-                        export_file=in_file,
-                        export_filepath=out_filepath,
-                        in_parameters=[
-                            "-metadata", "REPLAYGAIN_TRACK_GAIN={}".format(
-                                rp_info.gain + self._replaygain_preamp_gain),
-                            "-metadata", "REPLAYGAIN_TRACK_PEAK={}".format(
-                                rp_info.peak)
-                        ])
-                else:
-                    logger.warning("No ReplayGain info found {}", in_filepath)
-                    self.export_audio_file(
-                        export_file=in_file,
-                        export_filepath=out_filepath,
-                        in_parameters=[])
+            with stats.stage('decode', os.path.getsize(in_filepath)):
+                in_file = AudioSegment.from_file(
+                    in_filepath, util.get_audio_format(in_filepath))
+            stats.count('audio_seconds', in_file.duration_seconds)
+            if self._mode.startswith('replaygain'):
+                in_file = self.apply_replaygain(in_file, in_filepath, gain)
+            self.export_audio_file(
+                export_file=in_file,
+                export_filepath=out_filepath,
+                in_parameters=[])
         except (exceptions.CouldntDecodeError,
                 exceptions.CouldntEncodeError,
                 PermissionError) as err:
             raise IOError("Failed to transcode file {}: {}"
                           .format(in_filepath, err)) from err
 
+    def apply_replaygain(self, in_file, in_filepath, gain=None):
+        """Apply the ReplayGain (plus pre-amp gain) to a decoded file.
+
+        Without a given gain, the track gain is measured if NumPy is
+        available, otherwise it is read from the tags (like the album gain).
+        The gain is reduced if the peak would clip.
+        """
+        if gain is None:
+            if self._mode == 'replaygain' and loudness.available():
+                gain = loudness.get_gain(loudness.analyze_segment(in_file))
+            else:
+                gain = self.get_replaygain(in_filepath)
+        if gain is None:
+            logger.warning("No ReplayGain info found {}", in_filepath)
+            return in_file
+        gain_db = gain[0] + self._replaygain_preamp_gain
+        if gain[1] > 0:
+            gain_db = min(gain_db, -20 * math.log10(gain[1]))
+        with stats.stage('gain'):
+            return in_file.apply_gain(gain_db)
+
     def export_audio_file(self, export_file, export_filepath, in_parameters):
         """Convert and export the loaded AudioSegment; helper function for transcode()"""
-        if self._var_bitrate is not None:
-            export_file.export(
-                export_filepath,
-                format=self._format,
-                parameters=in_parameters + ["-q:a", self._var_bitrate])
-        else:
-            export_file.export(
-                export_filepath,
-                format=self._format,
-                bitrate=self._bitrate,
-                parameters=in_parameters)
-
-    def copy_tags(self, in_filepath, out_filepath):
-        """Copy tags."""
-        in_file = mutagen.File(in_filepath)
+        parameters = in_parameters + self.profile.parameters
+        with stats.stage('encode'):
+            if (self._var_bitrate is not None and
+                    self.profile.encoder == 'libmp3lame'):
+                export_file.export(
+                    export_filepath,
+                    format=self.profile.container,
+                    codec=self.profile.encoder,
+                    parameters=parameters + ["-q:a", self._var_bitrate])
+            elif self._var_bitrate is not None:
+                # Only LAME has quality levels, the others encode the
+                # average bitrate of the level of their profile
+                export_file.export(
+                    export_filepath,
+                    format=self.profile.container,
+                    codec=self.profile.encoder,
+                    bitrate='{}k'.format(self._average_bitrate),
+                    parameters=parameters)
+            else:
+                export_file.export(
+                    export_filepath,
+                    format=self.profile.container,
+                    codec=self.profile.encoder,
+                    bitrate=self._bitrate,
+                    parameters=parameters)
+        stats.add('encode', nbytes=os.path.getsize(export_filepath))
+
+    def copy_tags(self, in_filepath, out_filepath, source=None):
+        """Copy tags.
+
+        :param source: tuple (in_filename, hash) stored in the output file
+        """
+        with stats.stage('tags'):
+            if self.profile.tags == 'vorbis':
+                self._copy_tags_to_vorbis(in_filepath, out_filepath, source)
+            elif self.profile.tags == 'mp4':
+                self._copy_tags_to_mp4(in_filepath, out_filepath, source)
+            else:
+                self._copy_tags_to_mp3(in_filepath, out_filepath, source)
 
-        # Tags are converted to ID3 format. If the output format is changed
-        # in the functions above, this function has to be adapted too.
+    def _copy_tags_to_mp3(self, in_filepath, out_filepath, source):
+        """Copy tags to the MP3 output file (including cover art)."""
+        import mutagen.id3
+        import mutagen.mp3
         try:
             mp3_file = mutagen.mp3.MP3(out_filepath)
         except mutagen.mp3.HeaderNotFoundError as err:
@@ -232,72 +470,148 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
 
         if not mp3_file.tags:
             mp3_file.tags = mutagen.id3.ID3()
+        self._convert_tags(in_filepath, mp3_file.tags, source)
+
+        # Save as id3v1 and id3v2.3
+        mp3_file.tags.update_to_v23()
+        mp3_file.tags.save(out_filepath, v1=2, v2_version=3)
+
+    def _copy_tags_to_vorbis(self, in_filepath, out_filepath, source):
+        """Copy tags to the Ogg output file (e.g. Opus).
+
+        The tags are converted to ID3 first and replace all tags of the
+        output file.
+        """
+        import mutagen
+        import mutagen.id3
+        import mutagen.ogg
+        out_file = mutagen.File(out_filepath)
+        if not isinstance(out_file, mutagen.ogg.OggFileType):
+            raise IOError("Output file is not in Ogg format")
+        tags = mutagen.id3.ID3()
+        self._convert_tags(in_filepath, tags, source)
+        if out_file.tags is None:
+            out_file.add_tags()
+        out_file.tags.clear()
+        self.copy_id3_to_vorbis(tags, out_file.tags)
+        out_file.save()
+
+    def _copy_tags_to_mp4(self, in_filepath, out_filepath, source):
+        """Copy tags to the MP4 output file (e.g. AAC).
+
+        The tags are converted to ID3 first and replace all tags of the
+        output file.
+        """
+        import mutagen.id3
+        import mutagen.mp4
+        try:
+            out_file = mutagen.mp4.MP4(out_filepath)
+        except mutagen.MutagenError as err:
+            raise IOError("Output file is not in MP4 format") from err
+        tags = mutagen.id3.ID3()
+        self._convert_tags(in_filepath, tags, source)
+        if out_file.tags is None:
+            out_file.add_tags()
+        out_file.tags.clear()
+        self.copy_id3_to_mp4(tags, out_file.tags)
+        out_file.save()
+
+    def _convert_tags(self, in_filepath, tags, source):
+        """Convert the tags of the input file to ID3 (incl. cover art).
+
+        :param tags: ID3 tags the converted tags are added to
+        """
+        import mutagen.flac
+        import mutagen.id3
+        import mutagen.mp3
+        import mutagen.mp4
+        import mutagen.oggopus
+        import mutagen.oggvorbis
+        in_file = mutagen.File(in_filepath)
 
         # Tags are processed depending on their input format.
         if isinstance(in_file, mutagen.mp3.MP3):
-            self.copy_id3_to_id3(in_file.tags, mp3_file.tags)
+            self.copy_id3_to_id3(in_file.tags, tags)
         elif isinstance(in_file, (mutagen.flac.FLAC,
-                                  mutagen.oggvorbis.OggVorbis)):
-            self.copy_vorbis_to_id3(in_file.tags, mp3_file.tags)
-            self.copy_vorbis_picture_to_id3(in_file, mp3_file.tags)
+                                  mutagen.oggvorbis.OggVorbis,
+                                  mutagen.oggopus.OggOpus)):
+            self.copy_vorbis_to_id3(in_file.tags, tags)
+            with stats.stage('cover'):
+                self.copy_vorbis_picture_to_id3(in_file, tags)
         elif isinstance(in_file, mutagen.mp4.MP4):
-            self.copy_mp4_to_id3(in_file.tags, mp3_file.tags)
-            self.copy_mp4_picture_to_id3(in_file, mp3_file.tags)
+            self.copy_mp4_to_id3(in_file.tags, tags)
+            with stats.stage('cover'):
+                self.copy_mp4_picture_to_id3(in_file, tags)
         else:
             raise IOError("Input file tag conversion not implemented")
 
         # Load the image from folder.jpg
-        self.copy_folder_image_to_id3(in_filepath, mp3_file.tags)
+        with stats.stage('cover'):
+            self.copy_folder_image_to_id3(in_filepath, tags)
 
         # Apply hacks
         if self._albumartist_artist_hack:
-            self.apply_albumartist_artist_hack(mp3_file.tags)
+            self.apply_albumartist_artist_hack(tags)
         if self._albumartist_composer_hack:
-            self.apply_albumartist_composer_hack(mp3_file.tags)
+            self.apply_albumartist_composer_hack(tags)
         if self._artist_albumartist_hack:
-            self.apply_artist_albumartist_hack(mp3_file.tags)
+            self.apply_artist_albumartist_hack(tags)
         if self._discnumber_hack:
-            self.apply_disknumber_hack(mp3_file.tags)
+            self.apply_disknumber_hack(tags)
         if self._tracknumber_hack:
-            self.apply_tracknumber_hack(mp3_file.tags)
+            self.apply_tracknumber_hack(tags)
 
         # Remove ReplayGain tags if the volume has already been changed
         if self._mode.startswith('replaygain'):
-            mp3_file.tags.delall('TXXX:replaygain_album_gain')
-            mp3_file.tags.delall('TXXX:replaygain_album_peak')
-            mp3_file.tags.delall('TXXX:replaygain_track_gain')
-            mp3_file.tags.delall('TXXX:replaygain_track_peak')
+            tags.delall('TXXX:replaygain_album_gain')
+            tags.delall('TXXX:replaygain_album_peak')
+            tags.delall('TXXX:replaygain_track_gain')
+            tags.delall('TXXX:replaygain_track_peak')
+
+        # Remember the source (MP3 sources may contain their own frames)
+        for desc in SOURCE_FRAMES:
+            tags.delall('TXXX:' + desc)
+        if source is not None:
+            for desc, text in zip(SOURCE_FRAMES, source + (self.fingerprint,)):
+                tags.add(mutagen.id3.TXXX(encoding=3, desc=desc, text=text))
 
-        # Save as id3v1 and id3v2.3
-        mp3_file.tags.update_to_v23()
-        mp3_file.tags.save(out_filepath, v1=2, v2_version=3)
+    @classmethod
+    def read_source(cls, out_filepath):
+        """Read the source information stored by copy_tags().
+
+        Only the ID3 tag at the start of MP3 files is read.
+
+        :returns: tuple (in_filename, hash, fingerprint) or None
+        """
+        import mutagen
+        import mutagen.id3
+        import mutagen.mp4
+        try:
+            if out_filepath.endswith('.mp3'):
+                tags = mutagen.id3.ID3(out_filepath)
+            else:
+                tags = mutagen.File(out_filepath).tags
+        except (mutagen.MutagenError, OSError, AttributeError):
+            return None
+        try:
+            if isinstance(tags, mutagen.id3.ID3):
+                return tuple(str(tags['TXXX:' + desc].text[0])
+                             for desc in SOURCE_FRAMES)
+            if isinstance(tags, mutagen.mp4.MP4Tags):
+                return tuple(bytes(tags[MP4_FREEFORM + desc][0]).decode()
+                             for desc in SOURCE_FRAMES)
+            return tuple(tags[desc][0] for desc in SOURCE_FRAMES)
+        except (KeyError, TypeError):
+            return None
 
     @ classmethod
     def copy_vorbis_to_id3(cls, src_tags, dest_tags):
         """Copy tags in vorbis comments (ogg, flac) to ID3 format."""
-        tagtable = {
-            'album': mutagen.id3.TALB,
-            'artist': mutagen.id3.TPE1,
-            'albumartist': mutagen.id3.TPE2,
-            'title': mutagen.id3.TIT2,
-            'genre': mutagen.id3.TCON,
-            'date': mutagen.id3.TDRC,
-            'tracknumber': mutagen.id3.TRCK,
-            'discnumber': mutagen.id3.TPOS,
-            'MUSICBRAINZ_TRACKID': 'http://musicbrainz.org',
-            'MUSICBRAINZ_ARTISTID': 'MusicBrainz Artist Id',
-            'MUSICBRAINZ_ALBUMARTISTID': 'MusicBrainz Album Artist Id',
-            'MUSICBRAINZ_RELEASEGROUPID': 'MusicBrainz Release Group Id',
-            'MUSICBRAINZ_ALBUMID': 'MusicBrainz Album Id',
-            'MUSICBRAINZ_RELEASETRACKID': 'MusicBrainz Release Track Id',
-            'replaygain_album_gain': 'replaygain_album_gain',
-            'replaygain_album_peak': 'replaygain_album_peak',
-            'replaygain_track_gain': 'replaygain_track_gain',
-            'replaygain_track_peak': 'replaygain_track_peak'
-        }
-        for tag in tagtable:
+        import mutagen.id3
+        for tag, key in VORBIS_TO_ID3.items():
             if tag in src_tags:
-                id3tag = tagtable[tag]
+                frame_id, _, desc = key.partition(':')
+                id3tag = getattr(mutagen.id3, frame_id)
                 if tag == 'tracknumber':
                     track = src_tags['tracknumber'][0]
                     if 'tracktotal' in src_tags:
@@ -309,11 +623,11 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
                     if 'disctotal' in src_tags:
                         disc = '{}/{}'.format(disc, src_tags['disctotal'][0])
                     dest_tags.add(id3tag(encoding=3, text=disc))
-                elif tag == 'MUSICBRAINZ_TRACKID':
+                elif frame_id == 'UFID':
                     dest_tags.add(mutagen.id3.UFID(
-                        owner=id3tag, data=src_tags[tag][0].encode()))
-                elif isinstance(id3tag, str):  # TXXX tags
-                    dest_tags.add(mutagen.id3.TXXX(encoding=3, desc=id3tag,
+                        owner=desc, data=src_tags[tag][0].encode()))
+                elif frame_id == 'TXXX':
+                    dest_tags.add(mutagen.id3.TXXX(encoding=3, desc=desc,
                                                    text=src_tags[tag]))
                 else:  # All other tags
                     dest_tags.add(id3tag(encoding=3, text=src_tags[tag]))
@@ -321,6 +635,8 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
     @ classmethod
     def copy_vorbis_picture_to_id3(cls, in_file, dest_tags):
         """Copy pictures from vorbis comments to ID3 format."""
+        import mutagen.flac
+        import mutagen.id3
         pictures = []
         try:  # Flac
             pictures.extend(in_file.pictures)
@@ -341,21 +657,10 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
     @ classmethod
     def copy_mp4_to_id3(cls, src_tags, dest_tags):
         """Copy tags in MP4 format (m4a, ...) to ID3 format."""
-        tagtable = {
-            '\xa9alb': mutagen.id3.TALB,  # album
-            '\xa9ART': mutagen.id3.TPE1,  # artist
-            'aART': mutagen.id3.TPE2,  # albumartist
-            '\xa9nam': mutagen.id3.TIT2,  # title
-            '\xa9gen': mutagen.id3.TCON,  # genre
-            '\xa9day': mutagen.id3.TDRC,  # date
-            'trkn': mutagen.id3.TRCK,  # tracknumber
-            'disk': mutagen.id3.TPOS,  # disknumber
-            '\xa9wrt': mutagen.id3.TCOM,  # composer
-            '\xa9cmt': mutagen.id3.COMM  # comment
-        }
-        for tag in tagtable:
+        import mutagen.id3
+        for tag, frame_id in MP4_TO_ID3.items():
             if tag in src_tags:
-                id3tag = tagtable[tag]
+                id3tag = getattr(mutagen.id3, frame_id)
                 if tag == 'trkn':
                     track = src_tags["trkn"][0][0]
                     if src_tags["trkn"][0][1] != 0:  # pylint: disable=too-many-nested-blocks
@@ -383,6 +688,8 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
     @ classmethod
     def copy_mp4_picture_to_id3(cls, in_file, dest_tags):
         """Copy pictures from mp4 format to ID3 format."""
+        import mutagen.id3
+        import mutagen.mp4
         if "covr" in in_file.tags:
             picture = in_file["covr"][0]
 
@@ -426,9 +733,77 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
             if tag in src_tags:
                 dest_tags.add(src_tags[tag])
 
+    @classmethod
+    def copy_id3_to_vorbis(cls, src_tags, dest_tags):
+        """Copy tags in ID3 format to vorbis comments (opus)."""
+        import mutagen.flac
+        comments = {}
+        for frame in src_tags.values():
+            if frame.FrameID == 'APIC':
+                picture = mutagen.flac.Picture()
+                picture.type = frame.type
+                picture.mime = frame.mime
+                picture.desc = frame.desc
+                picture.data = frame.data
+                comments.setdefault('METADATA_BLOCK_PICTURE', []).append(
+                    base64.b64encode(picture.write()).decode('ascii'))
+            elif frame.FrameID == 'UFID':
+                if frame.HashKey in ID3_TO_VORBIS:
+                    comments[ID3_TO_VORBIS[frame.HashKey]] = [
+                        frame.data.decode()]
+            elif frame.FrameID == 'TXXX':
+                comments[ID3_TO_VORBIS.get(frame.HashKey, frame.desc)] = [
+                    str(text) for text in frame.text]
+            elif frame.FrameID in ID3_TO_VORBIS:
+                tag = ID3_TO_VORBIS[frame.FrameID]
+                values = [str(text) for text in (
+                    frame.genres if frame.FrameID == 'TCON' else frame.text)]
+                if tag in ['tracknumber', 'discnumber']:
+                    values[0], _, total = values[0].partition('/')
+                    if total:
+                        comments[tag.replace('number', 'total')] = [total]
+                comments[tag] = values
+        for tag, values in comments.items():
+            dest_tags[tag] = values
+
+    @classmethod
+    def copy_id3_to_mp4(cls, src_tags, dest_tags):
+        """Copy tags in ID3 format to MP4 format (aac)."""
+        import mutagen.mp4
+        covers = []
+        for frame in src_tags.values():
+            if frame.FrameID == 'APIC':
+                covers.append(mutagen.mp4.MP4Cover(
+                    frame.data, mutagen.mp4.AtomDataType.PNG
+                    if frame.mime == 'image/png'
+                    else mutagen.mp4.AtomDataType.JPEG))
+            elif frame.FrameID == 'UFID':
+                if frame.owner == 'http://musicbrainz.org':
+                    dest_tags[MP4_FREEFORM + 'MusicBrainz Track Id'] = [
+                        mutagen.mp4.MP4FreeForm(frame.data)]
+            elif frame.FrameID == 'TXXX':
+                dest_tags[MP4_FREEFORM + frame.desc] = [
+                    mutagen.mp4.MP4FreeForm(str(text).encode())
+                    for text in frame.text]
+            elif frame.FrameID in ID3_TO_MP4:
+                atom = ID3_TO_MP4[frame.FrameID]
+                if atom in ['trkn', 'disk']:
+                    number, _, total = str(frame.text[0]).partition('/')
+                    try:
+                        dest_tags[atom] = [(int(number), int(total or 0))]
+                    except ValueError:
+                        pass
+                else:
+                    dest_tags[atom] = [str(text) for text in (
+                        frame.genres if frame.FrameID == 'TCON'
+                        else frame.text)]
+        if covers:
+            dest_tags['covr'] = covers
+
     @ classmethod
     def copy_folder_image_to_id3(cls, in_filename, dest_tags):
         """Copy folder.jpg to ID3 tag."""
+        import mutagen.id3
         if 'APIC:' not in dest_tags:
             image = os.path.join(os.path.dirname(in_filename), 'folder.jpg')
             if os.path.exists(image):
@@ -439,18 +814,21 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
     @ classmethod
     def apply_albumartist_artist_hack(cls, tags):
         """Copy the albumartist (TPE2) into the artist field (TPE1)."""
+        import mutagen.id3
         artist = tags['TPE2'].text if 'TPE2' in tags else 'Various Artists'
         tags.add(mutagen.id3.TPE1(encoding=3, text=artist))
 
     @ classmethod
     def apply_albumartist_composer_hack(cls, tags):
         """Copy the albumartist (TPE2) into the composer field (TCOM)."""
+        import mutagen.id3
         if 'TPE2' in tags:
             tags.add(mutagen.id3.TCOM(encoding=3, text=tags['TPE2'].text))
 
     @ classmethod
     def apply_artist_albumartist_hack(cls, tags):
         """Copy the artist (TPE1) into the albumartist field (TPE2)."""
+        import mutagen.id3
         albumartist = tags['TPE1'].text \
             if 'TPE1' in tags else 'Various Artists'
         tags.add(mutagen.id3.TPE2(encoding=3, text=albumartist))
@@ -458,6 +836,7 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
     @ classmethod
     def apply_disknumber_hack(cls, tags):
         """Extend album field by disc number."""
+        import mutagen.id3
         if 'TALB' in tags and 'TPOS' in tags and not tags['TPOS'] == '1':
             tags.add(mutagen.id3.TALB(
                 encoding=tags['TALB'].encoding,
@@ -466,6 +845,7 @@ class Transcode:  # pylint: disable=too-many-instance-attributes
     @ classmethod
     def apply_tracknumber_hack(cls, tags):
         """Remove track total from track number."""
+        import mutagen.id3
         if 'TRCK' in tags:
             track_string = tags['TRCK'].text[0].split('/')[0]
             try:
@@ -17,7 +17,10 @@
 
 """Utilities."""
 
+import contextlib
 import logging
+import logging.handlers
+import multiprocessing
 import os
 import sys
 import re
@@ -52,6 +55,42 @@ class LogStyleAdapter(logging.LoggerAdapter):
 logger = LogStyleAdapter(  # pylint: disable=invalid-name
     logging.getLogger(__name__))
 
+# ffmpeg formats of the audio file extensions that aren't named like them
+# (Opus files are Ogg streams)
+AUDIO_FORMATS = {'.opus': 'ogg'}
+
+
+@contextlib.contextmanager
+def log_listener():
+    """Forward the log records of worker processes to the root handlers.
+
+    :returns: context manager providing the arguments (queue, level) for
+        init_worker_logging() in the worker processes
+    """
+    queue = multiprocessing.Queue()
+    handlers = logging.getLogger().handlers
+    listener = logging.handlers.QueueListener(
+        queue, *handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        yield queue, min((h.level for h in handlers), default=logging.WARNING)
+    finally:
+        listener.stop()
+
+
+def init_worker_logging(queue, level):
+    """Send all log records of a worker process to the main process.
+
+    :param queue: queue provided by log_listener()
+    :param level: lowest level handled by the main process, records below
+        are dropped in the worker
+    """
+    rootlogger = logging.getLogger()
+    for handler in rootlogger.handlers[:]:
+        rootlogger.removeHandler(handler)
+    rootlogger.addHandler(logging.handlers.QueueHandler(queue))
+    rootlogger.setLevel(level)
+
 
 def makepath(path):
     """Convert relative path into absolute path."""
@@ -81,18 +120,104 @@ def ensure_directory_exists(path):
         pass
 
 
+def get_package_version(name):
+    """Get the version of an installed distribution ('unknown' if missing).
+
+    importlib.metadata is only imported when needed as it is slow to import.
+    """
+    from importlib import metadata  # pylint: disable=import-outside-toplevel
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def write_atomic(path, content):
+    """Write a file by replacing it with a temporary file."""
+    temppath = path + '.tmp'
+    with open(temppath, 'w') as out_file:
+        out_file.write(content)
+    os.replace(temppath, path)
+
+
+def fsync_path(path):
+    """Flush a file or directory (its entries) to the device."""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def fsync_file(path):
+    """Flush a file and the directory entry of a new file to the device."""
+    fsync_path(path)
+    fsync_path(os.path.dirname(path) or '.')
+
+
+def syncfs(path):
+    """Flush all data of the file system containing the given path.
+
+    Uses syncfs(2) on Linux, which only waits for the given file system,
+    and falls back to sync(2) for all file systems elsewhere.
+    """
+    import ctypes  # pylint: disable=import-outside-toplevel
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, 'syncfs'):
+        os.sync()
+        return
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        if libc.syncfs(descriptor) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+    finally:
+        os.close(descriptor)
+
+
 def delete_empty_directories(path):
     """Recursively remove empty directories."""
     if not os.path.isdir(path):
         return False
-    if all(delete_empty_directories(os.path.join(path, filename))
-           for filename in os.listdir(path)):
+    # Visit all children, all() would stop at the first non-empty one
+    removed = [delete_empty_directories(os.path.join(path, filename))
+               for filename in os.listdir(path)]
+    if all(removed):
         logger.info("Removing {}".format(path))
         os.rmdir(path)
         return True
     return False
 
 
+def prune_empty_directories(directories, root):
+    """Remove the given directories and their ancestors below root if empty.
+
+    Directories are removed bottom-up so that parents that only contained
+    removed directories are removed as well. The root itself is kept.
+    """
+    root = os.path.normpath(root)
+    pending = set()
+    for directory in directories:
+        directory = os.path.normpath(directory)
+        while (directory.startswith(root + os.sep) and
+               directory not in pending):
+            pending.add(directory)
+            directory = os.path.dirname(directory)
+    for directory in sorted(pending, key=lambda d: d.count(os.sep),
+                            reverse=True):
+        try:
+            os.rmdir(directory)
+        except OSError:  # Not empty or already removed
+            continue
+        logger.info("Removing {}".format(directory))
+
+
+def get_audio_format(path):
+    """Get the ffmpeg format of an audio file by its extension."""
+    extension = os.path.splitext(path)[1].lower()
+    return AUDIO_FORMATS.get(extension, extension[1:])
+
+
 def correct_path_fat32(filename):
     """Replace illegal characters in FAT32 filenames with '_'."""
     return re.sub(r'[\\|:|*|?|"|<|>|\|]', '_', filename)
@@ -0,0 +1,198 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Watch directory trees for changed files with inotify."""
+
+import ctypes
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from . import util
+
+logger = util.LogStyleAdapter(  # pylint: disable=invalid-name
+    logging.getLogger(__name__))
+
+# Flags and events of inotify(7)
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Files are reported once they are complete: after writing them (not on
+# every write) or after moving them into place
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF)
+
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct('iIII')
+
+# Bursts are collected for at most this many delays before they are synced
+MAX_DELAY_FACTOR = 10
+
+
+class Watcher():
+    """Watch directory trees for changed files.
+
+    All directories of the trees are watched, directories created or moved
+    into them later are watched as well.
+    """
+
+    def __init__(self, roots):
+        """Watch the given directories.
+
+        :raises OSError: if inotify isn't available or the watches can't be
+            added (e.g. fs.inotify.max_user_watches is exceeded)
+        """
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            self._raise_error()
+        # Watched directories by watch descriptor
+        self._directories = {}
+        for root in roots:
+            self._add_tree(root)
+        logger.info("Watching {} directories", len(self._directories))
+
+    def close(self):
+        """Remove all watches."""
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _raise_error(self, path=None):
+        """Raise the error of the last failed libc call."""
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def _add_tree(self, path):
+        """Watch a directory and all directories below it.
+
+        :returns: list of the files in the tree
+        """
+        files = []
+        for dirpath, _, filenames in os.walk(path):
+            descriptor = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(dirpath), WATCH_MASK | IN_ONLYDIR)
+            if descriptor < 0:
+                if ctypes.get_errno() in [errno.ENOENT, errno.ENOTDIR]:
+                    continue  # Removed again in the meantime
+                self._raise_error(dirpath)
+            self._directories[descriptor] = dirpath
+            files.extend(os.path.join(dirpath, f) for f in filenames)
+        return files
+
+    def _remove_tree(self, path):
+        """Stop watching a directory and all directories below it.
+
+        Directories moved out of the trees are still watched by inotify,
+        their events would be reported with the old paths.
+        """
+        prefix = os.path.join(path, '')
+        for descriptor, directory in list(self._directories.items()):
+            if directory == path or directory.startswith(prefix):
+                del self._directories[descriptor]
+                self._libc.inotify_rm_watch(self._fd, descriptor)
+
+    def read(self, timeout=None):
+        """Read the pending events.
+
+        :param timeout: seconds to wait for events, None waits forever
+        :returns: set of changed paths (created, written, moved or removed
+            files and directories) or None if events were lost and
+            everything has to be checked again, an empty set on timeout
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return set()
+        changes = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self._directories.pop(descriptor, None)
+                continue
+            directory = self._directories.get(descriptor)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            changes.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been added before the watch was
+                changes.update(self._add_tree(path))
+            elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self._remove_tree(path)
+        return None if overflow else changes
+
+    def wait(self, delay):
+        """Wait for changes and collect them until no more arrive.
+
+        Bursts of changes, e.g. a tagger rewriting all files of an album,
+        are coalesced: the changes are returned once nothing changed for
+        the given delay (or after ten times the delay at the latest).
+
+        :returns: set of changed paths or None if everything has to be
+            checked again (see read())
+        """
+        # Reads without relevant events (e.g. of removed watches) neither
+        # start nor end a burst
+        changes = self.read()
+        while changes is not None and not changes:
+            changes = self.read()
+        changed = time.monotonic()
+        deadline = changed + delay * MAX_DELAY_FACTOR
+        while True:
+            timeout = min(changed + delay, deadline) - time.monotonic()
+            if timeout <= 0:
+                break
+            pending = self.read(timeout)
+            if pending is not None and not pending:
+                continue
+            changed = time.monotonic()
+            if pending is None or changes is None:
+                changes = None
+            else:
+                changes |= pending
+        return changes
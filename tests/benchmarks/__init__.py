@@ -0,0 +1,40 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmarks for sync_music.
+
+Benchmarks are not collected by pytest, they are run as modules. The suite
+runs all benchmarks on a synthetic library and compares them against a
+stored baseline (see __main__), the bench_* modules show how single
+operations scale::
+
+    python -m tests.benchmarks --save baseline.json
+    python -m tests.benchmarks.bench_cleanup
+"""
+
+import time
+
+
+def measure(func, repeat=5):
+    """Return the best wall clock time of several calls of func in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
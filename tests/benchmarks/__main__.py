@@ -0,0 +1,447 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmark suite.
+
+Generates a synthetic library (see synthlib) and runs end-to-end and micro
+benchmarks on it. Results are written as JSON and can be compared against a
+stored baseline::
+
+    python -m tests.benchmarks --save baseline.json
+    python -m tests.benchmarks --baseline baseline.json
+
+The exit code is 1 if a benchmark got slower than the baseline by more than
+the threshold.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from sync_music import loudness
+from sync_music import util
+from sync_music.hashdb import HashDb
+from sync_music.playlist import PathSuffixIndex
+from sync_music.playlist import read_playlist
+from sync_music.sync_music import SyncMusic
+from sync_music.sync_music import load_settings
+from sync_music.transcode import Transcode
+
+from . import bench_startup
+from . import measure
+from . import synthlib
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Register a benchmark, benchmarks run in the order of registration."""
+    BENCHMARKS.append(func)
+    return func
+
+
+class Context:  # pylint: disable=too-few-public-methods
+    """Paths and settings shared by the benchmarks."""
+
+    def __init__(self, path, args):
+        self.path = path
+        self.args = args
+        self.library = os.path.join(path, 'library')
+        self.playlists = os.path.join(path, 'playlists')
+        self.output = os.path.join(path, 'output')
+        self.files = []
+
+    def settings(self, *arguments):
+        """Get sync_music settings for syncing the library."""
+        settings = load_settings(
+            ['--audio-src', self.library, '--audio-dest', self.output,
+             '--playlist-src', self.playlists, '--batch'] + list(arguments))
+        settings.jobs = self.args.jobs
+        return settings
+
+    def audio_files(self, extensions=('.flac', '.ogg', '.m4a', '.mp3')):
+        """Get the absolute paths of the audio files of the library."""
+        return [os.path.join(self.library, f) for f in self.files
+                if os.path.splitext(f)[1] in extensions]
+
+
+@benchmark
+def startup_version(_):
+    """Start a new interpreter to show the version."""
+    return measure(lambda: bench_startup.run_main('--version'))
+
+
+@benchmark
+def list_all_files(context):
+    """Scan the library."""
+    return measure(lambda: util.list_all_files(context.library))
+
+
+@benchmark
+def hashdb_get_hash(context):
+    """Hash all files of the library."""
+    paths = [os.path.join(context.library, f) for f in context.files]
+    return measure(lambda: [HashDb.get_hash(p) for p in paths])
+
+
+def _create_hashdb(context, compact=False):
+    """Create a hash database with a large number of entries."""
+    hashdb = HashDb(os.path.join(context.path, 'benchmark.db'),
+                    compact=compact)
+    hashdb.database = {
+        'Artist {:05}/Album {:02}/{:02} Track.flac'.format(
+            index // 200, index // 20 % 10, index % 20):
+        ('Artist {:05}/Album {:02}/{:02} Track.mp3'.format(
+            index // 200, index // 20 % 10, index % 20),
+         '{:032x}'.format(index))
+        for index in range(context.args.entries)}
+    return hashdb
+
+
+@benchmark
+def hashdb_store(context):
+    """Store a hash database with --entries entries."""
+    return measure(_create_hashdb(context).store)
+
+
+@benchmark
+def hashdb_load(context):
+    """Load a hash database with --entries entries."""
+    _create_hashdb(context).store()
+    return measure(HashDb(os.path.join(context.path, 'benchmark.db')).load)
+
+
+@benchmark
+def hashdb_store_compact(context):
+    """Store a compact hash database with --entries entries."""
+    return measure(_create_hashdb(context, compact=True).store)
+
+
+@benchmark
+def hashdb_load_compact(context):
+    """Load a compact hash database with --entries entries."""
+    _create_hashdb(context, compact=True).store()
+    return measure(HashDb(os.path.join(context.path, 'benchmark.db'),
+                          compact=True).load)
+
+
+@benchmark
+def hashdb_load_scope(context):
+    """Load the entries of a single album of --entries entries."""
+    _create_hashdb(context).store()
+    return measure(lambda: HashDb(os.path.join(
+        context.path, 'benchmark.db')).load(['Artist 00001/Album 01']))
+
+
+def _transcode(context, codec):
+    """Transcode the lossless files of the library to a codec."""
+    paths = context.audio_files(('.flac',))[:context.args.transcodes]
+    action = Transcode(mode='transcode', copy_tags=False, codec=codec)
+    out_path = action.get_out_filename(os.path.join(context.path,
+                                                    'transcode'))
+    return measure(lambda: [action.transcode(p, out_path) for p in paths],
+                   repeat=1)
+
+
+@benchmark
+def transcode(context):
+    """Transcode (decode and encode) the lossless files of the library."""
+    return _transcode(context, 'mp3')
+
+
+@benchmark
+def transcode_opus(context):
+    """Transcode the lossless files of the library to Opus."""
+    return _transcode(context, 'opus')
+
+
+@benchmark
+def transcode_aac(context):
+    """Transcode the lossless files of the library to AAC."""
+    return _transcode(context, 'aac')
+
+
+@benchmark
+def loudness_analysis(context):
+    """Analyse the loudness of --duration seconds of audio per track."""
+    # pylint: disable=import-outside-toplevel
+    from . import bench_loudness
+    samples = bench_loudness.create_samples(
+        44100, 2, context.args.duration * context.args.transcodes)
+    return measure(lambda: loudness.analyze_samples(samples, 44100))
+
+
+@benchmark
+def copy_tags(context):
+    """Copy the tags of all audio files of the library to MP3 files."""
+    paths = context.audio_files()
+    template = context.audio_files(('.mp3',))[0]
+    out_paths = [os.path.join(context.path, 'tags{}.mp3'.format(index))
+                 for index in range(len(paths))]
+    for out_path in out_paths:
+        shutil.copy(template, out_path)
+    action = Transcode()
+    return measure(lambda: [action.copy_tags(p, o)
+                            for p, o in zip(paths, out_paths)])
+
+
+@benchmark
+def sync_initial(context):
+    """Sync the library to an empty destination."""
+    return measure(lambda: SyncMusic(context.settings()).sync_audio(),
+                   repeat=1)
+
+
+@benchmark
+def sync_unchanged(context):
+    """Sync the library without changes."""
+    return measure(lambda: SyncMusic(context.settings()).sync_audio())
+
+
+def _sync_durability(context, durability):
+    """Copy the library to a separate destination with a durability mode."""
+    settings = load_settings(
+        ['--audio-src', context.library, '--audio-dest',
+         os.path.join(context.path, 'durability-' + durability),
+         '--mode=copy', '--batch', '-f', '--durability', durability])
+    settings.jobs = context.args.jobs
+    return measure(lambda: SyncMusic(settings).sync_audio(), repeat=3)
+
+
+@benchmark
+def sync_durability_none(context):
+    """Copy the library without flushing the written files."""
+    return _sync_durability(context, 'none')
+
+
+@benchmark
+def sync_durability_batched(context):
+    """Copy the library flushing the file system at checkpoints."""
+    return _sync_durability(context, 'batched')
+
+
+@benchmark
+def sync_durability_per_file(context):
+    """Copy the library flushing every written file."""
+    return _sync_durability(context, 'per-file')
+
+
+@benchmark
+def startup_sync_unchanged(context):
+    """Sync the library without changes in a new interpreter."""
+    return measure(lambda: bench_startup.run_main(
+        '--audio-src', context.library, '--audio-dest', context.output,
+        '--batch', '--logfile', '', '--jobs', str(context.args.jobs)))
+
+
+@benchmark
+def cleanup_unchanged(context):
+    """Prune empty directories of the destination without changes."""
+    return measure(lambda: util.prune_empty_directories(set(),
+                                                        context.output))
+
+
+@benchmark
+def cleanup_full_sweep(context):
+    """Sweep the whole destination for empty directories."""
+    return measure(lambda: util.delete_empty_directories(context.output))
+
+
+def _load_hashdb(hashdb):
+    """Load the hash database of the synced library.
+
+    :raises RuntimeError: if the library wasn't synced (see sync_initial)
+    """
+    hashdb.load()
+    if not hashdb.database:
+        raise RuntimeError("The hash database is empty, run sync_initial")
+    return hashdb
+
+
+def _playlist_lines(context, hashdb):
+    """Get the lines of all playlists.
+
+    :raises RuntimeError: if a line doesn't resolve to a synced file
+    """
+    lines = [line for f in os.listdir(context.playlists)
+             for line in read_playlist(os.path.join(context.playlists, f))
+             if not line.startswith('#EXT')]
+    index = PathSuffixIndex(hashdb.database)
+    missing = [line for line in lines if not index.resolve(line)]
+    if missing:
+        raise RuntimeError("{} of {} playlist lines don't resolve, e.g. {}"
+                           .format(len(missing), len(lines), missing[0]))
+    return lines
+
+
+@benchmark
+def playlist_resolve(context):
+    """Resolve the lines of all playlists with the path suffix index."""
+    hashdb = _load_hashdb(
+        HashDb(os.path.join(context.output, 'sync_music.db')))
+    lines = _playlist_lines(context, hashdb)
+
+    def _resolve():
+        index = PathSuffixIndex(hashdb.database)
+        return [index.resolve(line) for line in lines]
+    return measure(_resolve)
+
+
+def _playlist_sync(context, *arguments):
+    """Sync all playlists after loading the hash database like main()."""
+    sync = SyncMusic(context.settings(*arguments))
+    # pylint: disable=protected-access
+    lines = _playlist_lines(context, _load_hashdb(sync._hashdb))
+    seconds = measure(sync.sync_playlists)
+    written = 0
+    for filename in os.listdir(context.playlists):
+        with open(os.path.join(context.output, filename),
+                  encoding='windows-1252') as playlist:
+            written += sum(1 for line in playlist
+                           if not line.startswith('#EXT'))
+    if written != len(lines):
+        raise RuntimeError("Wrote {} of {} playlist lines".format(
+            written, len(lines)))
+    return seconds
+
+
+@benchmark
+def playlist_sync(context):
+    """Sync all playlists (forced rewrite)."""
+    return _playlist_sync(context, '-f')
+
+
+@benchmark
+def playlist_sync_unchanged(context):
+    """Sync all playlists without changes."""
+    return _playlist_sync(context)
+
+
+def run(context, only=None):
+    """Run the benchmarks.
+
+    :returns: dict name -> seconds (None if the benchmark failed)
+    """
+    results = {}
+    for func in BENCHMARKS:
+        if only and func.__name__ not in only:
+            continue
+        try:
+            results[func.__name__] = func(context)
+        except Exception as err:  # pylint: disable=broad-except
+            print("{}: failed: {}".format(func.__name__, err),
+                  file=sys.stderr)
+            results[func.__name__] = None
+        else:
+            print("{}: {:.4f}s".format(func.__name__,
+                                       results[func.__name__]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compare results against a baseline.
+
+    :returns: list of the names of regressed benchmarks
+    """
+    regressions = []
+    print("{:<24} {:>10} {:>10} {:>8}".format(
+        "benchmark", "baseline", "current", "change"))
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if current is None or previous is None:
+            continue
+        change = current / previous - 1 if previous else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print("{:<24} {:10.4f} {:10.4f} {:+7.1%}{}".format(
+            name, previous, current, change,
+            " REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    """Run the benchmark suite from the command line."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--artists', type=int, default=10)
+    parser.add_argument('--albums', type=int, default=2,
+                        help="albums per artist")
+    parser.add_argument('--tracks', type=int, default=10,
+                        help="tracks per album")
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help="track duration in seconds")
+    parser.add_argument('--playlists', type=int, default=10)
+    parser.add_argument('--playlist-lines', type=int, default=1000)
+    parser.add_argument('--entries', type=int, default=100000,
+                        help="entries of the hash database benchmarks")
+    parser.add_argument('--transcodes', type=int, default=5,
+                        help="files of the transcode benchmark")
+    parser.add_argument('-j', '--jobs', type=int, default=4)
+    parser.add_argument('--only', nargs='+', metavar='BENCHMARK',
+                        choices=[func.__name__ for func in BENCHMARKS],
+                        help="only run the given benchmarks")
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the results as JSON")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare the results against a stored baseline")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="relative slowdown reported as regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as path:
+        context = Context(path, args)
+        start = time.perf_counter()
+        context.files = synthlib.generate_library(
+            context.library, args.artists, args.albums, args.tracks,
+            args.duration)
+        synthlib.generate_playlists(context.playlists, context.files,
+                                    args.playlists, args.playlist_lines)
+        print("Generated {} files in {:.1f}s".format(
+            len(context.files), time.perf_counter() - start))
+        results = run(context, args.only)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'files': len(context.files),
+            'settings': {k: v for k, v in vars(args).items()
+                         if k not in ['save', 'baseline', 'only']},
+        },
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as out_file:
+            json.dump(report, out_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as in_file:
+            baseline = json.load(in_file)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmark empty directory cleanup on an unchanged destination."""
+
+import os
+import tempfile
+
+from sync_music import util
+
+from . import measure
+
+
+def create_tree(path, directories):
+    """Create album directories containing a single track each."""
+    for index in range(directories):
+        album = os.path.join(path, 'artist{:04}'.format(index // 10),
+                             'album{:02}'.format(index % 10))
+        os.makedirs(album)
+        open(os.path.join(album, 'track.mp3'), 'w').close()
+
+
+def main():
+    """Run the benchmark."""
+    print("{:>8} {:>12} {:>12}".format("dirs", "full [s]", "pruned [s]"))
+    for directories in [1000, 10000, 30000]:
+        with tempfile.TemporaryDirectory() as path:
+            create_tree(path, directories)
+            full = measure(lambda: util.delete_empty_directories(path))
+            pruned = measure(
+                lambda: util.prune_empty_directories(set(), path))
+            print("{:8} {:12.4f} {:12.6f}".format(directories, full, pruned))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Benchmark the encode speed and output size of the codec profiles.
+
+Transcodes the lossless tracks of a synthetic library to every codec and
+shows the encode time, the speed relative to the audio duration and the
+output size. Opus and AAC are encoded at lower bitrates than MP3 by
+default, at which they reach about the same quality.
+"""
+
+import argparse
+import os
+import tempfile
+
+from sync_music.transcode import PROFILES
+from sync_music.transcode import Transcode
+
+from . import measure
+from . import synthlib
+
+
+def transcode_all(paths, out_path, codec, bitrate):
+    """Transcode files to a codec.
+
+    :returns: tuple (seconds, output bytes)
+    """
+    action = Transcode(mode='transcode', copy_tags=False, bitrate=bitrate,
+                       codec=codec)
+    out_paths = [action.get_out_filename(os.path.join(
+        out_path, '{}-{}'.format(codec, index)))
+                 for index in range(len(paths))]
+    seconds = measure(lambda: [action.transcode(p, o)
+                               for p, o in zip(paths, out_paths)], repeat=1)
+    return seconds, sum(os.path.getsize(o) for o in out_paths)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--albums', type=int, default=2)
+    parser.add_argument('--tracks', type=int, default=5,
+                        help="tracks per album")
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help="track duration in seconds")
+    parser.add_argument('--bitrates', type=str, nargs=len(PROFILES),
+                        default=['192', '96', '128'], metavar='KBITS',
+                        help="bitrates of {} (default 192 96 128)".format(
+                            ", ".join(PROFILES)))
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as path:
+        library = os.path.join(path, 'library')
+        files = synthlib.generate_library(library, 1, args.albums,
+                                          args.tracks, args.duration,
+                                          formats=['flac'])
+        paths = [os.path.join(library, f) for f in files
+                 if f.endswith('.flac')]
+        audio_seconds = len(paths) * args.duration
+        print("{:>6} {:>8} {:>9} {:>9} {:>9}".format(
+            "codec", "bitrate", "encode", "speed", "size"))
+        sizes = {}
+        for codec, bitrate in zip(PROFILES, args.bitrates):
+            seconds, size = transcode_all(paths, path, codec, bitrate)
+            sizes[codec] = size
+            print("{:>6} {:>5} kb {:8.2f}s {:8.1f}x {:6.1f} MB ({:.0%})"
+                  .format(codec, bitrate, seconds, audio_seconds / seconds,
+                          size / 1e6, size / sizes['mp3']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmark the memory, file size and load time of the hash database.
+
+Compares the dict of tuples with the compact FileEntries for a synthetic
+library (transcoded files with output size and digest, 20 tracks per
+album, 10 albums per artist). The memory is measured with tracemalloc
+after loading the database.
+"""
+
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+
+from sync_music.hashdb import HashDb
+
+from . import measure
+
+
+def create_entries(count):
+    """Create the entries of a synthetic library."""
+    entries = {}
+    for index in range(count):
+        path = 'Artist {:05}/Album {:02}/{:02} Track'.format(
+            index // 200, index // 20 % 10, index % 20)
+        digest = '{:032x}'.format(-index % 2**128)
+        entries[path + '.flac'] = (path + '.mp3', '{:032x}'.format(index),
+                                   5000000 + index, digest)
+    return entries
+
+
+def measure_memory(path, compact):
+    """Measure the memory of a loaded database in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    hashdb = HashDb(path, compact=compact)
+    hashdb.load()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del hashdb
+    return memory
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=1000000,
+                        help="number of files in the database")
+    args = parser.parse_args()
+    entries = create_entries(args.entries)
+    print("{:>8} {:>11} {:>9} {:>9} {:>9}".format(
+        "format", "memory", "file", "load", "store"))
+    with tempfile.TemporaryDirectory() as path:
+        for compact in [False, True]:
+            db_path = os.path.join(path, 'sync_music.db')
+            hashdb = HashDb(db_path, compact=compact)
+            hashdb.database = entries
+            store = measure(hashdb.store, 3)
+            del hashdb
+            load = measure(HashDb(db_path, compact=compact).load, 3)
+            print("{:>8} {:8.1f} MB {:6.1f} MB {:8.2f}s {:8.2f}s".format(
+                "compact" if compact else "dict",
+                measure_memory(db_path, compact) / 1e6,
+                os.path.getsize(db_path) / 1e6, load, store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Benchmark the loudness analysis in multiples of realtime.
+
+Analyses synthetic PCM (noise) for common sample rates and channel counts,
+decoding is not included.
+"""
+
+import argparse
+
+import numpy
+
+from sync_music import loudness
+
+from . import measure
+
+
+def create_samples(rate, channels, seconds):
+    """Create noise samples."""
+    return numpy.random.default_rng(0).uniform(
+        -0.5, 0.5, (int(rate * seconds), channels))
+
+
+def measure_realtime(rate, channels, seconds, repeat=3):
+    """Measure the analysis speed in multiples of realtime."""
+    samples = create_samples(rate, channels, seconds)
+    return seconds / measure(
+        lambda: loudness.analyze_samples(samples, rate), repeat)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=300.0,
+                        help="duration of the analysed audio")
+    args = parser.parse_args()
+    print("{:>8} {:>9} {:>10}".format("rate", "channels", "realtime"))
+    for rate, channels in [(44100, 2), (48000, 2), (96000, 2), (48000, 6)]:
+        print("{:8} {:9} {:9.0f}x".format(
+            rate, channels, measure_realtime(rate, channels, args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
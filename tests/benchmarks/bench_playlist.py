@@ -0,0 +1,100 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmark playlist path resolution.
+
+Resolves playlist lines against the hash database (index vs. probing every
+suffix) and against the file system for --playlist-selection (with and
+without the cache of resolved directories).
+"""
+
+import os
+import tempfile
+
+from sync_music.playlist import PathSuffixIndex
+from sync_music.playlist import resolve_in_directory
+
+from . import measure
+
+
+def resolve_by_splitting(database, line):
+    """Resolve a playlist line by probing every suffix (previous method)."""
+    try:
+        while True:
+            if line in database:
+                return line
+            line = line.split('/', 1)[1]
+    except IndexError:
+        return None
+
+
+def select_files(root, prefixes):
+    """Resolve playlist lines in the file system (--playlist-selection)."""
+    paths = ['artist{:03}/album{:02}/{:02} track.flac'.format(
+        track // 200, track // 20 % 10, track % 20) for track in range(20000)]
+    for path in paths:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        open(os.path.join(root, path), 'w').close()
+    print("{:>8} {:>8} {:>12} {:>11}".format(
+        "prefix", "lines", "uncached [s]", "cached [s]"))
+    for name, prefix in prefixes.items():
+        playlist = [prefix + paths[line * 7 % len(paths)]
+                    for line in range(10000)]
+        uncached = measure(lambda: [resolve_in_directory(line, root)
+                                    for line in playlist], repeat=3)
+        cached = measure(lambda: [resolve_in_directory(line, root, cache)
+                                  for cache in [{}] for line in playlist],
+                         repeat=3)
+        print("{:>8} {:8} {:12.4f} {:11.4f}".format(
+            name, len(playlist), uncached, cached))
+
+
+def main():
+    """Run the benchmark."""
+    database = dict.fromkeys(
+        'artist{:04}/album{:02}/{:02} track.flac'.format(
+            track // 200, track // 20 % 10, track % 20)
+        for track in range(100000))
+    keys = list(database)
+    prefixes = {
+        'shallow': '/music/',
+        'deep': '/media/user/nas/share/audio/library/lossless/sorted/',
+    }
+    print("{:>8} {:>8} {:>7} {:>10} {:>10} {:>10}".format(
+        "prefix", "lines", "missing", "split [s]", "index [s]",
+        "build [s]"))
+    build = measure(lambda: PathSuffixIndex(database), repeat=1)
+    index = PathSuffixIndex(database)
+    for name, prefix in prefixes.items():
+        for lines, missing in [(10000, 0), (10000, 0.2), (50000, 0)]:
+            playlist = [
+                prefix + keys[line * 7 % 100000] +
+                ('.missing' if line < lines * missing else '')
+                for line in range(lines)]
+            split = measure(lambda: [resolve_by_splitting(database, line)
+                                     for line in playlist], repeat=3)
+            indexed = measure(lambda: [index.resolve(line)
+                                       for line in playlist], repeat=3)
+            print("{:>8} {:8} {:7.0%} {:10.4f} {:10.4f} {:10.4f}".format(
+                name, lines, missing, split, indexed, build))
+    print()
+    with tempfile.TemporaryDirectory() as root:
+        select_files(root, prefixes)
+
+
+if __name__ == '__main__':
+    main()
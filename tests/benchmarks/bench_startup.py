@@ -0,0 +1,105 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Benchmark the startup time of the command line tool.
+
+Measures `sync_music --version` and a sync of a library without changes in
+fresh interpreters. The library consists of small placeholder files and an
+up to date destination, so the codecs are never needed.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import sync_music
+from sync_music.hashdb import HashDb
+
+from . import measure
+
+MAIN = ("import sys; sys.argv[0] = 'sync_music'; "
+        "from sync_music.sync_music import main; main()")
+
+
+def create_unchanged_library(path, files):
+    """Create a library and a destination that is up to date with it.
+
+    :returns: tuple (library path, destination path)
+    """
+    library = os.path.join(path, 'library')
+    output = os.path.join(path, 'output')
+    hashdb = HashDb(os.path.join(output, 'sync_music.db'))
+    for index in range(files):
+        in_filename = 'Artist {:04}/Album {:02}/{:02} Track.flac'.format(
+            index // 100, index // 10 % 10, index % 10)
+        out_filename = os.path.splitext(in_filename)[0] + '.mp3'
+        for filename, content in [(os.path.join(library, in_filename),
+                                   os.urandom(8192)),
+                                  (os.path.join(output, out_filename), b'')]:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as out_file:
+                out_file.write(content)
+        hashdb.database[in_filename] = (
+            out_filename, hashdb.get_hash(os.path.join(library, in_filename)))
+    hashdb.store()
+    return library, output
+
+
+def run_main(*arguments):
+    """Run sync_music in a new interpreter."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(sync_music.__file__))] +
+        ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    subprocess.run([sys.executable, '-c', MAIN] + list(arguments),
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def measure_startup(library, output, repeat=5):
+    """Measure the startup benchmarks.
+
+    :returns: dict name -> seconds
+    """
+    return {
+        'python': measure(lambda: subprocess.run([sys.executable, '-c', ''],
+                                                 check=True), repeat),
+        'version': measure(lambda: run_main('--version'), repeat),
+        'sync_unchanged': measure(lambda: run_main(
+            '--audio-src', library, '--audio-dest', output, '--batch',
+            '--logfile', ''), repeat),
+    }
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as path:
+        library, output = create_unchanged_library(path, args.files)
+        results = measure_startup(library, output, args.repeat)
+    print("{:<16} {:>10}".format("command", "time [s]"))
+    for name, seconds in results.items():
+        print("{:<16} {:10.4f}".format(name, seconds))
+
+
+if __name__ == '__main__':
+    main()
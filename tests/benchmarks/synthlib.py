@@ -0,0 +1,230 @@
+# sync_music - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Synthetic music library generator.
+
+The library is generated locally: tones are encoded with FFmpeg into a small
+set of template tracks per format, which are copied and tagged with Mutagen
+for every track of the library. Albums are stored as artist/album/ folders
+with covers embedded into the tracks, stored as folder.jpg or both.
+"""
+
+import argparse
+import base64
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+import mutagen
+import mutagen.flac
+import mutagen.id3
+import mutagen.mp4
+import mutagen.oggvorbis
+
+FORMATS = {
+    'flac': ['-c:a', 'flac'],
+    'ogg': ['-c:a', 'libvorbis', '-q:a', '5'],
+    'm4a': ['-c:a', 'aac', '-b:a', '192k'],
+    'mp3': ['-c:a', 'libmp3lame', '-b:a', '320k'],
+}
+
+GENRES = ['Rock', 'Jazz', 'Classical', 'Electronic', 'Folk', 'Hip-Hop']
+
+TONES = [220.0, 330.0, 440.0]
+
+
+def ffmpeg(*args):
+    """Run FFmpeg."""
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'] +
+                   list(args), check=True)
+
+
+def create_track(path, codec_args, frequency, duration):
+    """Encode a stereo sine tone."""
+    ffmpeg('-f', 'lavfi',
+           '-i', 'sine=frequency={}:duration={}'.format(frequency, duration),
+           '-ac', '2', '-ar', '44100', *codec_args, path)
+
+
+def create_cover(path, color, size=500):
+    """Create a JPEG cover image filled with a single color."""
+    ffmpeg('-f', 'lavfi', '-i', 'color=c={}:s={}x{}'.format(color, size, size),
+           '-frames:v', '1', path)
+
+
+def tag_track(path, tags, cover=None):
+    """Write realistic tags (and an embedded cover) into a track.
+
+    :param tags: dict with title, artist, album, albumartist, date, genre,
+        tracknumber, tracktotal, discnumber, disctotal
+    """
+    extension = os.path.splitext(path)[1]
+    if extension in ['.flac', '.ogg']:
+        audio = (mutagen.flac.FLAC(path) if extension == '.flac'
+                 else mutagen.oggvorbis.OggVorbis(path))
+        for key, value in tags.items():
+            audio[key] = str(value)
+        audio['replaygain_track_gain'] = '-6.50 dB'
+        audio['replaygain_track_peak'] = '0.950000'
+        audio['replaygain_album_gain'] = '-7.00 dB'
+        audio['replaygain_album_peak'] = '0.990000'
+        if cover is not None:
+            picture = mutagen.flac.Picture()
+            picture.type = mutagen.id3.PictureType.COVER_FRONT
+            picture.mime = 'image/jpeg'
+            picture.data = cover
+            if extension == '.flac':
+                audio.add_picture(picture)
+            else:
+                audio['metadata_block_picture'] = base64.b64encode(
+                    picture.write()).decode('ascii')
+    elif extension == '.m4a':
+        audio = mutagen.mp4.MP4(path)
+        audio['\xa9nam'] = tags['title']
+        audio['\xa9ART'] = tags['artist']
+        audio['\xa9alb'] = tags['album']
+        audio['aART'] = tags['albumartist']
+        audio['\xa9day'] = str(tags['date'])
+        audio['\xa9gen'] = tags['genre']
+        audio['trkn'] = [(tags['tracknumber'], tags['tracktotal'])]
+        audio['disk'] = [(tags['discnumber'], tags['disctotal'])]
+        if cover is not None:
+            audio['covr'] = [mutagen.mp4.MP4Cover(
+                cover, imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)]
+    else:
+        audio = mutagen.File(path)
+        if audio.tags is None:
+            audio.add_tags()
+        for frame, key in [(mutagen.id3.TIT2, 'title'),
+                           (mutagen.id3.TPE1, 'artist'),
+                           (mutagen.id3.TALB, 'album'),
+                           (mutagen.id3.TPE2, 'albumartist'),
+                           (mutagen.id3.TDRC, 'date'),
+                           (mutagen.id3.TCON, 'genre')]:
+            audio.tags.add(frame(encoding=3, text=str(tags[key])))
+        audio.tags.add(mutagen.id3.TRCK(encoding=3, text='{}/{}'.format(
+            tags['tracknumber'], tags['tracktotal'])))
+        audio.tags.add(mutagen.id3.TPOS(encoding=3, text='{}/{}'.format(
+            tags['discnumber'], tags['disctotal'])))
+        if cover is not None:
+            audio.tags.add(mutagen.id3.APIC(
+                encoding=3, mime='image/jpeg',
+                type=mutagen.id3.PictureType.COVER_FRONT, desc='',
+                data=cover))
+    audio.save()
+
+
+def generate_library(path, artists=4, albums=2, tracks=10, duration=10.0,
+                     formats=None, seed=0):
+    """Generate a synthetic music library.
+
+    :param formats: list of formats (keys of FORMATS), albums use them in turn
+    :returns: list of the generated files relative to path
+    """
+    formats = list(FORMATS) if formats is None else formats
+    rng = random.Random(seed)
+    files = []
+    with tempfile.TemporaryDirectory() as template_path:
+        templates = {}
+        for file_format in formats:
+            for tone in TONES:
+                template = os.path.join(template_path, '{}.{}'.format(
+                    tone, file_format))
+                create_track(template, FORMATS[file_format], tone, duration)
+                templates.setdefault(file_format, []).append(template)
+        covers = []
+        for color in ['red', 'green', 'blue', 'orange']:
+            cover = os.path.join(template_path, color + '.jpg')
+            create_cover(cover, color)
+            with open(cover, 'rb') as cover_file:
+                covers.append(cover_file.read())
+
+        album_index = 0
+        for artist in range(1, artists + 1):
+            artist_name = 'Artist {:03}'.format(artist)
+            for album in range(1, albums + 1):
+                file_format = formats[album_index % len(formats)]
+                album_name = 'Album {:02}'.format(album)
+                album_path = os.path.join(artist_name, album_name)
+                os.makedirs(os.path.join(path, album_path), exist_ok=True)
+                cover = covers[album_index % len(covers)]
+                # Covers: 0 embedded, 1 folder.jpg, 2 both
+                cover_mode = album_index % 3
+                if cover_mode > 0:
+                    with open(os.path.join(path, album_path, 'folder.jpg'),
+                              'wb') as cover_file:
+                        cover_file.write(cover)
+                    files.append(os.path.join(album_path, 'folder.jpg'))
+                date = rng.randint(1960, 2020)
+                genre = rng.choice(GENRES)
+                for track in range(1, tracks + 1):
+                    filename = os.path.join(
+                        album_path, '{:02} Track {}.{}'.format(
+                            track, track, file_format))
+                    shutil.copy(rng.choice(templates[file_format]),
+                                os.path.join(path, filename))
+                    tag_track(os.path.join(path, filename), {
+                        'title': 'Track {}'.format(track),
+                        'artist': artist_name, 'album': album_name,
+                        'albumartist': artist_name, 'date': date,
+                        'genre': genre, 'tracknumber': track,
+                        'tracktotal': tracks, 'discnumber': 1,
+                        'disctotal': 1,
+                    }, cover if cover_mode != 1 else None)
+                    files.append(filename)
+                album_index += 1
+    return files
+
+
+def generate_playlists(path, files, playlists=2, lines=100,
+                       prefix='/media/music/', seed=0):
+    """Generate M3U playlists referencing library files by absolute paths."""
+    rng = random.Random(seed)
+    tracks = [f for f in files if not f.endswith('folder.jpg')]
+    os.makedirs(path, exist_ok=True)
+    for playlist in range(1, playlists + 1):
+        with open(os.path.join(path, 'playlist{:03}.m3u'.format(playlist)),
+                  'w', encoding='windows-1252', errors='replace') as out_file:
+            out_file.write('#EXTM3U\n')
+            for _ in range(lines):
+                out_file.write(prefix + rng.choice(tracks) + '\n')
+
+
+def main():
+    """Generate a library from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', help="output folder")
+    parser.add_argument('--artists', type=int, default=4)
+    parser.add_argument('--albums', type=int, default=2,
+                        help="albums per artist")
+    parser.add_argument('--tracks', type=int, default=10,
+                        help="tracks per album")
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help="track duration in seconds")
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    files = generate_library(args.path, args.artists, args.albums,
+                             args.tracks, args.duration, args.formats,
+                             args.seed)
+    print("Generated {} files in {}".format(len(files), args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Fixtures shared by the sync_music tests."""
+
+import os
+import shutil
+
+import pytest
+
+from sync_music.sync_music import SyncMusic
+from sync_music.sync_music import load_settings
+
+REFERENCE_PATH = 'tests/reference_data/regular'
+
+
+class Library:
+    """Temporary music library that is synced in a test."""
+
+    def __init__(self, input_path, output_path):
+        self.input_path = input_path
+        self.output_path = output_path
+
+    def add(self, filenames=None, directory='', source=REFERENCE_PATH):
+        """Copy reference files into the library.
+
+        :param filenames: files to copy, all files of source if None
+        :param directory: directory in the library to copy the files to
+        :param source: directory of the reference files
+        """
+        path = os.path.join(self.input_path, directory)
+        if filenames is None:
+            shutil.copytree(source, path, dirs_exist_ok=True)
+            return
+        os.makedirs(path, exist_ok=True)
+        for filename in filenames:
+            shutil.copy(os.path.join(source, filename), path)
+
+    def create(self, arguments=None, audio_dest=None, jobs=1):
+        """Create a SyncMusic instance for the library.
+
+        :param arguments: additional command line arguments
+        :param audio_dest: destinations, the output path if None
+        :param jobs: number of processes
+        """
+        args = load_settings(
+            ['--batch'] + (arguments or []) +
+            ['--audio-src', self.input_path, '--audio-dest'] +
+            (audio_dest or [self.output_path]))
+        args.jobs = jobs
+        return SyncMusic(args)
+
+    def sync(self, arguments=None, audio_dest=None, jobs=1):
+        """Sync the library, takes the arguments of create.
+
+        :returns: the SyncMusic instance after the sync
+        """
+        sync_music = self.create(arguments, audio_dest, jobs)
+        sync_music.sync_audio()
+        return sync_music
+
+
+@pytest.fixture(name='library')
+def fixture_library(tmpdir_factory, tmpdir):
+    """Temporary library that is synced to the tmpdir of the test."""
+    return Library(str(tmpdir_factory.mktemp('input')), str(tmpdir))
@@ -0,0 +1,106 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests the basic actions."""
+
+import errno
+import os
+
+import pytest
+
+from sync_music import actions
+from sync_music import stats
+from sync_music.actions import copy_file
+
+
+class TestCopyFile:
+    """Tests copying files with the copy strategies."""
+
+    @staticmethod
+    @pytest.fixture()
+    def in_filepath(tmpdir):
+        """Create a source file."""
+        path = str(tmpdir.join('in.mp3'))
+        with open(path, 'wb') as in_file:
+            in_file.write(b'x' * 100000)
+        return path
+
+    @staticmethod
+    @pytest.fixture(autouse=True)
+    def reset_unsupported():
+        """Forget the unsupported operations of other tests."""
+        actions._unsupported.clear()  # pylint: disable=protected-access
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as in_file:
+            return in_file.read()
+
+    def test_copy(self, in_filepath, tmpdir):
+        """Test copying all bytes."""
+        out_filepath = str(tmpdir.join('out.mp3'))
+        with stats.collect() as run_stats:
+            assert copy_file(in_filepath, out_filepath, 'copy') == 'copied'
+        assert self._read(out_filepath) == self._read(in_filepath)
+        assert run_stats.counters['bytes_copied'] == 100000
+
+    def test_hardlink(self, in_filepath, tmpdir):
+        """Test linking and replacing links."""
+        out_filepath = str(tmpdir.join('out.mp3'))
+        with stats.collect() as run_stats:
+            assert copy_file(in_filepath, out_filepath,
+                             'hardlink') == 'linked'
+        assert os.path.samefile(in_filepath, out_filepath)
+        assert run_stats.counters['bytes_linked'] == 100000
+
+        # A link is replaced, never written through
+        other_filepath = str(tmpdir.join('other.mp3'))
+        with open(other_filepath, 'wb') as other_file:
+            other_file.write(b'y')
+        copy_file(other_filepath, out_filepath, 'copy')
+        assert self._read(out_filepath) == b'y'
+        assert self._read(in_filepath) == b'x' * 100000
+
+    def test_clone(self, in_filepath, tmpdir, mocker):
+        """Test cloning and falling back if clones aren't supported."""
+        ioctl = mocker.patch('fcntl.ioctl')
+        out_filepath = str(tmpdir.join('out.mp3'))
+        with stats.collect() as run_stats:
+            assert copy_file(in_filepath, out_filepath) == 'cloned'
+        assert ioctl.call_args[0][1] == actions.FICLONE
+        assert run_stats.counters['bytes_cloned'] == 100000
+
+        ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'Not supported')
+        for _ in range(2):
+            assert copy_file(in_filepath, out_filepath) == 'copied'
+            assert self._read(out_filepath) == self._read(in_filepath)
+        assert ioctl.call_count == 2
+
+        ioctl.side_effect = OSError(errno.EIO, 'I/O error')
+        actions._unsupported.clear()  # pylint: disable=protected-access
+        with pytest.raises(OSError):
+            copy_file(in_filepath, out_filepath)
+
+    def test_copy_file_range(self, in_filepath, tmpdir, mocker):
+        """Test falling back if copy_file_range() isn't supported."""
+        mocker.patch('fcntl.ioctl',
+                     side_effect=OSError(errno.ENOTTY, 'Not supported'))
+        mocker.patch('os.copy_file_range', create=True,
+                     side_effect=OSError(errno.EXDEV, 'Cross device'))
+        out_filepath = str(tmpdir.join('out.mp3'))
+        assert copy_file(in_filepath, out_filepath) == 'copied'
+        assert self._read(out_filepath) == self._read(in_filepath)
@@ -0,0 +1,123 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests the metadata catalog."""
+
+import os
+import shutil
+
+import pytest
+
+from sync_music.catalog import Catalog
+from sync_music.catalog import Query
+from sync_music.catalog import get_fields
+from sync_music.catalog import read_tags
+from sync_music.hashdb import HashDb
+
+
+class TestQuery:
+    """Tests compiling and evaluating queries."""
+
+    fields = get_fields('Jazz/album/track.flac', {
+        'artist': ['the artist'], 'genre': ['jazz', 'blues'],
+        'year': 1995, 'rating': 4.0})
+
+    @pytest.mark.parametrize('expression', [
+        'genre == "Jazz"', 'genre in ["rock", "blues"]', '"artist" in artist',
+        'year >= 1990 and rating > 3', 'year < 1990 or rating == 4',
+        'not genre == "rock"', 'genre != "rock"', '1990 <= year < 2000',
+        'format == "flac"', '"/album/" in path', 'rating', 'not title'])
+    def test_match(self, expression):
+        """Test expressions matching the fields."""
+        assert Query(expression).matches(self.fields)
+
+    @pytest.mark.parametrize('expression', [
+        'genre == "rock"', 'genre not in ["jazz"]', 'year > 2000',
+        'title == "x"', 'artist > 3', 'genre != "blues"'])
+    def test_no_match(self, expression):
+        """Test expressions not matching the fields."""
+        assert not Query(expression).matches(self.fields)
+
+    @pytest.mark.parametrize('expression', [
+        'genre ==', 'unknown == 1', 'genre == artist.lower()',
+        '__import__("os")', 'year + 1 > 2000', 'genre is None',
+        'rating == True'])
+    def test_invalid(self, expression):
+        """Test rejecting invalid expressions."""
+        with pytest.raises(ValueError):
+            Query(expression)
+
+
+class TestCatalog:
+    """Tests reading tags and updating the catalog."""
+
+    input_path = 'tests/reference_data/regular'
+
+    @pytest.mark.parametrize('extension', ['flac', 'mp3', 'ogg', 'm4a'])
+    def test_read_tags(self, extension):
+        """Test normalising the tags of all formats."""
+        entry = read_tags(os.path.join(
+            self.input_path, 'withtags_{}.{}'.format(extension, extension)))
+        assert entry.pop('length') > 0
+        assert entry == {
+            'artist': ['theartist'], 'albumartist': ['thealbumartist'],
+            'album': ['thealbum'], 'title': ['thetitle'], 'genre': ['rock'],
+            'year': 2000, 'tracknumber': 1, 'discnumber': 2}
+        assert set(read_tags(os.path.join(
+            self.input_path, 'stripped_{}.{}'.format(
+                extension, extension)))) <= {'length'}
+        assert read_tags(os.path.join(self.input_path, 'folder.jpg')) is None
+
+    def test_update(self, tmpdir, mocker):
+        """Test parsing only new and changed files."""
+        for filename in ['withtags_mp3.mp3', 'withtags_ogg.ogg']:
+            shutil.copy(os.path.join(self.input_path, filename), str(tmpdir))
+        path = os.path.join(str(tmpdir), 'catalog.db')
+        read = mocker.patch('sync_music.catalog.read_tags',
+                            side_effect=read_tags)
+
+        def _update(in_filenames, removed=None):
+            hashdb = HashDb(path)
+            hashdb.load()
+            catalog = Catalog(hashdb)
+            entries = catalog.update(str(tmpdir), in_filenames, 2, removed)
+            catalog.store()
+            return entries
+
+        entries = _update(['withtags_mp3.mp3', 'withtags_ogg.ogg'])
+        assert entries['withtags_mp3.mp3']['title'] == ['thetitle']
+        assert read.call_count == 2
+        _update(['withtags_mp3.mp3', 'withtags_ogg.ogg'])
+        assert read.call_count == 2
+
+        # Partial updates only remove the files known to be removed
+        exists = mocker.spy(os.path, 'exists')
+        _update(['withtags_mp3.mp3'], removed=[])
+        assert [c for c in exists.call_args_list
+                if c[0][0].endswith('.ogg')] == []
+        hashdb = HashDb(path)
+        hashdb.load()
+        assert len(hashdb.database) == 2
+
+        # Changed files are parsed again, removed ones are dropped
+        os.utime(os.path.join(str(tmpdir), 'withtags_mp3.mp3'), ns=(0, 0))
+        os.remove(os.path.join(str(tmpdir), 'withtags_ogg.ogg'))
+        _update(['withtags_mp3.mp3'])
+        assert read.call_count == 3
+        hashdb = HashDb(path)
+        hashdb.load()
+        assert list(hashdb.database) == ['withtags_mp3.mp3']
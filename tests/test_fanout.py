@@ -0,0 +1,97 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Tests writing processed files to several destinations."""
+
+import os
+
+from sync_music.fanout import FanOut
+from sync_music.stats import RunStats
+
+
+class TestFanOut:
+    """Tests the FanOut implementation."""
+
+    @staticmethod
+    def _stage(fanout, out_filename):
+        """Create a processed file in the staging directory."""
+        path = os.path.join(fanout.staging, out_filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as staged_file:
+            staged_file.write(out_filename)
+
+    def test_write(self, tmpdir):
+        """Test writing files to the destinations that need them."""
+        destinations = [str(tmpdir.mkdir('a')), str(tmpdir.mkdir('b'))]
+        fanout = FanOut(destinations, 2)
+        files = fanout.throttle(['1', '2', '3'])
+        assert next(files) == '1'
+        self._stage(fanout, 'dir/1.mp3')
+        fanout.put(('1.flac', 'dir/1.mp3', 'hash1', [0, 1]))
+        assert next(files) == '2'
+        self._stage(fanout, '2.mp3')
+        fanout.put(('2.flac', '2.mp3', 'hash2', [1]))
+        assert next(files) == '3'
+        fanout.put(None)
+        run_stats = RunStats()
+        fanout.close(run_stats)
+
+        assert fanout.written == [[('1.flac', 'dir/1.mp3', 'hash1')],
+                                  [('1.flac', 'dir/1.mp3', 'hash1'),
+                                   ('2.flac', '2.mp3', 'hash2')]]
+        assert os.path.exists(os.path.join(destinations[0], 'dir/1.mp3'))
+        assert not os.path.exists(os.path.join(destinations[0], '2.mp3'))
+        assert os.path.exists(os.path.join(destinations[1], '2.mp3'))
+        assert len(run_stats.durations['fanout']) == 3
+        assert not os.path.exists(fanout.staging)
+
+    def test_sync(self, tmpdir, mocker):
+        """Test flushing every written file."""
+        fsync_file = mocker.patch('sync_music.util.fsync_file')
+        destination = str(tmpdir.mkdir('a'))
+        fanout = FanOut([destination], 1, sync=True)
+        next(fanout.throttle(['1']))
+        self._stage(fanout, '1.mp3')
+        fanout.put(('1.flac', '1.mp3', 'hash1', [0]))
+        run_stats = RunStats()
+        fanout.close(run_stats)
+        fsync_file.assert_called_once_with(os.path.join(destination, '1.mp3'))
+        assert len(run_stats.durations['flush']) == 1
+
+    def test_write_error(self, tmpdir):
+        """Test a destination that can't be written."""
+        destination = str(tmpdir.join('file'))
+        open(destination, 'w').close()
+        fanout = FanOut([destination], 1)
+        next(fanout.throttle(['1']))
+        self._stage(fanout, '1.mp3')
+        fanout.put(('1.flac', '1.mp3', 'hash1', [0]))
+        run_stats = RunStats()
+        fanout.close(run_stats)
+        assert fanout.written == [[]]
+        assert run_stats.counters['files_failed'] == 1
+
+    @staticmethod
+    def test_abort(tmpdir):
+        """Test that a full buffer blocks until the sync is aborted."""
+        fanout = FanOut([str(tmpdir)], 1)
+        files = fanout.throttle(['1', '2'])
+        assert next(files) == '1'
+        fanout.abort()
+        assert list(files) == []
+        fanout.close()
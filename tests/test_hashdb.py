@@ -18,9 +18,11 @@
 """Tests the HashDb implementation."""
 
 import os
+import pickle
 
 import pytest
 
+from sync_music.fileentries import FileEntries
 from sync_music.sync_music import HashDb
 
 
@@ -60,6 +62,20 @@ class TestHashDb:
         hashdb.load()
         assert hashdb.database == self.data
 
+    def test_sync(self, testfile, mocker):
+        """Test flushing the database to the device."""
+        fsync = mocker.spy(os, 'fsync')
+        hashdb = HashDb(testfile)
+        hashdb.database = dict(self.data)
+        hashdb.store(sync=True)
+        assert fsync.call_count == 3  # Index, offset and directory entry
+        hashdb.load(['test1'])
+        hashdb.store(sync=True)
+        assert fsync.call_count == 5
+        assert os.listdir(os.path.dirname(testfile)) == ['test_hashdb.db']
+        hashdb.load()
+        assert hashdb.database == self.data
+
     @staticmethod
     def test_hash(testfile):
         """Test file hashing."""
@@ -67,3 +83,192 @@ class TestHashDb:
             out_file.write(b"TEST")
         assert HashDb.get_hash(testfile) == \
             '033bd94b1168d7e4f0d644c3c95e35bf'
+
+    @staticmethod
+    def test_scope(testfile):
+        """Test loading and storing a part of the database."""
+        data = {'a/1/x.flac': ('a/1/x.mp3', 'h1'),
+                'a/2/y.flac': ('a/2/y.mp3', 'h2'),
+                'b/z.flac': ('b/z.mp3', 'h3'),
+                'root.flac': ('root.mp3', 'h4')}
+        hashdb = HashDb(testfile)
+        hashdb.database = dict(data)
+        hashdb.store()
+
+        hashdb = HashDb(testfile)
+        hashdb.load(['a/1', 'root.flac'])
+        assert hashdb.database == {'a/1/x.flac': ('a/1/x.mp3', 'h1'),
+                                   'root.flac': ('root.mp3', 'h4')}
+        del hashdb.database['a/1/x.flac']
+        hashdb.database['a/1/new.flac'] = ('a/1/new.mp3', 'h5')
+        del hashdb.database['root.flac']
+        size = os.path.getsize(testfile)
+        hashdb.store()
+        assert os.path.getsize(testfile) > size
+
+        del data['a/1/x.flac'], data['root.flac']
+        data['a/1/new.flac'] = ('a/1/new.mp3', 'h5')
+        hashdb.load()
+        assert hashdb.database == data
+
+        # Storing the whole database drops superseded chunks
+        hashdb.store()
+        assert os.path.getsize(testfile) < size
+        hashdb.load(['b'])
+        assert hashdb.database == {'b/z.flac': ('b/z.mp3', 'h3')}
+
+    @staticmethod
+    def test_compact_file(testfile, mocker):
+        """Test dropping superseded chunks when updating a part."""
+        mocker.patch('sync_music.hashdb.COMPACT_MIN_BYTES', 1000)
+        data = {'{}/{}.flac'.format(top, index): ('out', '0' * 32)
+                for top in 'ab' for index in range(100)}
+        hashdb = HashDb(testfile)
+        hashdb.database = dict(data)
+        hashdb.store()
+        size = os.path.getsize(testfile)
+
+        # Updates of a part append until half of the file is superseded
+        # (the old chunks of 'a' and the old indexes)
+        compact = mocker.spy(hashdb, '_compact_file')
+        hashdb.load(['a'])
+        hashdb.store()
+        assert compact.call_count == 0
+        assert os.path.getsize(testfile) > size
+        hashdb.load(['a'])
+        hashdb.store()
+        assert compact.call_count == 1
+        assert os.path.getsize(testfile) <= size
+        assert os.listdir(os.path.dirname(testfile)) == ['test_hashdb.db']
+        hashdb.load()
+        assert hashdb.database == data
+        hashdb.load(['b'])
+        assert len(hashdb.database) == 100
+
+    @staticmethod
+    def test_store_keys(testfile):
+        """Test storing only the chunks of changed entries."""
+        # pylint: disable=protected-access
+        data = {'a/x.flac': ('a/x.mp3', 'h1'), 'b/y.flac': ('b/y.mp3', 'h2'),
+                'c/z.flac': ('c/z.mp3', 'h3')}
+        hashdb = HashDb(testfile)
+        hashdb.database = dict(data)
+        hashdb.store()
+        with open(testfile, 'rb') as hash_file:
+            index = HashDb._read_index(hash_file)
+
+        hashdb.database['a/new.flac'] = data['a/new.flac'] = ('new', 'h4')
+        del hashdb.database['c/z.flac'], data['c/z.flac']
+        hashdb.store(keys=['a/new.flac', 'c/z.flac'])
+        with open(testfile, 'rb') as hash_file:
+            stored = HashDb._read_index(hash_file)
+        assert stored['b'] == index['b']
+        assert stored['a'] != index['a']
+        assert 'c' not in stored
+        hashdb.load()
+        assert hashdb.database == data
+
+    def test_legacy(self, testfile):
+        """Test loading a database stored as a single pickled dict."""
+        with open(testfile, 'wb') as hash_file:
+            pickle.dump(self.data, hash_file)
+        hashdb = HashDb(testfile)
+        hashdb.load(['test1'])
+        assert hashdb.database == {'test1': ('test2', 'test3')}
+        hashdb.store()
+        hashdb.load()
+        assert hashdb.database == self.data
+
+    @staticmethod
+    def test_compact(testfile):
+        """Test storing and loading a compact database."""
+        data = {'a/1/x.flac': ('a/1/x.mp3', '0' * 32),
+                'a/2/y.mp3': ('a/2/y.mp3', '1' * 32, 10, '2' * 32),
+                'b/z.flac': ('b/z.mp3', 'h3'),
+                'root.flac': ('root.mp3', '3' * 32)}
+        hashdb = HashDb(testfile, compact=True)
+        hashdb.database = data
+        assert isinstance(hashdb.database, FileEntries)
+        hashdb.store()
+        hashdb.load()
+        assert hashdb.database == data
+
+        # Scoped updates keep the other entries
+        hashdb.load(['a/1', 'root.flac'])
+        assert hashdb.database == {'a/1/x.flac': ('a/1/x.mp3', '0' * 32),
+                                   'root.flac': ('root.mp3', '3' * 32)}
+        del hashdb.database['root.flac']
+        hashdb.database['a/1/new.flac'] = ('a/1/new.mp3', '4' * 32)
+        hashdb.store()
+        del data['root.flac']
+        data['a/1/new.flac'] = ('a/1/new.mp3', '4' * 32)
+        hashdb.load()
+        assert hashdb.database == data
+
+        # Databases are converted between the formats
+        legacy = HashDb(testfile)
+        legacy.load()
+        assert legacy.database == data
+        legacy.store()
+        hashdb.load(['b'])
+        assert hashdb.database == {'b/z.flac': ('b/z.mp3', 'h3')}
+        hashdb.store()
+        hashdb.load()
+        assert hashdb.database == data
+
+
+class TestFileEntries:
+    """Tests the compact FileEntries mapping."""
+
+    entries = {
+        'a/copy.mp3': ('a/copy.mp3', '0123456789abcdef' * 2),
+        'a/transcode.flac': ('a/transcode.mp3', 'f' * 32, 123, 'e' * 32),
+        'a/fat32?.flac': ('a/fat32_.mp3', 'd' * 32),
+        'root.ogg': ('root.mp3', 'c' * 32, 0, 'b' * 32),
+        'b/text.flac': ('b/text.mp3', 'not a digest'),
+        'b/upper.flac': ('b/upper.mp3', 'A' * 32),
+        'b/other.flac': ['b/other.mp3', 'a' * 32],
+    }
+
+    def test_mapping(self):
+        """Test that the entries are returned as they were stored."""
+        entries = FileEntries(self.entries)
+        assert len(entries) == len(self.entries)
+        assert entries == {key: tuple(value)
+                           for key, value in self.entries.items()}
+        assert set(entries) == set(self.entries)
+        assert 'a/copy.mp3' in entries
+        assert 'a/missing.mp3' not in entries
+        assert 'c/missing.mp3' not in entries
+        with pytest.raises(KeyError):
+            entries['c/missing.mp3']  # pylint: disable=pointless-statement
+        assert entries.keys() - {'a/copy.mp3'} == \
+            set(self.entries) - {'a/copy.mp3'}
+
+    def test_packing(self):
+        """Test storing the entries in binary form."""
+        entries = FileEntries(self.entries)
+        directory = entries.directories['a']
+        assert directory.outs == [None, '.mp3', ('a/fat32_.mp3',)]
+        assert len(directory.hashes) == 3 * 16
+        assert not directory.extra
+        assert set(entries.directories['b'].extra) == {
+            'text.flac', 'upper.flac', 'other.flac'}
+
+    def test_update(self):
+        """Test replacing and removing entries."""
+        entries = FileEntries(self.entries)
+        entries['a/copy.mp3'] = ('a/copy.mp3', '9' * 32, 5, '8' * 32)
+        assert entries['a/copy.mp3'] == ('a/copy.mp3', '9' * 32, 5, '8' * 32)
+        del entries['a/transcode.flac']
+        assert 'a/transcode.flac' not in entries
+        with pytest.raises(KeyError):
+            del entries['a/transcode.flac']
+        # Free slots are reused
+        entries['a/new.flac'] = ('a/new.mp3', '7' * 32)
+        assert len(entries.directories['a'].outs) == 3
+        assert entries['a/new.flac'] == ('a/new.mp3', '7' * 32)
+        for key in ['b/text.flac', 'b/upper.flac', 'b/other.flac']:
+            del entries[key]
+        assert 'b' not in entries.directories
+        assert len(entries) == 4
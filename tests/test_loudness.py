@@ -0,0 +1,191 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Tests the loudness analysis."""
+
+import os
+
+from unittest import mock
+
+import pytest
+
+from pydub import AudioSegment
+
+from sync_music import loudness
+from sync_music.transcode import Transcode
+from sync_music.util import list_all_files
+
+numpy = pytest.importorskip('numpy')
+
+RATE = 48000
+
+
+def sine(level, seconds, rate=RATE, frequency=1000.0, channels=2):
+    """Create a sine with the given level in dBFS."""
+    samples = numpy.sin(2 * numpy.pi * frequency *
+                        numpy.arange(int(rate * seconds)) / rate)
+    return numpy.repeat((samples * 10 ** (level / 20))[:, None],
+                        channels, axis=1)
+
+
+def measure(samples, rate=RATE):
+    """Measure the integrated loudness of samples."""
+    return loudness.integrated_loudness(
+        loudness.analyze_samples(samples, rate)[1])
+
+
+class TestLoudness:
+    """Tests the loudness analysis."""
+
+    @staticmethod
+    def test_k_weighting():
+        """Test the K-weighting response (BS.1770 48 kHz coefficients)."""
+        response = 10 * numpy.log10(
+            loudness.k_weighting(numpy.array([997.0, 20.0, 10000.0]), RATE))
+        assert response == pytest.approx([0.691, -13.2, 4.0], abs=0.1)
+
+    @staticmethod
+    def test_integrated_loudness():
+        """Test the loudness of sines (EBU Tech 3341)."""
+        assert measure(sine(-23, 20)) == pytest.approx(-23, abs=0.1)
+        assert measure(sine(-23, 20, rate=44100), 44100) == \
+            pytest.approx(-23, abs=0.1)
+        mono = sine(0, 20, frequency=997.0)
+        mono[:, 1] = 0
+        assert measure(mono) == pytest.approx(-3.01, abs=0.1)
+
+    @staticmethod
+    def test_gating():
+        """Test the absolute and relative gate."""
+        samples = numpy.concatenate(
+            [sine(-36, 10), sine(-23, 60), sine(-36, 10)])
+        assert measure(samples) == pytest.approx(-23, abs=0.1)
+        samples = numpy.concatenate(
+            [sine(-72, 10), sine(-36, 10), sine(-72, 10)])
+        assert measure(samples) == pytest.approx(-36, abs=0.2)
+        assert loudness.get_gain(loudness.analyze_samples(
+            numpy.zeros((RATE * 5, 2)), RATE)) is None
+        assert loudness.get_gain(loudness.analyze_samples(
+            sine(-23, 0.3), RATE)) is None
+
+    @staticmethod
+    def test_combine():
+        """Test combining tracks to an album."""
+        quiet = loudness.analyze_samples(sine(-30, 20), RATE)
+        loud = loudness.analyze_samples(sine(-10, 20) * 1.0, RATE)
+        album = loudness.get_gain(loudness.combine([quiet, loud]))
+        expected = measure(numpy.concatenate([sine(-30, 20), sine(-10, 20)]))
+        assert album[0] == pytest.approx(-18 - expected, abs=0.1)
+        assert album[1] == pytest.approx(10 ** (-10 / 20), abs=1e-3)
+        assert loudness.get_gain(quiet)[0] == pytest.approx(12, abs=0.1)
+
+    @staticmethod
+    def test_analyze_segment():
+        """Test analysing decoded audio of different sample widths."""
+        samples = sine(-23, 10)
+        for width in [1, 2, 3, 4]:
+            scale = 2 ** (8 * width - 1) - 1
+            data = numpy.round(samples * scale).astype('<i8')
+            if width == 1:
+                raw = (data + 128).astype(numpy.uint8).tobytes()
+            else:
+                raw = data.astype('<i4').view(numpy.uint8).reshape(
+                    -1, 4)[:, :width].tobytes()
+            segment = AudioSegment(data=raw, sample_width=width,
+                                   frame_rate=RATE, channels=2)
+            peak, histogram = loudness.analyze_segment(segment)
+            assert peak == pytest.approx(10 ** (-23 / 20), abs=0.01)
+            assert loudness.integrated_loudness(histogram) == \
+                pytest.approx(-23, abs=0.2)
+
+
+class TestApplyReplayGain:
+    """Tests applying the ReplayGain to the samples."""
+
+    @staticmethod
+    def _segment(level):
+        """Create a decoded 16 bit stereo sine."""
+        data = numpy.round(sine(level, 5) * 32767).astype('<i2')
+        return AudioSegment(data=data.tobytes(), sample_width=2,
+                            frame_rate=RATE, channels=2)
+
+    def test_track_gain(self):
+        """Test measuring and applying the track gain."""
+        transcode = Transcode(mode='replaygain', replaygain_preamp_gain=1.0)
+        segment = transcode.apply_replaygain(self._segment(-30), 'in.flac')
+        # -30 dBFS sine is about -30 LUFS, the target is -18 + 1 dB
+        assert segment.dBFS == pytest.approx(
+            self._segment(-30).dBFS + 13, abs=0.2)
+
+    def test_given_gain(self):
+        """Test applying a given gain with clipping prevention."""
+        transcode = Transcode(mode='replaygain-album')
+        segment = transcode.apply_replaygain(self._segment(-20), 'in.flac',
+                                             (-6.0, 0.1))
+        assert segment.dBFS == pytest.approx(
+            self._segment(-20).dBFS - 6, abs=0.1)
+        segment = transcode.apply_replaygain(self._segment(-20), 'in.flac',
+                                             (30.0, 0.1))
+        assert segment.max_dBFS == pytest.approx(-0.0, abs=0.1)
+
+
+class TestAlbumAnalysis:
+    """Tests measuring the album gain during a sync."""
+
+    @staticmethod
+    def test_analyze_albums(library):
+        """Test analysing albums with changed files and caching results."""
+        input_path = library.input_path
+        library.add(['withtags.flac', 'stripped.flac'], 'a',
+                    source='tests/reference_data/audiofiles')
+        library.add(['withtags.ogg'], 'b',
+                    source='tests/reference_data/audiofiles')
+        levels = {'withtags.flac': -30, 'stripped.flac': -10,
+                  'withtags.ogg': -20}
+
+        def _analyze_file(path):
+            return loudness.analyze_samples(
+                sine(levels[os.path.basename(path)], 5), RATE)
+
+        def _analyze():
+            sync_music = library.create(['--mode', 'replaygain-album'])
+            files = [(f, sync_music._get_file_action(f), None)
+                     for f in list_all_files(input_path)]
+            return sync_music._analyze_albums(files)
+
+        with mock.patch('sync_music.loudness.analyze_file',
+                        side_effect=_analyze_file) as analyze_file:
+            gains = _analyze()
+            assert analyze_file.call_count == 3
+            assert gains['a/withtags.flac'] == gains['a/stripped.flac']
+            assert gains['a/withtags.flac'][1] == \
+                pytest.approx(10 ** (-10 / 20), abs=1e-3)
+            assert gains['b/withtags.ogg'][0] == pytest.approx(2, abs=0.1)
+            assert 'sync_music_loudness.db' in \
+                list_all_files(library.output_path)
+
+            # Results are cached by the hash, size and modification time
+            assert _analyze() == gains
+            assert analyze_file.call_count == 3
+
+            # Changes after the hashed beginning of a file are detected
+            with open(os.path.join(input_path, 'a', 'withtags.flac'),
+                      'ab') as changed_file:
+                changed_file.write(b'\0')
+            assert _analyze() == gains
+            assert analyze_file.call_count == 4
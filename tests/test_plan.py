@@ -0,0 +1,86 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Tests the dry-run plans."""
+
+import os
+
+from sync_music import plan
+from sync_music import stats
+
+
+class TestPlan:
+    """Tests creating plans and the throughput history."""
+
+    @staticmethod
+    def _entry(action, tags=False, replaces=None):
+        """Create a plan entry."""
+        return {'file': 'in', 'out': 'out', 'hash': '0', 'action': action,
+                'tags': tags, 'bytes': 1000000, 'out_bytes': 500000,
+                'replaces': replaces}
+
+    @staticmethod
+    def test_history(tmpdir):
+        """Test recording the throughput of runs."""
+        path = os.path.join(str(tmpdir), plan.HISTORY_FILENAME)
+        assert plan.load_history(path) == {}
+
+        run_stats = stats.RunStats()
+        run_stats.add('decode', 1.0, 4000000)
+        run_stats.add('encode', 3.0)
+        run_stats.add('tags', 0.5)
+        run_stats.add('tags', 0.5)
+        plan.update_history(path, run_stats)
+        history = plan.load_history(path)
+        assert plan.get_throughput(history, 'transcode') == 1000000
+        assert plan.get_throughput(history, 'tags') == 2
+        assert plan.get_throughput(history, 'copy') is None
+
+        # Previous runs are weighted less than the current run
+        run_stats = stats.RunStats()
+        run_stats.add('decode', 1.0, 4000000)
+        run_stats.add('encode', 1.0)
+        plan.update_history(path, run_stats)
+        throughput = plan.get_throughput(plan.load_history(path), 'transcode')
+        assert 1000000 < throughput < 2000000
+
+    def test_create_plan(self):
+        """Test the summary and the estimates of a plan."""
+        history = {'copy': {'units': 2000000, 'seconds': 1.0},
+                   'transcode': {'units': 1000000, 'seconds': 2.0},
+                   'tags': {'units': 10, 'seconds': 1.0}}
+        entries = [self._entry('transcode', tags=True),
+                   self._entry('copy', replaces={'out': 'old',
+                                                 'bytes': 400}),
+                   self._entry('tags', tags=True)]
+        deletes = [{'file': 'a', 'out': 'a', 'bytes': 300}]
+        result = plan.create_plan({}, entries, deletes, history, 2)
+        summary = result['summary']
+        assert summary['transcode']['seconds'] == 2.1
+        assert summary['copy']['files'] == 1
+        assert summary['copy'] == {'files': 1, 'bytes': 1000000,
+                                   'out_bytes': 500000, 'seconds': 0.5}
+        assert summary['replace'] == {'files': 1, 'bytes': 400}
+        assert summary['delete'] == {'files': 1, 'bytes': 300}
+        assert summary['out_bytes'] == 1500000
+        assert summary['seconds'] == (2.1 + 0.5 + 0.1) / 2
+
+        # Without history the duration is unknown
+        summary = plan.create_plan({}, entries, deletes, {}, 2)['summary']
+        assert summary['seconds'] is None
+        assert summary['transcode']['seconds'] is None
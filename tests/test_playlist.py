@@ -0,0 +1,67 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests the playlist helpers."""
+
+import os
+
+from sync_music.playlist import PathSuffixIndex
+from sync_music.playlist import resolve_in_directory
+
+
+class TestPathSuffixIndex:
+    """Tests the PathSuffixIndex implementation."""
+
+    paths = ['artist/album/track.flac', 'album/track.flac', 'other.mp3']
+
+    def test_resolve(self):
+        """Test resolving absolute and relative paths."""
+        index = PathSuffixIndex(self.paths)
+        assert index.resolve('/music/other.mp3') == ['other.mp3']
+        assert index.resolve('other.mp3') == ['other.mp3']
+        assert index.resolve('smb://server/music/artist/album/track.flac') \
+            == ['artist/album/track.flac', 'album/track.flac']
+
+    def test_unknown(self):
+        """Test resolving unknown paths."""
+        index = PathSuffixIndex(self.paths)
+        assert index.resolve('/music/missing.mp3') == []
+        assert index.resolve('/music/album/other.mp3/') == []
+        assert index.resolve('') == []
+
+
+class TestResolveInDirectory:
+    """Tests resolving paths in the file system."""
+
+    @staticmethod
+    def test_cache(tmpdir, mocker):
+        """Test that the files of a known directory need a single check."""
+        os.makedirs(os.path.join(str(tmpdir), 'artist', 'album'))
+        for name in ['1.flac', '2.flac']:
+            open(os.path.join(str(tmpdir), 'artist', 'album', name),
+                 'w').close()
+        root = str(tmpdir)
+        cache = {}
+        assert resolve_in_directory('/music/artist/album/1.flac', root,
+                                    cache) == 'artist/album/1.flac'
+        isfile = mocker.spy(os.path, 'isfile')
+        assert resolve_in_directory('/music/artist/album/2.flac', root,
+                                    cache) == 'artist/album/2.flac'
+        assert isfile.call_count == 1
+        assert resolve_in_directory('/music/artist/album/3.flac', root,
+                                    cache) is None
+        assert resolve_in_directory('/music/../x.flac', root) is None
@@ -0,0 +1,64 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests the profiling helpers."""
+
+import os
+import pstats
+
+from sync_music import profiling
+
+
+class TestProfiling:
+    """Tests the profiling helpers."""
+
+    @staticmethod
+    def test_profile(tmpdir):
+        """Test profiling and merging the statistics."""
+        directory = str(tmpdir)
+        assert profiling.merge_profiles(directory) is None
+        profiler = profiling.Profiler.get(directory)
+        assert profiling.Profiler.get(directory) is profiler
+        with profiler.profile():
+            sorted(range(1000))
+        # Written at exit or after DUMP_INTERVAL, not after every block
+        assert profiling.merge_profiles(directory) is None
+        profiling.dump_profile()
+        path = profiling.merge_profiles(directory)
+        assert pstats.Stats(path).total_calls > 0
+        profiling.remove_profiles(directory)
+        assert os.listdir(directory) == ['sync_music.pstats']
+
+    @staticmethod
+    def test_memory_stage(tmpdir):
+        """Test tracing memory peaks of nested stages."""
+        results = {}
+        with profiling.memory_stage('outer', results):
+            with profiling.memory_stage('inner', results):
+                buffer = bytearray(4000000)
+            del buffer
+        assert results['inner']['peak'] >= 4000000
+        assert results['outer']['peak'] >= results['inner']['peak']
+
+        merged = {'inner': {'peak': 1, 'top': []}}
+        profiling.merge_memory(merged, results)
+        assert merged == results
+
+        path = os.path.join(str(tmpdir), 'memory.txt')
+        profiling.write_memory_report(path, results)
+        with open(path) as report_file:
+            assert report_file.readline().startswith('inner: peak 4.0 MB')
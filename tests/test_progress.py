@@ -0,0 +1,66 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Tests the progress reporting."""
+
+import io
+import logging
+
+from sync_music import progress
+
+
+class TestProgress:
+    """Tests the Progress and StatusHandler implementation."""
+
+    @staticmethod
+    def test_status_line():
+        """Test showing the progress as status line below log messages."""
+        stream = io.StringIO()
+        handler = progress.StatusHandler(stream)
+        file_progress = progress.Progress(4, handler, interval=0)
+        file_progress.update(nbytes=1000000)
+        assert stream.getvalue().startswith(
+            progress.CLEAR_LINE + '1/4 files, ')
+
+        # Log messages are written above the status line
+        handler.handle(logging.makeLogRecord({'msg': 'message'}))
+        lines = stream.getvalue().split(progress.CLEAR_LINE)
+        assert lines[-1].startswith('message\n1/4 files, ')
+
+        file_progress.finish()
+        assert stream.getvalue().endswith(progress.CLEAR_LINE)
+
+    @staticmethod
+    def test_logged(caplog):
+        """Test logging the progress in intervals."""
+        caplog.set_level(logging.INFO)
+        file_progress = progress.Progress(3, interval=3600)
+        file_progress.update()
+        assert 'Progress' not in caplog.text
+        file_progress = progress.Progress(3, interval=0)
+        file_progress.update(2)
+        assert 'Progress: 2/3 files' in caplog.text
+        file_progress.finish()
+        assert 'Processed 2/3 files' in caplog.text
+
+    @staticmethod
+    def test_format_duration():
+        """Test formatting the ETA."""
+        assert progress.format_duration(3.4) == '3s'
+        assert progress.format_duration(123) == '2m03s'
+        assert progress.format_duration(3723) == '1h02m03s'
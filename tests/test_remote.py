@@ -0,0 +1,355 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Tests distributed transcoding."""
+
+import json
+import os
+import socket
+import threading
+import time
+
+from unittest import mock
+
+import pytest
+
+from sync_music import remote
+from sync_music import stats
+from sync_music.remote import RemoteWorkers
+from sync_music.remote import WorkerServer
+from sync_music.sync_music import load_settings
+from sync_music.transcode import Transcode
+from sync_music.util import list_all_files
+
+
+def fake_transcode(_, in_filepath, out_filepath, gain=None):
+    """Transcode replacement that doesn't need ffmpeg."""
+    del gain
+    with open(in_filepath, 'rb') as in_file:
+        data = in_file.read()
+    if data == b'broken':
+        raise IOError("Failed to transcode file {}".format(in_filepath))
+    with open(out_filepath, 'wb') as out_file:
+        out_file.write(b'mp3:' + data)
+
+
+@pytest.fixture(name='workers')
+def fixture_workers():
+    """Start workers on localhost.
+
+    :returns: function that starts a worker and returns its address
+    """
+    servers = []
+
+    def _start(jobs=2, **kwargs):
+        server = WorkerServer(('127.0.0.1', 0), jobs, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return '{}:{}'.format(*server.server_address), server
+
+    with mock.patch.object(Transcode, 'transcode', fake_transcode):
+        yield _start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+class TestProtocol:
+    """Tests the message format."""
+
+    @staticmethod
+    def test_message():
+        """Test sending and receiving messages."""
+        first, second = socket.socketpair()
+        with first, second:
+            remote.send_message(first, {'type': 'hello'})
+            remote.send_message(first, {'status': 'ok'}, b'\x00' * 100000)
+            assert remote.receive_message(second) == \
+                ({'type': 'hello', 'size': 0}, b'')
+            assert remote.receive_message(second) == \
+                ({'status': 'ok', 'size': 100000}, b'\x00' * 100000)
+            first.close()
+            with pytest.raises(ConnectionError):
+                remote.receive_message(second)
+
+    @staticmethod
+    def test_parse_address():
+        """Test parsing worker addresses."""
+        assert remote.parse_address('localhost:7531') == ('localhost', 7531)
+        assert remote.parse_address('[::1]:80') == ('[::1]', 80)
+        with pytest.raises(ValueError):
+            remote.parse_address('localhost')
+
+    @staticmethod
+    def test_worker_settings(tmpdir):
+        """Test that workers only listen on other interfaces with a secret."""
+        args = remote.load_worker_settings([])
+        assert args.listen == '127.0.0.1:7531'
+        assert args.secret is None
+        assert remote.is_loopback('localhost')
+        assert remote.is_loopback('[::1]')
+        assert not remote.is_loopback('0.0.0.0')
+        assert not remote.is_loopback('example.com')
+        with pytest.raises(SystemExit):
+            remote.load_worker_settings(['--listen', '0.0.0.0:7531'])
+
+        secret_path = str(tmpdir.join('secret'))
+        with open(secret_path, 'w') as secret_file:
+            secret_file.write('geheim\n')
+        args = remote.load_worker_settings(['--listen', '0.0.0.0:7531',
+                                            '--secret-file', secret_path])
+        assert args.secret == 'geheim'
+
+
+class TestRemoteWorkers:
+    """Tests dispatching transcode jobs to workers."""
+
+    @staticmethod
+    def _create_file(tmpdir, name, data=b'audio'):
+        """Create a source file."""
+        path = str(tmpdir.join(name))
+        with open(path, 'wb') as source_file:
+            source_file.write(data)
+        return path
+
+    @staticmethod
+    def _read(path):
+        """Read a file."""
+        with open(path, 'rb') as out_file:
+            return out_file.read()
+
+    def test_transcode(self, tmpdir, workers):
+        """Test transcoding on several workers."""
+        addresses = [workers(jobs=2)[0], workers(jobs=3)[0]]
+        remote_workers = RemoteWorkers(addresses, local_jobs=0)
+        assert remote_workers.remote_slots == 5
+        action = Transcode(copy_tags=False)
+        with stats.collect() as run_stats:
+            for index in range(4):
+                in_filepath = self._create_file(
+                    tmpdir, '{}.flac'.format(index), str(index).encode())
+                out_filepath = str(tmpdir.join('{}.mp3'.format(index)))
+                remote_workers.transcode(action, in_filepath, out_filepath)
+                assert self._read(out_filepath) == \
+                    'mp3:{}'.format(index).encode()
+        assert run_stats.counters['files_remote'] == 4
+        throughput = remote_workers.get_throughput()
+        assert throughput['local'] is None
+        assert all(throughput[address] for address in addresses)
+
+    def test_shared_paths(self, tmpdir, workers):
+        """Test sending paths to workers that share the source files."""
+        address, server = workers(source_root=str(tmpdir))
+        remote_workers = RemoteWorkers([address], local_jobs=0,
+                                       shared_paths=True)
+        in_filepath = self._create_file(tmpdir, 'in.flac')
+        out_filepath = str(tmpdir.join('out.mp3'))
+        with mock.patch.object(server, 'transcode',
+                               wraps=server.transcode) as transcode:
+            remote_workers.transcode(Transcode(), in_filepath, out_filepath)
+            assert transcode.call_count == 1
+            assert transcode.call_args[0][1] == b''
+            assert self._read(out_filepath) == b'mp3:audio'
+
+            # The file contents are sent if the path doesn't exist there
+            with mock.patch('os.path.isfile', return_value=False):
+                remote_workers.transcode(Transcode(), in_filepath,
+                                         out_filepath)
+            assert transcode.call_count == 3
+            assert transcode.call_args[0][1] == b'audio'
+
+    def test_source_root(self, tmpdir, workers):
+        """Test that workers only read paths below their source root."""
+        source_root = tmpdir.mkdir('root')
+        address, server = workers(source_root=str(source_root))
+        remote_workers = RemoteWorkers([address], local_jobs=0,
+                                       shared_paths=True)
+        outside = self._create_file(tmpdir, 'outside.flac', b'secret')
+        os.symlink(outside, str(source_root.join('link.flac')))
+        out_filepath = str(tmpdir.join('out.mp3'))
+        for in_filepath in [
+                outside, str(source_root.join('link.flac')),
+                os.path.join(str(source_root), '..', 'outside.flac')]:
+            assert server.get_source_path(in_filepath) is None
+        with mock.patch.object(server, 'transcode',
+                               wraps=server.transcode) as transcode:
+            # The worker answers 'missing' and gets the file contents
+            remote_workers.transcode(Transcode(), outside, out_filepath)
+            assert transcode.call_count == 2
+            assert transcode.call_args[0][1] == b'secret'
+
+        # Workers without source root don't read any paths
+        address, server = workers()
+        assert server.get_source_path(outside) is None
+
+    def test_secret(self, tmpdir, workers):
+        """Test that workers only accept requests with their secret."""
+        address, _ = workers(secret='geheim')
+        assert RemoteWorkers([address], local_jobs=0).addresses == [None]
+        assert RemoteWorkers([address], local_jobs=0,
+                             secret='other').addresses == [None]
+        remote_workers = RemoteWorkers([address], local_jobs=0,
+                                       secret='geheim')
+        assert remote_workers.addresses == [None, address]
+        in_filepath = self._create_file(tmpdir, 'in.flac')
+        out_filepath = str(tmpdir.join('out.mp3'))
+        remote_workers.transcode(Transcode(), in_filepath, out_filepath)
+        assert self._read(out_filepath) == b'mp3:audio'
+
+    @staticmethod
+    def test_limits(workers):
+        """Test that payloads are only read for authorized requests."""
+        address, _ = workers(secret='geheim')
+
+        def _request(header, length=None):
+            data = json.dumps(header).encode()
+            with socket.create_connection(remote.parse_address(address),
+                                          timeout=5) as connection:
+                connection.sendall(remote.HEADER_LENGTH.pack(
+                    len(data) if length is None else length) + data)
+                return remote.receive_message(connection)
+
+        # The payload isn't read, even if it's too large
+        header = {'type': 'transcode', 'secret': 'other', 'size': 1 << 40}
+        assert _request(header)[0] == {'status': 'error',
+                                       'message': "Wrong secret",
+                                       'size': 0}
+        for header, length in [(dict(header, secret='geheim'), None),
+                               ({'type': 'hello'}, 1 << 20)]:
+            with pytest.raises(ConnectionError):
+                _request(header, length)
+
+    @staticmethod
+    def test_timeout():
+        """Test that workers not answering the hello are skipped quickly."""
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen()  # Connections are never accepted
+            address = '{}:{}'.format(*server.getsockname())
+            start = time.monotonic()
+            with mock.patch.object(remote, 'CONNECT_TIMEOUT', 0.2):
+                assert RemoteWorkers([address], 1).addresses == [None]
+            assert time.monotonic() - start < 2
+
+    def test_transcode_error(self, tmpdir, workers):
+        """Test that files failing on a worker are not retried locally."""
+        remote_workers = RemoteWorkers([workers()[0]], local_jobs=0)
+        in_filepath = self._create_file(tmpdir, 'in.flac', b'broken')
+        with pytest.raises(remote.RemoteError):
+            remote_workers.transcode(Transcode(), in_filepath,
+                                     str(tmpdir.join('out.mp3')))
+        # pylint: disable=protected-access
+        assert list(remote_workers._failed) == [0, 0]
+        assert list(remote_workers._busy) == [0, 0]
+
+    def test_fallback(self, tmpdir, workers):
+        """Test falling back to local transcoding if a worker fails."""
+        address, server = workers()
+        remote_workers = RemoteWorkers([address, '127.0.0.1:1'],
+                                       local_jobs=1)
+        assert remote_workers.addresses == [None, address]
+        server.shutdown()
+        server.server_close()
+
+        # pylint: disable=protected-access
+        remote_workers._throughput[0] = 1.0
+        in_filepath = self._create_file(tmpdir, 'in.flac')
+        out_filepath = str(tmpdir.join('out.mp3'))
+        with stats.collect() as run_stats:
+            remote_workers.transcode(Transcode(), in_filepath, out_filepath)
+        assert self._read(out_filepath) == b'mp3:audio'
+        assert 'files_remote' not in run_stats.counters
+        assert list(remote_workers._failed) == [0, 1]
+        assert list(remote_workers._busy) == [0, 0]
+
+    @staticmethod
+    def test_select():
+        """Test balancing the load by the observed throughput."""
+        # pylint: disable=protected-access
+        remote_workers = RemoteWorkers([], local_jobs=2)
+        remote_workers.addresses += ['a:1', 'b:1']
+        remote_workers.slots += [1, 1]
+        remote_workers._throughput = [10.0, 0.0, 30.0]
+        remote_workers._busy = [0, 0, 0]
+        remote_workers._failed = [0, 0, 0]
+
+        # Unknown workers are measured first, then the fastest is used
+        assert remote_workers._select(local_only=False) == 1
+        remote_workers._throughput[1] = 20.0
+        assert remote_workers._select(local_only=False) == 2
+        assert remote_workers._select(local_only=True) == 0
+
+        # Waiting for the fastest worker is better than using a slow one
+        remote_workers._busy = [0, 1, 1]
+        assert remote_workers._select(local_only=False) is None
+        remote_workers._throughput[0] = 15.0
+        assert remote_workers._select(local_only=False) == 0
+
+        # Failed workers are ignored
+        remote_workers._throughput[0] = 10.0
+        remote_workers._failed = [0, 1, 1]
+        assert remote_workers._select(local_only=False) == 0
+        remote_workers._busy = [2, 0, 0]
+        assert remote_workers._select(local_only=False) is None
+
+    @staticmethod
+    def test_release():
+        """Test averaging the observed throughput."""
+        # pylint: disable=protected-access
+        remote_workers = RemoteWorkers([], local_jobs=1)
+        remote_workers._busy[0] = 2
+        remote_workers._release(0, 100, 1.0)
+        assert remote_workers._throughput[0] == 100.0
+        remote_workers._release(0, 200, 1.0)
+        assert remote_workers._throughput[0] == pytest.approx(130.0)
+        assert remote_workers._busy[0] == 0
+
+
+class TestSyncMusicRemote:
+    """Tests syncing with remote workers."""
+
+    @staticmethod
+    def test_sync(library, workers):
+        """Test transcoding with local and remote workers."""
+        library.add()
+        sync_music = library.sync([
+            '--disable-tag-processing',
+            '--remote-worker', workers()[0], '127.0.0.1:1'])
+        assert set(list_all_files(library.output_path)) == {
+            'stripped_flac.mp3', 'stripped_mp3.mp3',
+            'stripped_ogg.mp3', 'stripped_m4a.mp3',
+            'withtags_flac.mp3', 'withtags_mp3.mp3',
+            'withtags_ogg.mp3', 'withtags_m4a.mp3',
+            'sync_music.db', 'folder.jpg', 'dir/folder.jpg'}
+        with open(os.path.join(library.output_path, 'withtags_flac.mp3'),
+                  'rb') as out_file:
+            assert out_file.read(4) == b'mp3:'
+        counters = sync_music.stats.report()['counters']
+        assert counters['files_changed'] == 10
+        assert 'files_failed' not in counters
+
+    @staticmethod
+    def test_settings():
+        """Test loading the remote worker settings."""
+        args = load_settings(['--audio-src', '/tmp', '--audio-dest', '/tmp',
+                              '--remote-worker', 'a:1', 'b:2'])
+        assert args.remote_worker == ['a:1', 'b:2']
+        assert args.remote_secret is None
+        with pytest.raises(SystemExit):
+            load_settings(['--audio-src', '/tmp', '--audio-dest', '/tmp',
+                           '--remote-worker', 'a'])
@@ -0,0 +1,126 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests the run statistics."""
+
+import json
+import os
+
+from sync_music import stats
+
+
+class TestRunStats:
+    """Tests the RunStats implementation."""
+
+    @staticmethod
+    def _create_stats():
+        """Create statistics with known values."""
+        run_stats = stats.RunStats()
+        for duration in range(1, 101):
+            run_stats.add('encode', duration / 100, 1000000)
+        run_stats.add('process', 10.0)
+        run_stats.count('files', 20)
+        run_stats.count('audio_seconds', 1010.0)
+        return run_stats
+
+    def test_report(self):
+        """Test the report values."""
+        report = self._create_stats().report()
+        encode = report['stages']['encode']
+        assert encode['count'] == 100
+        assert encode['p50'] == 0.5
+        assert encode['p90'] == 0.9
+        assert encode['p99'] == 0.99
+        assert encode['max'] == 1.0
+        assert encode['bytes'] == 100000000
+        assert report['files_per_second'] == 2.0
+        assert report['mb_per_second'] == 10.0
+        assert report['realtime_factor'] == 20.0
+
+    def test_merge(self):
+        """Test merging statistics of worker tasks."""
+        run_stats = stats.RunStats()
+        with stats.collect() as task_stats:
+            stats.add('encode', 1.0, 10)
+            stats.count('files')
+            with stats.stage('decode'):
+                pass
+        run_stats.merge(task_stats)
+        run_stats.merge(task_stats)
+        assert run_stats.durations['encode'] == [1.0, 1.0]
+        assert len(run_stats.durations['decode']) == 2
+        assert run_stats.nbytes['encode'] == 20
+        assert run_stats.counters['files'] == 2
+
+    @staticmethod
+    def test_no_collection():
+        """Test that stages outside of a task are not recorded."""
+        with stats.stage('decode'):
+            stats.add('decode', 1.0)
+            stats.count('files')
+
+    def test_write(self, tmpdir):
+        """Test writing JSON and Prometheus reports."""
+        run_stats = self._create_stats()
+        json_path = os.path.join(str(tmpdir), 'report.json')
+        run_stats.write_json(json_path)
+        with open(json_path) as json_file:
+            assert json.load(json_file)['files_per_second'] == 2.0
+
+        prom_path = os.path.join(str(tmpdir), 'sync_music.prom')
+        run_stats.write_prometheus(prom_path)
+        with open(prom_path) as prom_file:
+            metrics = prom_file.read().splitlines()
+        assert 'sync_music_stage_seconds{stage="encode",quantile="0.5"} 0.5' \
+            in metrics
+        assert 'sync_music_files_per_second 2.0' in metrics
+        assert sorted(os.listdir(str(tmpdir))) == ['report.json',
+                                                   'sync_music.prom']
+
+    @staticmethod
+    def test_trace(tmpdir):
+        """Test recording trace events."""
+        run_stats = stats.RunStats(trace=True)
+        with stats.collect(trace=True) as task_stats:
+            with stats.trace('Copying', 'file', file='a.mp3') as event_args:
+                event_args['bytes'] = 10
+                with stats.stage('write', 10):
+                    pass
+        run_stats.merge(task_stats)
+        with run_stats.stage('store'):
+            pass
+        assert [(e['name'], e['cat'], e['args']) for e in run_stats.events] \
+            == [('write', 'stage', {'bytes': 10}),
+                ('Copying', 'file', {'file': 'a.mp3', 'bytes': 10}),
+                ('store', 'stage', {})]
+
+        trace_path = os.path.join(str(tmpdir), 'trace.json')
+        run_stats.write_trace(trace_path)
+        with open(trace_path) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+        assert events[0]['ph'] == 'M'
+        assert len(events) == 4
+
+    @staticmethod
+    def test_trace_disabled():
+        """Test that no events are recorded without tracing."""
+        with stats.collect() as task_stats:
+            with stats.trace('Copying', 'file') as event_args:
+                assert event_args is None
+                with stats.stage('write'):
+                    pass
+        assert task_stats.events is None
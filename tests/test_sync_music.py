@@ -17,15 +17,22 @@
 
 """Tests sync_music."""
 
+import json
 import os
 import shutil
+import sys
 
 from unittest import mock
 
 import pytest
 
+import sync_music.sync_music
+from sync_music import plan
+from sync_music.catalog import read_tags
+from sync_music.hashdb import HashDb
 from sync_music.sync_music import SyncMusic
 from sync_music.sync_music import load_settings
+from sync_music.transcode import Transcode
 from sync_music.util import list_all_files
 
 
@@ -55,6 +62,17 @@ class TestSyncMusicSettings:
         with pytest.raises(SystemExit):
             load_settings(argv)
 
+    @staticmethod
+    def test_version(capsys):
+        """Tests showing the version."""
+        with pytest.raises(SystemExit):
+            load_settings(['--version'])
+        assert capsys.readouterr().out.strip() == \
+            '{} {}'.format(os.path.basename(sys.argv[0]),
+                           sync_music.sync_music.__version__)
+        with pytest.raises(AttributeError):
+            getattr(sync_music.sync_music, 'nonexistent')
+
     @staticmethod
     def test_configfile():
         """Tests loading of settings within config file."""
@@ -163,6 +181,617 @@ class TestSyncMusicFiles():
         with mock.patch('sync_music.util.query_yes_no', side_effect=query_yes):
             self._execute_sync_music(input_path, output_files)
 
+    def test_cleanup_single_query(self, tmpdir_factory):
+        """Test cleanup asking once for all files removed from the input."""
+        input_path = str(tmpdir_factory.mktemp('input'))
+        for filename in ['stripped_mp3.mp3', 'withtags_mp3.mp3', 'folder.jpg']:
+            shutil.copy(os.path.join(self.input_path, filename), input_path)
+        arguments = ['--mode=copy', '-j', '2']
+        self._execute_sync_music(
+            input_path, ['stripped_mp3.mp3', 'withtags_mp3.mp3',
+                         'folder.jpg', 'sync_music.db'], arguments[:])
+
+        os.remove(os.path.join(input_path, 'withtags_mp3.mp3'))
+        os.remove(os.path.join(input_path, 'folder.jpg'))
+        with mock.patch('sync_music.util.query_yes_no',
+                        return_value=True) as query:
+            self._execute_sync_music(
+                input_path, ['stripped_mp3.mp3', 'sync_music.db'],
+                arguments[:], jobs=2)
+        query.assert_called_once()
+
+    def test_cleanup_directories(self, tmpdir_factory):
+        """Test cleanup of empty directories (incremental and full)."""
+        input_path = str(tmpdir_factory.mktemp('input'))
+        os.makedirs(os.path.join(input_path, 'a', 'b'))
+        shutil.copy(os.path.join(self.input_path, 'folder.jpg'),
+                    os.path.join(input_path, 'a', 'b'))
+        shutil.copy(os.path.join(self.input_path, 'folder.jpg'), input_path)
+        self._execute_sync_music(
+            input_path, ['a/b/folder.jpg', 'folder.jpg', 'sync_music.db'],
+            ['--mode=copy', '--batch'])
+
+        # Only the directories of removed files are cleaned up
+        os.mkdir(os.path.join(self.output_path, 'untouched'))
+        shutil.rmtree(os.path.join(input_path, 'a'))
+        self._execute_sync_music(
+            input_path, ['folder.jpg', 'sync_music.db'],
+            ['--mode=copy', '--batch'])
+        assert not os.path.exists(os.path.join(self.output_path, 'a'))
+        assert os.path.isdir(os.path.join(self.output_path, 'untouched'))
+
+        # A full cleanup sweeps the whole destination
+        self._execute_sync_music(
+            input_path, ['folder.jpg', 'sync_music.db'],
+            ['--mode=copy', '--batch', '--full-directory-cleanup'])
+        assert not os.path.exists(os.path.join(self.output_path, 'untouched'))
+
+    def test_reports(self, tmpdir_factory):
+        """Test writing run reports."""
+        report_path = str(tmpdir_factory.mktemp('report'))
+        argv = ['--mode=copy',
+                '--report', os.path.join(report_path, 'report.json'),
+                '--prometheus', os.path.join(report_path, 'sync_music.prom'),
+                '--audio-src', self.input_path,
+                '--audio-dest', self.output_path]
+        args = load_settings(argv)
+        args.jobs = 2
+        sync_music = SyncMusic(args)
+        sync_music.sync_audio()
+        sync_music.write_reports()
+        with open(os.path.join(report_path, 'report.json')) as report_file:
+            report = json.load(report_file)
+        assert report['counters']['files'] == 11
+        assert report['counters']['files_changed'] == 10
+        assert set(report['stages']) == {'scan', 'cleanup', 'hash', 'write',
+                                         'digest', 'process', 'store'}
+        assert os.path.exists(os.path.join(report_path, 'sync_music.prom'))
+
+    def test_trace(self, tmpdir_factory):
+        """Test writing a trace of the worker activity."""
+        trace_path = os.path.join(str(tmpdir_factory.mktemp('trace')),
+                                  'trace.json')
+        argv = ['--mode=copy', '--trace', trace_path,
+                '--audio-src', self.input_path,
+                '--audio-dest', self.output_path]
+        args = load_settings(argv)
+        args.jobs = 2
+        sync_music = SyncMusic(args)
+        sync_music.sync_audio()
+        sync_music.write_reports()
+        with open(trace_path) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+        files = [e for e in events if e.get('cat') == 'file']
+        assert len(files) == 11
+        assert {e['name'] for e in files} == {'Copying', 'Skipping'}
+        assert {e['pid'] for e in files} != {os.getpid()}
+
+    def test_profile(self, tmpdir_factory):
+        """Test profiling the main and the worker processes."""
+        profile_path = str(tmpdir_factory.mktemp('profile'))
+        argv = ['--mode=copy', '--profile', profile_path, '--profile-memory',
+                '--audio-src', self.input_path,
+                '--audio-dest', self.output_path]
+        args = load_settings(argv)
+        args.jobs = 2
+        sync_music = SyncMusic(args)
+        sync_music.sync_audio()
+        sync_music.write_reports()
+        assert len([f for f in os.listdir(profile_path)
+                    if f.startswith('process-')]) > 1
+        assert os.path.exists(os.path.join(profile_path, 'sync_music.pstats'))
+        with open(os.path.join(profile_path, 'memory.txt')) as memory_file:
+            assert memory_file.read().startswith('cleanup: peak')
+
+    def test_plan(self):
+        """Test planning a sync without writing anything."""
+        output_path = os.path.join(self.output_path, 'dest')
+        argv = ['--plan', os.path.join(self.output_path, 'plan.json'),
+                '--audio-src', self.input_path, '--audio-dest', output_path]
+        sync_plan = SyncMusic(load_settings(argv)).plan_audio()
+        assert not os.path.exists(output_path)
+        summary = sync_plan['summary']
+        assert summary['transcode']['files'] == 6
+        assert summary['copy']['files'] == 4
+        assert summary['tags']['files'] == 0
+        assert summary['delete']['files'] == 0
+        assert 0 < summary['transcode']['out_bytes'] < \
+            summary['transcode']['bytes']
+        assert summary['seconds'] is None
+
+    @staticmethod
+    def test_plan_execute(library, tmpdir_factory):
+        """Test executing a plan and estimating with the run history."""
+        input_path = library.input_path
+        library.add(['stripped_mp3.mp3', 'withtags_mp3.mp3', 'folder.jpg'])
+        plan_path = os.path.join(str(tmpdir_factory.mktemp('plan')),
+                                 'plan.json')
+
+        def _plan_and_execute(output_files):
+            sync_music = library.create(['--mode=copy', '--plan', plan_path])
+            plan.write_plan(plan_path, sync_music.plan_audio())
+            sync_music = library.create(['--mode=copy', '--execute-plan',
+                                         plan_path])
+            sync_plan = sync_music.read_plan(plan_path)
+            sync_music.sync_audio(sync_plan)
+            assert set(list_all_files(library.output_path)) == \
+                set(output_files)
+            return sync_plan['summary']
+
+        summary = _plan_and_execute(['stripped_mp3.mp3', 'withtags_mp3.mp3',
+                                     'folder.jpg', 'sync_music.db'])
+        assert summary['copy']['files'] == 3
+        assert summary['seconds'] is None
+
+        # The second plan is estimated with the throughput of the first run
+        library.add(['withtags_flac.flac'])
+        os.remove(os.path.join(input_path, 'folder.jpg'))
+        summary = _plan_and_execute(['stripped_mp3.mp3', 'withtags_mp3.mp3',
+                                     'withtags_flac.flac', 'sync_music.db'])
+        assert summary['copy']['files'] == 1
+        assert summary['delete']['files'] == 1
+        assert summary['seconds'] is not None
+
+        # Plans are only valid for the settings they were created with
+        with pytest.raises(ValueError):
+            library.create().read_plan(plan_path)
+
+    def test_replaced_output(self, tmpdir_factory):
+        """Test removing outputs that are written under another name."""
+        input_path = str(tmpdir_factory.mktemp('input'))
+        shutil.copy(os.path.join(self.input_path, 'withtags_flac.flac'),
+                    input_path)
+        self._execute_sync_music(input_path,
+                                 ['withtags_flac.flac', 'sync_music.db'],
+                                 ['--mode=copy'])
+
+        # Transcoding writes a new output and removes the copy
+        argv = ['--audio-src', input_path, '--audio-dest', self.output_path]
+        summary = SyncMusic(load_settings(argv)).plan_audio()['summary']
+        assert summary['transcode']['files'] == 1
+        assert summary['replace']['files'] == 1
+        assert summary['replace']['bytes'] > 0
+        self._execute_sync_music(input_path,
+                                 ['withtags_flac.mp3', 'sync_music.db'])
+
+    @staticmethod
+    def test_multiple_destinations(library, tmpdir_factory):
+        """Test processing files once for several destinations."""
+        library.add(['stripped_mp3.mp3', 'withtags_mp3.mp3', 'folder.jpg'])
+        audio_dests = [library.output_path,
+                       str(tmpdir_factory.mktemp('second'))]
+        second_path = audio_dests[1]
+        output_files = ['stripped_mp3.mp3', 'withtags_mp3.mp3', 'folder.jpg',
+                        'sync_music.db']
+
+        def _sync(jobs):
+            sync_music = library.sync(
+                ['--mode=copy', '--destination-buffer', '1'],
+                audio_dest=audio_dests, jobs=jobs)
+            for path in audio_dests:
+                assert set(list_all_files(path)) == set(output_files)
+            return sync_music.stats.report()
+
+        report = _sync(jobs=2)
+        assert report['counters']['files_changed'] == 3
+        assert report['stages']['fanout']['count'] == 6
+
+        # Only the destination that needs a file gets it, the file is
+        # processed once
+        os.remove(os.path.join(second_path, 'folder.jpg'))
+        report = _sync(jobs=1)
+        assert report['counters']['files_changed'] == 1
+        assert report['stages']['fanout']['count'] == 1
+
+        # Files removed from the source are removed from all destinations
+        os.remove(os.path.join(library.input_path, 'folder.jpg'))
+        output_files.remove('folder.jpg')
+        _sync(jobs=2)
+
+    @staticmethod
+    def test_rebuild_db(library):
+        """Test rebuilding the hash database from the destination."""
+        library.add(['stripped_mp3.mp3', 'withtags_mp3.mp3', 'folder.jpg'])
+        db_path = os.path.join(library.output_path, 'sync_music.db')
+
+        def _sync(arguments, rebuild=False):
+            sync_music = library.create(arguments)
+            if rebuild:
+                os.remove(db_path)
+                sync_music.rebuild_db()
+            sync_music.sync_audio()
+            return sync_music.stats.report()['counters']
+
+        _sync([])
+        hashdb = HashDb(db_path)
+        hashdb.load()
+        database = hashdb.database
+        counters = _sync([], rebuild=True)
+        assert 'files_changed' not in counters
+        hashdb.load()
+        # The digests of the outputs are only recorded when writing them
+        assert hashdb.database == {key: value[:2]
+                                   for key, value in database.items()}
+
+        # Outputs written with other settings are processed again
+        counters = _sync(['--tracknumber-hack'], rebuild=True)
+        assert counters['files_changed'] == 2
+
+    @staticmethod
+    def test_only(library):
+        """Test syncing a part of the library."""
+        input_path, output_path = library.input_path, library.output_path
+        for album in ['a', 'b']:
+            library.add(['stripped_mp3.mp3', 'folder.jpg'], album)
+
+        def _sync(only=None):
+            return library.sync(
+                ['--mode=copy', '--full-directory-cleanup'] +
+                (['--only'] + only if only else [])).stats.report()['counters']
+
+        _sync()
+        # Changes outside of the scope are ignored
+        os.remove(os.path.join(input_path, 'a', 'folder.jpg'))
+        shutil.rmtree(os.path.join(input_path, 'b'))
+        library.add(['stripped_mp3.mp3'], 'c')
+        counters = _sync(only=['c/'])
+        assert counters['files'] == 1
+        assert set(list_all_files(output_path)) == {
+            'a/stripped_mp3.mp3', 'a/folder.jpg', 'b/stripped_mp3.mp3',
+            'b/folder.jpg', 'c/stripped_mp3.mp3', 'sync_music.db'}
+
+        # Removed files and directories of the scope are cleaned up
+        _sync(only=['b', 'a/folder.jpg'])
+        assert set(list_all_files(output_path)) == {
+            'a/stripped_mp3.mp3', 'c/stripped_mp3.mp3', 'sync_music.db'}
+        assert not os.path.exists(os.path.join(output_path, 'b'))
+        hashdb = HashDb(os.path.join(output_path, 'sync_music.db'))
+        hashdb.load()
+        assert set(hashdb.database) == {'a/stripped_mp3.mp3',
+                                        'c/stripped_mp3.mp3'}
+
+        for only in [['..'], ['.'], ['/']]:
+            with pytest.raises(SystemExit):
+                load_settings(['--audio-src', input_path, '--audio-dest',
+                               output_path, '--only'] + only)
+
+    @staticmethod
+    def test_select(library, mocker):
+        """Test selecting the files by their tags."""
+        output_path = library.output_path
+        library.add(['withtags_mp3.mp3', 'withtags_ogg.ogg', 'folder.jpg'],
+                    'a')
+        library.add(['stripped_mp3.mp3', 'folder.jpg'], 'b')
+        read = mocker.patch('sync_music.catalog.read_tags',
+                            side_effect=read_tags)
+
+        def _sync(select):
+            library.sync(['--mode=copy', '--select', select])
+
+        _sync('genre == "rock" and format == "mp3"')
+        assert set(list_all_files(output_path)) == {
+            'a/withtags_mp3.mp3', 'a/folder.jpg', 'sync_music.db',
+            'sync_music_catalog.db'}
+        assert read.call_count == 3
+
+        # Unchanged files are not parsed again
+        _sync('not genre')
+        assert set(list_all_files(output_path)) == {
+            'b/stripped_mp3.mp3', 'b/folder.jpg', 'sync_music.db',
+            'sync_music_catalog.db'}
+        assert read.call_count == 3
+
+        with pytest.raises(SystemExit):
+            load_settings(['--audio-src', library.input_path, '--audio-dest',
+                           output_path, '--select', 'genre = "rock"'])
+
+    @staticmethod
+    def test_verify(library, caplog):
+        """Test verifying the destination and creating bad files again."""
+        input_path, output_path = library.input_path, library.output_path
+        library.add()
+
+        def _sync(arguments=None):
+            sync_music = library.create(['--mode=copy'] + (arguments or []),
+                                        jobs=2)
+            if arguments:
+                sync_music.verify_audio()
+            sync_music.sync_audio()
+            return sync_music.stats.report()['counters']
+
+        _sync()
+        hashdb = HashDb(os.path.join(output_path, 'sync_music.db'))
+        hashdb.load()
+        out_filepath = os.path.join(output_path, 'stripped_mp3.mp3')
+        assert hashdb.database['stripped_mp3.mp3'][2:] == \
+            HashDb.get_digest(out_filepath)
+
+        # Corrupted, truncated and missing files
+        with open(out_filepath, 'r+b') as out_file:
+            out_file.seek(1000)
+            out_file.write(b'corrupted')
+        with open(os.path.join(output_path, 'withtags_mp3.mp3'),
+                  'r+b') as out_file:
+            out_file.truncate(1000)
+        os.remove(os.path.join(output_path, 'folder.jpg'))
+        counters = _sync(['--verify'])
+        assert counters['verify_files'] == 10
+        assert counters['verify_failed'] == 3
+        assert counters['files_changed'] == 3
+        assert "File withtags_mp3.mp3 is truncated" in caplog.text
+        assert "File stripped_mp3.mp3 is corrupted" in caplog.text
+        assert HashDb.get_digest(out_filepath) == HashDb.get_digest(
+            os.path.join(input_path, 'stripped_mp3.mp3'))
+
+        counters = _sync(['--verify', '0.5'])
+        assert counters['verify_files'] == 5
+        assert counters['verify_failed'] == 0
+
+        # Digests are recorded for entries without them, then verified
+        hashdb.load()
+        hashdb.database = {key: value[:2]
+                           for key, value in hashdb.database.items()}
+        hashdb.store()
+        counters = _sync(['--verify'])
+        assert counters['verify_recorded'] == 10
+        assert counters['verify_failed'] == 0
+        assert "10 files are unverified" in caplog.text
+        with open(out_filepath, 'r+b') as out_file:
+            out_file.seek(1000)
+            out_file.write(b'corrupted')
+        counters = _sync(['--verify'])
+        assert counters['verify_recorded'] == 0
+        assert counters['verify_failed'] == 1
+        for fraction in ['0', '2']:
+            with pytest.raises(SystemExit):
+                load_settings(['--audio-src', input_path, '--audio-dest',
+                               output_path, '--verify', fraction])
+
+    @staticmethod
+    def test_durability(library, mocker):
+        """Test flushing the written files with the durability modes."""
+        fsync_file = mocker.spy(sync_music.util, 'fsync_file')
+        syncfs = mocker.spy(sync_music.util, 'syncfs')
+        store = mocker.spy(HashDb, 'store')
+        library.add()
+
+        def _sync(arguments):
+            return library.sync(['--mode=copy', '-f'] +
+                                arguments).stats.report()
+
+        report = _sync(['--durability', 'per-file'])
+        assert fsync_file.call_count == 10
+        assert syncfs.call_count == 0
+        assert store.call_args.kwargs == {'sync': True, 'keys': None}
+        assert report['stages']['flush']['count'] == 10
+
+        # Checkpoints store the database after each file with interval 0
+        fsync_file.reset_mock()
+        store.reset_mock()
+        report = _sync(['--durability', 'batched',
+                        '--checkpoint-interval', '0'])
+        assert fsync_file.call_count == 0
+        assert syncfs.call_count == 12
+        assert store.call_count == 12
+        assert 'checkpoint' in report['stages']
+
+        syncfs.reset_mock()
+        _sync([])
+        assert syncfs.call_count == 0
+        assert fsync_file.call_count == 0
+
+    @staticmethod
+    def test_copy_strategy(library, caplog):
+        """Test hard linking copies, but not copies with modified tags."""
+        input_path, output_path = library.input_path, library.output_path
+        library.add(['stripped_mp3.mp3', 'folder.jpg'])
+
+        def _sync(arguments):
+            return library.sync(['--copy-strategy', 'hardlink'] +
+                                arguments).stats.report()['counters']
+
+        counters = _sync(['--mode=copy'])
+        for filename in ['stripped_mp3.mp3', 'folder.jpg']:
+            assert os.path.samefile(os.path.join(input_path, filename),
+                                    os.path.join(output_path, filename))
+        assert counters['bytes_linked'] == sum(
+            os.path.getsize(os.path.join(input_path, f))
+            for f in ['stripped_mp3.mp3', 'folder.jpg'])
+        assert "MB hard linked" in caplog.text
+
+        # MP3s get their tags modified in the auto mode
+        counters = _sync(['-f'])
+        assert not os.path.samefile(
+            os.path.join(input_path, 'stripped_mp3.mp3'),
+            os.path.join(output_path, 'stripped_mp3.mp3'))
+        assert 'bytes_linked' in counters
+
+    def test_watch(self, library, tmpdir_factory, mocker):
+        """Test syncing only the changes reported in watch mode."""
+        input_path = library.input_path
+        playlist_path = str(tmpdir_factory.mktemp('playlists'))
+        album = os.path.join(input_path, 'album')
+        library.add(['stripped_mp3.mp3'])
+        library.add(['withtags_mp3.mp3', 'folder.jpg'], 'album')
+        with open(os.path.join(playlist_path, 'list.m3u'), 'w') as playlist:
+            playlist.write('album/withtags_mp3.mp3\n')
+        sync = library.sync(['--mode=copy', '--watch',
+                             '--playlist-src', playlist_path])
+        sync.sync_playlists()
+
+        def _watch(changes):
+            watcher = mocker.Mock()
+            watcher.wait.side_effect = [changes, KeyboardInterrupt]
+            sync.watch(watcher)
+            assert watcher.close.called
+            return sync.stats.report()['stages']
+
+        # Only the changed directory is synced and stored
+        store = mocker.spy(HashDb, 'store')
+        shutil.copy(os.path.join(self.input_path, 'stripped_mp3.mp3'),
+                    os.path.join(album, 'new.mp3'))
+        os.remove(os.path.join(album, 'folder.jpg'))
+        with open(os.path.join(playlist_path, 'list.m3u'), 'a') as playlist:
+            playlist.write('album/new.mp3\n')
+        stages = _watch({os.path.join(album, 'new.mp3'),
+                         os.path.join(album, 'folder.jpg'),
+                         os.path.join(album, '.new.mp3.tmp'),
+                         os.path.join(playlist_path, 'list.m3u')})
+        assert 'scan' not in stages
+        assert stages['process']['count'] == 1
+        assert [call.kwargs['keys'] for call in store.call_args_list
+                if call.args[0].path.endswith('sync_music.db')] == [
+                    {'album/withtags_mp3.mp3', 'album/new.mp3',
+                     'album/folder.jpg'}]
+        assert set(list_all_files(self.output_path)) == {
+            'stripped_mp3.mp3', 'album/withtags_mp3.mp3', 'album/new.mp3',
+            'list.m3u', 'sync_music.db', 'sync_music_playlists.db'}
+        with open(os.path.join(self.output_path, 'list.m3u')) as playlist:
+            assert 'album\\new.mp3' in playlist.read()
+        hashdb = HashDb(os.path.join(self.output_path, 'sync_music.db'))
+        hashdb.load()
+        assert set(hashdb.database) == {
+            'stripped_mp3.mp3', 'album/withtags_mp3.mp3', 'album/new.mp3'}
+
+        # Removed directories remove all files below them
+        shutil.rmtree(album)
+        _watch({album})
+        assert set(list_all_files(self.output_path)) == {
+            'stripped_mp3.mp3', 'list.m3u', 'sync_music.db',
+            'sync_music_playlists.db'}
+
+        # Everything is synced again if events were lost
+        shutil.copy(os.path.join(self.input_path, 'withtags_mp3.mp3'),
+                    input_path)
+        assert 'scan' in _watch(None)
+        assert 'withtags_mp3.mp3' in list_all_files(self.output_path)
+
+        for argv in [['--only', 'album'], ['--plan', 'plan.json'],
+                     ['--watch-delay', '-1']]:
+            with pytest.raises(SystemExit):
+                load_settings(['--watch', '--audio-src', input_path,
+                               '--audio-dest', self.output_path] + argv)
+
+    def test_watch_select(self, library, mocker):
+        """Test keeping the catalog in memory in watch mode."""
+        album = os.path.join(library.input_path, 'album')
+        library.add(['withtags_mp3.mp3'], 'album')
+        sync = library.sync(['--mode=copy', '--watch',
+                             '--select', 'genre == "rock"'])
+
+        load = mocker.spy(HashDb, 'load')
+        read = mocker.patch('sync_music.catalog.read_tags',
+                            side_effect=read_tags)
+        shutil.copy(os.path.join(self.input_path, 'withtags_mp3.mp3'),
+                    os.path.join(album, 'new.mp3'))
+        shutil.copy(os.path.join(self.input_path, 'stripped_mp3.mp3'),
+                    os.path.join(album, 'stripped.mp3'))
+        watcher = mocker.Mock()
+        watcher.wait.side_effect = [{os.path.join(album, 'new.mp3'),
+                                     os.path.join(album, 'stripped.mp3')},
+                                    KeyboardInterrupt]
+        sync.watch(watcher)
+        assert load.call_count == 0
+        assert read.call_count == 2
+        assert set(list_all_files(self.output_path)) == {
+            'album/withtags_mp3.mp3', 'album/new.mp3', 'sync_music.db',
+            'sync_music_catalog.db'}
+        hashdb = HashDb(os.path.join(self.output_path,
+                                     'sync_music_catalog.db'))
+        hashdb.load()
+        assert set(hashdb.database) == {
+            'album/withtags_mp3.mp3', 'album/new.mp3', 'album/stripped.mp3'}
+
+    def test_codecs(self, library):
+        """Test syncing destinations with different codecs."""
+        import mutagen
+        Transcode(codec='opus').execute(
+            os.path.join(self.input_path, 'withtags_flac.flac'),
+            os.path.join(library.input_path, 'track.opus'))
+        library.add(['folder.jpg'])
+        audio_dests = [os.path.join(library.output_path, name)
+                       for name in ['opus1', 'mp3', 'opus2', 'aac']]
+        sync = library.create(['--codec', 'opus:96', 'mp3', 'opus:96', 'aac'],
+                              audio_dest=audio_dests)
+        # pylint: disable=protected-access
+        assert [d._args.audio_dest for d in sync._get_all_destinations()] \
+            == [audio_dests[0], audio_dests[2], audio_dests[1],
+                audio_dests[3]]
+        sync.sync_audio()
+        assert 'files_failed' not in sync.stats.counters
+
+        # Opus files are copied for the Opus destinations (with new tags)
+        for audio_dest in [audio_dests[0], audio_dests[2]]:
+            assert set(list_all_files(audio_dest)) == {
+                'track.opus', 'folder.jpg', 'sync_music.db'}
+            out_file = mutagen.File(os.path.join(audio_dest, 'track.opus'))
+            assert isinstance(out_file, mutagen.oggopus.OggOpus)
+        # and decoded for the others
+        for audio_dest, out_filename in [(audio_dests[1], 'track.mp3'),
+                                         (audio_dests[3], 'track.m4a')]:
+            assert set(list_all_files(audio_dest)) == {
+                out_filename, 'folder.jpg', 'sync_music.db'}
+        out_file = mutagen.File(os.path.join(audio_dests[1], 'track.mp3'))
+        assert isinstance(out_file, mutagen.mp3.MP3)
+        assert out_file.info.length > 0
+        out_file = mutagen.File(os.path.join(audio_dests[3], 'track.m4a'))
+        assert isinstance(out_file, mutagen.mp4.MP4)
+        assert out_file.info.codec == 'mp4a.40.2'  # AAC LC
+        assert out_file.tags['\xa9ART'] == ['TheArtist']
+
+        # Changing the codec replaces the outputs
+        library.sync(['--codec', 'opus'], audio_dest=audio_dests[1:2])
+        assert set(list_all_files(audio_dests[1])) == {
+            'track.opus', 'folder.jpg', 'sync_music.db'}
+
+        assert load_settings(['--audio-src', '/tmp', '--audio-dest', '/tmp',
+                              '/proc', '--codec', 'aac']).codec == \
+            ['aac', 'aac']
+        for codecs in [['aac', 'mp3'], ['opus:97'], ['flac']]:
+            with pytest.raises(SystemExit):
+                load_settings(['--audio-src', '/tmp', '--audio-dest', '/tmp',
+                               '/proc', '/dev', '--codec'] + codecs)
+        # AAC has no VBR quality levels
+        with pytest.raises(SystemExit):
+            load_settings(['--audio-src', '/tmp', '--audio-dest', '/tmp',
+                           '--codec', 'aac', '--varbitrate', '2'])
+        assert load_settings(['--audio-src', '/tmp', '--audio-dest', '/tmp',
+                              '--codec', 'aac:128', '--varbitrate',
+                              '2']).codec == ['aac:128']
+
+    @staticmethod
+    def test_low_bitrate(library, caplog):
+        """Test copying MP3s at or below the target bitrate."""
+        library.add(['stripped_mp3.mp3', 'withtags_mp3.mp3'])
+        sync_music = library.sync(['--mode', 'transcode'])
+        counters = sync_music.stats.report()['counters']
+        assert counters['encodes_avoided'] == 2
+        assert counters['files_changed'] == 2
+        assert "Copied 2 MP3s at or below the target bitrate" in caplog.text
+
+    @staticmethod
+    def test_multiple_destinations_settings():
+        """Test loading several destinations."""
+        args = load_settings(['--audio-src', '/tmp',
+                              '--audio-dest', '/tmp', '/tmp/../proc'])
+        assert args.audio_dest == '/tmp'
+        assert args.audio_dests == ['/tmp', '/proc']
+        for argv in [['--audio-dest', '/tmp', '/tmp/'],
+                     ['--audio-dest', '/tmp', '/proc', '--plan', 'plan.json'],
+                     ['--audio-dest', '/tmp', '--destination-buffer', '0']]:
+            with pytest.raises(SystemExit):
+                load_settings(['--audio-src', '/tmp'] + argv)
+
+    def test_worker_logging(self, mocker, caplog):
+        """Test sending the log records of the workers to the main process."""
+        mocker.patch('sync_music.actions.Copy.execute',
+                     side_effect=IOError('Mocked exception'))
+        self._execute_sync_music(output_files=['sync_music.db'],
+                                 arguments=['--mode=copy', '--progress'],
+                                 jobs=2)
+        assert caplog.text.count('Mocked exception') == 10
+        assert 'Processed 11/11 files' in caplog.text
+
     def test_reference_multiprocessing(self):
         """Test reference folder with parallel jobs."""
         self._execute_sync_music(jobs=4)
@@ -247,6 +876,51 @@ class TestSyncMusicPlaylists():
         """Tests playlist generation."""
         self._execute_sync_music()
 
+    def test_playlists_unchanged(self, tmpdir_factory):
+        """Tests that unchanged playlists are not rewritten."""
+        playlist_path = str(tmpdir_factory.mktemp('playlists'))
+        shutil.copy(os.path.join(self.playlist_path, 'normal.m3u'),
+                    playlist_path)
+        destpath = os.path.join(self.output_path, 'normal.m3u')
+        self._execute_sync_music(playlist_path)
+        inode = os.stat(destpath).st_ino
+        self._execute_sync_music(playlist_path)
+        assert os.stat(destpath).st_ino == inode
+
+        # Changed playlists are rewritten
+        with open(os.path.join(playlist_path, 'normal.m3u'), 'a') as playlist:
+            playlist.write('stripped_mp3.mp3\n')
+        self._execute_sync_music(playlist_path)
+        with open(destpath, 'rb') as playlist:
+            assert playlist.read().count(b'stripped_mp3.mp3\r\n') == 2
+
+    def test_playlists_selection(self):
+        """Tests syncing only files referenced by playlists."""
+        argv = ['--audio-src', self.input_path,
+                '--audio-dest', self.output_path,
+                '--playlist-src', self.playlist_path,
+                '--mode=copy', '--batch']
+        SyncMusic(load_settings(argv[:])).sync_audio()
+        assert 'dir/folder.jpg' in list_all_files(self.output_path)
+
+        # Files not referenced by playlists are removed
+        sync_music = SyncMusic(load_settings(argv + ['--playlist-selection']))
+        sync_music.sync_audio()
+        sync_music.sync_playlists()
+        assert set(list_all_files(self.output_path)) == {
+            'stripped_flac.flac', 'stripped_mp3.mp3', 'stripped_ogg.ogg',
+            'withtags_flac.flac', 'withtags_mp3.mp3', 'withtags_ogg.ogg',
+            'folder.jpg', 'normal.m3u', 'sync_music.db',
+            'sync_music_playlists.db'}
+
+    @staticmethod
+    def test_playlists_selection_without_playlists():
+        """Tests that a playlist selection requires playlists."""
+        argv = ['--audio-src', '/tmp', '--audio-dest', '/tmp',
+                '--playlist-selection']
+        with pytest.raises(SystemExit):
+            load_settings(argv)
+
     def test_playlists_exists(self):
         """Tests playlist generation when playlist exists."""
         shutil.copy('tests/reference_data/playlists/normal.m3u',
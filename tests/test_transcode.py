@@ -22,6 +22,8 @@ import shutil
 
 import pytest
 
+from sync_music import loudness
+from sync_music import stats
 from sync_music.sync_music import Transcode
 
 
@@ -97,11 +99,142 @@ class TestTranscode():
         self.execute_transcode(Transcode(),
                                in_filename=self.in_filename_mp3empty)
 
+    def test_source(self):
+        """Tests storing the source information in the output file."""
+        transcode = Transcode()
+        out_filepath = os.path.join(self.output_path, self.out_filename)
+        transcode.execute(os.path.join(self.input_path, self.in_filename_mp3),
+                          out_filepath, source=('dir/in.mp3', 'hash'))
+        assert transcode.read_source(out_filepath) == \
+            ('dir/in.mp3', 'hash', transcode.fingerprint)
+        assert Transcode(bitrate='128').fingerprint != transcode.fingerprint
+
+        # Source information of MP3 sources is not passed on
+        in_filepath = out_filepath
+        out_filepath = os.path.join(self.output_path, 'out.mp3')
+        transcode.execute(in_filepath, out_filepath)
+        assert transcode.read_source(out_filepath) is None
+        assert transcode.read_source(
+            os.path.join(self.input_path, self.img_filename)) is None
+
+    def test_codecs(self):
+        """Tests the output file names and settings of the codecs."""
+        assert Transcode(codec='opus').get_out_filename(
+            self.in_filename_flac) == 'withtags.opus'
+        assert Transcode(codec='aac').get_out_filename(
+            self.in_filename_flac) == 'withtags.m4a'
+        fingerprints = {Transcode(codec=codec).fingerprint
+                        for codec in ['mp3', 'opus', 'aac']}
+        assert len(fingerprints) == 3
+
+    def test_transcode_codecs(self):
+        """Tests transcoding to Opus and AAC."""
+        import mutagen
+        for codec, out_filename in [('opus', 'withtags.opus'),
+                                    ('aac', 'withtags.m4a')]:
+            self.execute_transcode(Transcode(codec=codec),
+                                   out_filename=out_filename)
+            out_file = mutagen.File(os.path.join(self.output_path,
+                                                 out_filename))
+            assert out_file.info.length > 0
+
+    def test_transcode_opus_source(self):
+        """Tests decoding Opus sources (Ogg streams for ffmpeg)."""
+        import mutagen.mp3
+        opus_filepath = os.path.join(self.output_path, 'in.opus')
+        Transcode(codec='opus').transcode(
+            os.path.join(self.input_path, self.in_filename_flac),
+            opus_filepath)
+        out_filepath = os.path.join(self.output_path, self.out_filename)
+        Transcode(mode='transcode').transcode(opus_filepath, out_filepath)
+        assert mutagen.mp3.MP3(out_filepath).info.length > 0
+        if loudness.available():
+            assert loudness.analyze_file(opus_filepath)[0] > 0
+
+    def test_varbitrate_codecs(self):
+        """Tests the VBR quality levels of the codecs."""
+        sizes = []
+        for level in ['0', '9']:
+            transcode = Transcode(codec='opus', var_bitrate=level)
+            out_filepath = os.path.join(self.output_path,
+                                        '{}.opus'.format(level))
+            transcode.transcode(
+                os.path.join(self.input_path, self.in_filename_flac),
+                out_filepath)
+            sizes.append(os.path.getsize(out_filepath))
+        assert sizes[0] > sizes[1]
+        with pytest.raises(ValueError):
+            Transcode(codec='aac', var_bitrate='5')
+
+    def test_copy_tags_vorbis(self):
+        """Tests copying tags to Opus files (vorbis comments)."""
+        import mutagen
+        out_filepath = os.path.join(self.output_path, 'out.opus')
+        shutil.copy(os.path.join(self.input_path, self.in_filename_oggempty),
+                    out_filepath)
+        transcode = Transcode(codec='opus', mode='replaygain')
+        transcode.copy_tags(
+            os.path.join(self.input_path, self.in_filename_mp3all),
+            out_filepath, source=('dir/in.mp3', 'hash'))
+        tags = mutagen.File(out_filepath).tags
+        assert tags['artist'] == ['TheArtist']
+        assert tags['tracknumber'] == ['1']
+        assert tags['discnumber'] == ['2']
+        assert tags['disctotal'] == ['2']
+        assert 'musicbrainz_trackid' in tags
+        assert 'replaygain_track_gain' not in tags
+        assert 'metadata_block_picture' in tags
+        assert transcode.read_source(out_filepath) == \
+            ('dir/in.mp3', 'hash', transcode.fingerprint)
+
+    def test_copy_tags_mp4(self):
+        """Tests copying tags to AAC files (MP4 atoms)."""
+        import mutagen
+        out_filepath = os.path.join(self.output_path, 'out.m4a')
+        shutil.copy(os.path.join(self.input_path, self.in_filename_m4aempty),
+                    out_filepath)
+        transcode = Transcode(codec='aac', albumartist_composer_hack=True)
+        transcode.copy_tags(
+            os.path.join(self.input_path, self.in_filename_flacall),
+            out_filepath, source=('dir/in.flac', 'hash'))
+        tags = mutagen.File(out_filepath).tags
+        assert tags['\xa9ART'] == ['TheArtist']
+        assert tags['\xa9wrt'] == ['TheAlbumArtist']
+        assert tags['trkn'] == [(1, 1)]
+        assert tags['----:com.apple.iTunes:replaygain_track_gain'] == [
+            b'+0.78 dB']
+        assert len(tags['covr']) == 1
+        assert transcode.read_source(out_filepath) == \
+            ('dir/in.flac', 'hash', transcode.fingerprint)
+
+        with pytest.raises(IOError):
+            transcode.copy_tags(
+                os.path.join(self.input_path, self.in_filename_flacall),
+                os.path.join(self.input_path, self.in_filename_mp3empty))
+
     def test_transcode_transcode(self):
         """Tests transcoding with forced transcode."""
-        self.execute_transcode(Transcode(mode='transcode'),
+        self.execute_transcode(Transcode(mode='transcode', bitrate='96'),
                                in_filename=self.in_filename_mp3)
 
+    def test_transcode_low_bitrate(self):
+        """Tests copying MP3s at or below the target bitrate."""
+        with stats.collect() as run_stats:
+            self.execute_transcode(Transcode(mode='transcode'),
+                                   in_filename=self.in_filename_mp3)
+        assert run_stats.counters['encodes_avoided'] == 1
+        assert 'encode' not in run_stats.durations
+        in_filepath = os.path.join(self.input_path, self.in_filename_mp3)
+        assert Transcode(mode='transcode').plan(
+            in_filepath, 'out.mp3')['action'] == 'copy'
+
+        # pylint: disable=protected-access
+        assert Transcode(mode='transcode', bitrate='96')._needs_encode(
+            in_filepath)
+        assert Transcode(mode='replaygain')._needs_encode(in_filepath)
+        assert Transcode(mode='transcode')._needs_encode(os.path.join(
+            self.input_path, self.in_filename_flac))
+
     def test_transcode_replaygain(self):
         """Tests transcoding with ReplayGain (track based)."""
         self.execute_transcode(Transcode(mode='replaygain'),
@@ -0,0 +1,112 @@
+# music_sync - Sync music library to external device
+# Copyright (C) 2013-2018 Christian Fetzer
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Tests watching directory trees."""
+
+import os
+import time
+
+import pytest
+
+from sync_music import watch
+
+
+@pytest.fixture(name='watcher')
+def fixture_watcher(tmpdir):
+    """Watch a temporary directory."""
+    with watch.Watcher([str(tmpdir)]) as watcher:
+        yield watcher
+
+
+class TestWatcher:
+    """Tests the inotify watcher."""
+
+    @staticmethod
+    def test_changes(tmpdir, watcher):
+        """Test that written, moved and removed files are reported."""
+        path = str(tmpdir)
+        assert watcher.read(0) == set()
+        with open(os.path.join(path, 'new.flac'), 'w') as new_file:
+            new_file.write('content')
+        os.rename(os.path.join(path, 'new.flac'),
+                  os.path.join(path, 'moved.flac'))
+        os.remove(os.path.join(path, 'moved.flac'))
+        assert watcher.read(1) == {os.path.join(path, 'new.flac'),
+                                   os.path.join(path, 'moved.flac')}
+
+    @staticmethod
+    def test_new_directories(tmpdir, tmpdir_factory, watcher):
+        """Test that directories moved into the tree are watched."""
+        album = str(tmpdir_factory.mktemp('album'))
+        os.mkdir(os.path.join(album, 'cd1'))
+        open(os.path.join(album, 'cd1', 'track.flac'), 'w').close()
+        path = os.path.join(str(tmpdir), 'album')
+        os.rename(album, path)
+        assert watcher.wait(0.1) == {path,
+                                     os.path.join(path, 'cd1', 'track.flac')}
+
+        open(os.path.join(path, 'cd1', 'other.flac'), 'w').close()
+        assert watcher.wait(0.1) == {os.path.join(path, 'cd1', 'other.flac')}
+
+    @staticmethod
+    def test_removed_directories(tmpdir, tmpdir_factory, watcher):
+        """Test that directories moved out of the tree aren't watched."""
+        path = os.path.join(str(tmpdir), 'album')
+        os.makedirs(os.path.join(path, 'cd1'))
+        assert watcher.wait(0.1) == {path}
+        moved = os.path.join(str(tmpdir_factory.mktemp('outside')), 'album')
+        os.rename(path, moved)
+        assert watcher.wait(0.1) == {path}
+        open(os.path.join(moved, 'cd1', 'track.flac'), 'w').close()
+        assert watcher.read(0.1) == set()
+
+        # Removed directories are only reported by their parent
+        os.makedirs(os.path.join(path, 'cd1'))
+        watcher.wait(0.1)
+        os.rmdir(os.path.join(path, 'cd1'))
+        os.rmdir(path)
+        assert watcher.wait(0.1) == {path, os.path.join(path, 'cd1')}
+        # pylint: disable=protected-access
+        assert list(watcher._directories.values()) == [str(tmpdir)]
+
+    @staticmethod
+    def test_wait(tmpdir, watcher, mocker):
+        """Test that bursts are coalesced and lost events are reported."""
+        path = str(tmpdir)
+
+        def _read(changes):
+            changes = iter(changes)
+
+            def _next(timeout=None):
+                try:
+                    return next(changes)
+                except StopIteration:
+                    time.sleep(timeout)
+                    return set()
+            return _next
+
+        # Reads without relevant events don't end the burst
+        mocker.patch.object(watcher, 'read', side_effect=_read(
+            [set(), {os.path.join(path, 'a')}, set(),
+             {os.path.join(path, 'b')}]))
+        assert watcher.wait(0.1) == {os.path.join(path, 'a'),
+                                     os.path.join(path, 'b')}
+
+        mocker.patch.object(watcher, 'read',
+                            side_effect=_read([{path}, None]))
+        assert watcher.wait(0.1) is None